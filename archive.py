@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+完了から時間の経った案件を別の DB (アーカイブ) に移す
+
+operation_orders・spot_info は増える一方で、完了済みの案件と削除済みの写真も
+/get_locations などで毎回読まれる。完了から ARCHIVE_AFTER_DAYS 日を過ぎた案件を、
+その写真ごと ATTACH したアーカイブ DB (ARCHIVE_DB_PATH) に移して運用中の表を小さく保つ
+
+移すのは ARCHIVE_BATCH_SIZE 件ずつで、1 回分を
+  1. アーカイブに写す (アーカイブ側だけの書き込み)
+  2. 運用中の DB から消す (写した後に変わった案件は消さずに、写した分を取り消す)
+の 2 つの短いトランザクションで行う。WAL の DB を ATTACH した場合のトランザクションは
+DB をまたいで不可分にならないので、途中で止まっても両方に残る (取りこぼさない) 順にしている。
+アーカイブへは INSERT OR REPLACE なので、やり直しても重複しない
+
+運用中の DB からの削除は通常の削除と同じく、トリガーで墓標 (差分取得の removed)・
+地図の集計・R*Tree・ルームの件数 (rooms は運用中の案件だけの件数になる) に反映される。
+削除済みの写真も案件と一緒に移す (operation_status は削除済みの写真も見て決まるので、
+写真だけを先に移すことはしない)
+
+空いたページは incremental vacuum で返す。auto_vacuum が INCREMENTAL でない既存の DB は
+--enable-incremental-vacuum で 1 度だけ VACUUM し直す (DB 全体を書き直すので、空いている時間に)
+
+python archive.py [--days 180] [--before YYYY-MM-DD] [--enable-incremental-vacuum]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from urllib.parse import quote
+from zoneinfo import ZoneInfo
+
+from db import DB_PATH, connect
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DB_PATH = os.getenv(
+    "ARCHIVE_DB_PATH", os.path.splitext(DB_PATH)[0] + "-archive.db"
+)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+# incremental vacuum 1 回で返すページ数 (1 回ごとに書き込みのロックを離す)
+ARCHIVE_VACUUM_PAGES = int(os.getenv("ARCHIVE_VACUUM_PAGES", "2000"))
+
+# アーカイブする表と、アーカイブ側に作るインデックス
+ARCHIVE_INDEXES = {
+    "operation_orders": (("msg_id",), ("room_id", "operation_status"), ("completed",)),
+    "spot_info": (("msg_id",), ("image_filename",)),
+}
+
+
+def _table_columns(conn, schema, table):
+    """
+    [(列名, 型), ...]。生成列 (spot_info.bucket) も含める
+    """
+    return [
+        (row[1], row[2])
+        for row in conn.execute(f"PRAGMA {schema}.table_xinfo({table})")
+    ]
+
+
+def ensure_archive_tables(conn):
+    """
+    アーカイブ側の表を運用中の表に合わせて作る (足りない列は足す)
+    生成列は計算済みの値を普通の列として持つ。archived_at は移した日時
+    """
+    for table, indexes in ARCHIVE_INDEXES.items():
+        conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS archive.{table} (
+                id INTEGER PRIMARY KEY,
+                archived_at TEXT
+            )
+        """
+        )
+        existing = {name for name, _ in _table_columns(conn, "archive", table)}
+        for name, decl in _table_columns(conn, "main", table):
+            if name not in existing:
+                conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {name} {decl}")
+        for columns in indexes:
+            conn.execute(
+                f"""
+                CREATE INDEX IF NOT EXISTS archive.idx_{table}_{'_'.join(columns)}
+                ON {table} ({', '.join(columns)})
+            """
+            )
+
+
+def upgrade_archive(conn, path=None):
+    """
+    アーカイブ DB があれば、その表を運用中の表に合わせる (migrations.migrate から呼ぶ)
+    読み込み側は表を作らないので、運用中の表に列を足したらここで足しておく
+    path を省略すると ARCHIVE_DB_PATH の指定が無ければ conn の DB の隣のファイル
+    (ベンチマークなど別の DB を移行した時に、運用中のアーカイブに触らない)
+    """
+    if path is None:
+        main = conn.execute("PRAGMA main.database_list").fetchone()[2]
+        if os.getenv("ARCHIVE_DB_PATH"):
+            path = ARCHIVE_DB_PATH
+        elif main:
+            path = os.path.splitext(main)[0] + "-archive.db"
+    if not path or not os.path.exists(path):
+        return False
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ensure_archive_tables(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.execute("DETACH DATABASE archive")
+    return True
+
+
+def attach_archive(conn, path=None, create=False):
+    """
+    アーカイブ DB を archive として ATTACH する (接続ごとに 1 回だけ)。ATTACH できたか返す
+    conn は db.connect で開いたもの (ATTACH 済みかを conn.attached で覚える)
+
+    create=False (読み込み側) は読み取り専用で ATTACH し、表は作らない。
+    ファイルが無ければ作らずに False (アーカイブが無くても動く)
+    create=True (アーカイブへ移す側) は書き込みできる形で開き、表を作る
+    トランザクションの外で呼ぶこと
+    """
+    if "archive" in conn.attached:
+        return True
+    path = path or ARCHIVE_DB_PATH
+    if create:
+        conn.execute("ATTACH DATABASE ? AS archive", (path,))
+        conn.execute("PRAGMA archive.journal_mode = WAL")
+        ensure_archive_tables(conn)
+        conn.attached["archive"] = "rw"
+        return True
+    if not os.path.exists(path):
+        return False
+    conn.execute(
+        "ATTACH DATABASE ? AS archive",
+        (f"file:{quote(os.path.abspath(path))}?mode=ro",),
+    )
+    conn.attached["archive"] = "ro"
+    return True
+
+
+def archive_completed(conn, cutoff, batch_size=None):
+    """
+    completed が cutoff ("YYYY-MM-DD HH:MM:SS") より前の案件と、その写真をアーカイブに移す
+    conn は attach_archive 済みのもの。{"orders", "spots", "batches"} を返す
+    """
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    # 移す案件の一覧 (一時 DB なので運用中の DB はロックしない)
+    conn.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS archive_batch (
+            id INTEGER PRIMARY KEY,
+            msg_id TEXT,
+            row_seq INTEGER
+        )
+    """
+    )
+    order_columns, spot_columns = (
+        ", ".join(name for name, _ in _table_columns(conn, "main", table))
+        for table in ("operation_orders", "spot_info")
+    )
+    counts = {"orders": 0, "spots": 0, "batches": 0}
+    last_id = 0
+    while True:
+        # id 順に前回の続きから探すので、インデックスが無くても全体で 1 回走査するだけで済む
+        batch = conn.execute(
+            """
+            SELECT id, msg_id, row_seq FROM operation_orders
+            WHERE id > ? AND completed IS NOT NULL AND completed != '' AND completed < ?
+            ORDER BY id
+            LIMIT ?
+        """,
+            (last_id, cutoff, batch_size),
+        ).fetchall()
+        if not batch:
+            return counts
+        last_id = batch[-1]["id"]
+        archived_at = datetime.now(ZoneInfo("Asia/Tokyo")).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+
+        conn.execute("BEGIN")
+        try:
+            conn.execute("DELETE FROM temp.archive_batch")
+            conn.executemany(
+                "INSERT INTO temp.archive_batch (id, msg_id, row_seq) VALUES (?, ?, ?)",
+                [tuple(row) for row in batch],
+            )
+            conn.execute(
+                f"""
+                INSERT OR REPLACE INTO archive.operation_orders (archived_at, {order_columns})
+                SELECT ?, {order_columns} FROM main.operation_orders
+                WHERE id IN (SELECT id FROM temp.archive_batch)
+            """,
+                (archived_at,),
+            )
+            conn.execute(
+                f"""
+                INSERT OR REPLACE INTO archive.spot_info (archived_at, {spot_columns})
+                SELECT ?, {spot_columns} FROM main.spot_info
+                WHERE msg_id IN (SELECT msg_id FROM temp.archive_batch)
+            """,
+                (archived_at,),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 写した後に更新された案件 (row_seq が進んだもの) は運用中のまま残す
+            orders = conn.execute(
+                """
+                DELETE FROM main.operation_orders
+                WHERE id IN (SELECT id FROM temp.archive_batch)
+                    AND row_seq = (
+                        SELECT row_seq FROM temp.archive_batch AS b
+                        WHERE b.id = operation_orders.id
+                    )
+            """
+            ).rowcount
+            # 案件を先に消しておくと、写真の削除のトリガーが案件の row_seq を進めずに済む
+            spots = conn.execute(
+                """
+                DELETE FROM main.spot_info
+                WHERE msg_id IN (SELECT msg_id FROM temp.archive_batch)
+                    AND NOT EXISTS (
+                        SELECT 1 FROM main.operation_orders AS o
+                        WHERE o.msg_id = spot_info.msg_id
+                    )
+            """
+            ).rowcount
+            # 残した案件の写しはアーカイブから消す (両方に出てこないように)
+            conn.execute(
+                """
+                DELETE FROM archive.spot_info
+                WHERE msg_id IN (
+                    SELECT msg_id FROM temp.archive_batch
+                    WHERE id IN (SELECT id FROM main.operation_orders)
+                )
+            """
+            )
+            conn.execute(
+                """
+                DELETE FROM archive.operation_orders
+                WHERE id IN (SELECT id FROM temp.archive_batch)
+                    AND id IN (SELECT id FROM main.operation_orders)
+            """
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        counts["orders"] += orders
+        counts["spots"] += spots
+        counts["batches"] += 1
+        logger.info("archive 成功！！ 案件 %s 件・写真 %s 件", orders, spots)
+
+
+def incremental_vacuum(conn, pages=None):
+    """
+    運用中の DB の空きページを少しずつファイルから返し、返したページ数を返す
+    auto_vacuum が INCREMENTAL でなければ何もしない (空きページは以降の書き込みで使い回される)
+    """
+    pages = pages or ARCHIVE_VACUUM_PAGES
+    if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+        logger.warning(
+            "auto_vacuum が INCREMENTAL でないので空きページを返しません "
+            "(python archive.py --enable-incremental-vacuum)"
+        )
+        return 0
+    freed = 0
+    while True:
+        free = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+        if free == 0:
+            break
+        conn.execute(f"PRAGMA main.incremental_vacuum({pages})").fetchall()
+        freed += free - conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+    # WAL に書かれたページを戻して、ファイルを実際に縮める (読み込み中なら次の機会に)
+    conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)").fetchall()
+    return freed
+
+
+def enable_incremental_vacuum(conn):
+    """
+    既存の DB の auto_vacuum を INCREMENTAL にする (VACUUM で DB 全体を書き直す)
+    """
+    conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM main")
+    conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)").fetchall()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python archive.py")
+    parser.add_argument(
+        "--days", type=int, default=ARCHIVE_AFTER_DAYS, help="完了からこの日数を過ぎた案件を移す"
+    )
+    parser.add_argument(
+        "--before", help="この日 (YYYY-MM-DD) より前に完了した案件を移す (--days より優先)"
+    )
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="移した後に VACUUM して auto_vacuum を INCREMENTAL にする (初回だけ)",
+    )
+    args = parser.parse_args(argv)
+    if args.before:
+        try:
+            cutoff = datetime.fromisoformat(args.before).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            parser.error("--before は YYYY-MM-DD")
+    else:
+        cutoff = datetime.now(ZoneInfo("Asia/Tokyo")) - timedelta(days=args.days)
+        cutoff = cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+    conn = connect()
+    try:
+        attach_archive(conn, create=True)
+        started = time.perf_counter()
+        counts = archive_completed(conn, cutoff, args.batch_size)
+        print(
+            f"{cutoff} より前に完了した案件 {counts['orders']} 件・写真 {counts['spots']} 件を"
+            f"アーカイブに移しました ({counts['batches']} 回、"
+            f"{time.perf_counter() - started:.1f} 秒)"
+        )
+        started = time.perf_counter()
+        if args.enable_incremental_vacuum:
+            enable_incremental_vacuum(conn)
+            print(f"VACUUM しました ({time.perf_counter() - started:.1f} 秒)")
+        else:
+            freed = incremental_vacuum(conn)
+            print(
+                f"空きページ {freed} ページを返しました "
+                f"({time.perf_counter() - started:.1f} 秒)"
+            )
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""
+API のベンチマーク・負荷試験
+
+datagen.py：地図用の DB (案件・現場写真・作業者・ルーム) を生成する
+stub_elgana.py：Elgana のログイン・画像取得・投稿 API の代わりをするローカルサーバー
+loadgen.py：keep-alive の HTTP クライアント、一定レート/同時数での負荷、集計
+scenarios.py：地図の読み込み・webhook の集中・画像の取り込み・読み書きの混在・変更の配信
+run.py：上を組み合わせて gunicorn を起動し、結果を JSON に保存する
+compare.py：2 つの結果 JSON を並べて比べる
+micro.py：サーバーを起動せずに関数を直接測るマイクロベンチマーク (しきい値付き)
+
+python -m bench.run                       全シナリオ (結果は bench/results/)
+python -m bench.compare 前.json 後.json
+python -m bench.micro                     マイクロベンチマーク
+"""
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+2 つのベンチマーク結果 (bench.run の JSON) を並べて比べる
+
+遅延 (p50 / p95 / p99)・スループットと、取り込みの速さなどの値を
+前・後・変化率 (%) で出す。遅延は減れば、スループットは増えれば改善
+
+python -m bench.compare 前.json 後.json
+"""
+import argparse
+import json
+import sys
+
+
+# 遅延以外で比べる値 (大きいほど良いものは True)
+SCALARS = {
+    "throughput_rps": True,
+    "mb_per_s": True,
+    "jobs_per_s": True,
+    "images_per_s": True,
+    "drain_s": False,
+    "derivatives_wait_s": False,
+    "errors": False,
+    "missed": False,
+}
+
+
+def _flatten(result, prefix=""):
+    """
+    結果の dict を {"シナリオ.段階.値の名前": 数値} に平らにする
+    """
+    values = {}
+    for key, value in result.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            if key.endswith("_ms") and "p50" in value:
+                for p in ("p50", "p95", "p99"):
+                    values[f"{name}.{p}"] = value[p]
+            elif key not in ("status", "replies", "jobs", "elgana"):
+                values.update(_flatten(value, name))
+        elif key in SCALARS and isinstance(value, (int, float)):
+            values[name] = value
+    return values
+
+
+def _better_when_higher(name):
+    key = name.rsplit(".", 1)[-1]
+    return SCALARS.get(key, False)
+
+
+def compare(before, after):
+    """
+    (名前, 前, 後, 変化率 %, 改善なら True) のリスト
+    """
+    old = _flatten(before["results"])
+    new = _flatten(after["results"])
+    rows = []
+    for name in list(old) + [name for name in new if name not in old]:
+        a, b = old.get(name), new.get(name)
+        change = None
+        if a and b is not None:
+            change = round((b - a) / a * 100, 1)
+        improved = None
+        if change:
+            improved = (change > 0) == _better_when_higher(name)
+        rows.append((name, a, b, change, improved))
+    return rows
+
+
+def _describe(report):
+    meta = report.get("meta", {})
+    commit = (meta.get("commit") or "?")[:7] + ("+" if meta.get("dirty") else "")
+    return f"{commit} {meta.get('timestamp', '')} {meta.get('label', '')}".strip()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m bench.compare")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args(argv)
+    with open(args.before, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.after, encoding="utf-8") as f:
+        after = json.load(f)
+
+    print(f"前: {_describe(before)}")
+    print(f"後: {_describe(after)}")
+    print(f"{'':48} {'前':>10} {'後':>10} {'変化':>9}")
+    for name, a, b, change, improved in compare(before, after):
+        mark = {True: " 改善", False: " 悪化", None: ""}[improved]
+        a = "-" if a is None else a
+        b = "-" if b is None else b
+        change = "-" if change is None else f"{change:+.1f}%"
+        print(f"{name:48} {a:>10} {b:>10} {change:>9}{mark}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
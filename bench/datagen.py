@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマーク用の DB を生成する
+
+migrations.py で作ったテーブルに、作業者 (user_info)・ルーム (rooms)・
+案件 (operation_orders)・現場写真 (spot_info) を乱数で入れる。
+種を固定しているので、同じ引数なら同じ内容になる。
+ルームの件数・地図の集計・R*Tree などはトリガーで本番と同じように作られる
+
+位置は半分を東京周辺、2 割を大阪周辺に集め、残りを日本全体に散らす。
+ルームの大きさは偏らせ (少数のルームに案件が集まる)、一部は完了済み・位置なしにする
+
+python -m bench.datagen 出力先.db [--orders 100000] [--rooms 200] [--users 500]
+    [--completed-ratio 0.9]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from db import connect
+from migrations import migrate
+
+
+# (中心の緯度, 経度, 標準偏差 (度), 割合)
+CLUSTERS = ((35.68, 139.76, 0.3, 0.5), (34.69, 135.50, 0.2, 0.2))
+# 日本全体 (南端, 西端, 北端, 東端)
+JAPAN = (31.0, 130.0, 43.0, 145.0)
+
+URGENCIES = ("高", "中", "低")
+# ②状況 (作業の内容)
+STATUSES = ("側溝の補修", "舗装の打ち換え", "街路灯の交換", "ガードレールの修理", "倒木の撤去")
+CUSTOMERS = ("要請あり", "連絡不要", "折り返し希望", "")
+REMARKS = (
+    "至急対応をお願いします。",
+    "7月初旬には住宅の工事が始まるので、それまでに対応をお願いしたいです。",
+    "通学路のため安全に配慮してください。",
+    "",
+)
+
+# 完了済みの案件・位置のない案件・写真の削除済みの割合
+COMPLETED_RATIO = 0.3
+NO_LOCATION_RATIO = 0.05
+DELETED_SPOT_RATIO = 0.02
+
+
+def _object_id(rng):
+    # Elgana の ID と同じ 24 桁の 16 進数
+    return "%024x" % rng.getrandbits(96)
+
+
+def _location(rng):
+    r = rng.random()
+    for lat, lon, sigma, ratio in CLUSTERS:
+        if r < ratio:
+            return lat + rng.gauss(0, sigma), lon + rng.gauss(0, sigma)
+        r -= ratio
+    south, west, north, east = JAPAN
+    return rng.uniform(south, north), rng.uniform(west, east)
+
+
+def generate(
+    path,
+    orders=10000,
+    rooms=50,
+    users=200,
+    spots_per_order=1.5,
+    max_spots=3,
+    seed=1,
+    completed_ratio=COMPLETED_RATIO,
+):
+    """
+    path に DB を作る (既にあれば消して作り直す)。入れた件数の dict を返す
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rng = random.Random(seed)
+    now = datetime(2025, 8, 1)
+
+    conn = connect(path)
+    try:
+        migrate(conn)
+
+        user_ids = [_object_id(rng) for _ in range(users)]
+        conn.executemany(
+            """
+            INSERT INTO user_info (user_id, user_name, org, email_address)
+            VALUES (?, ?, ?, ?)
+        """,
+            [
+                (user_id, f"作業者{i:04d}", f"第{i % 8 + 1}工区", f"worker{i}@example.com")
+                for i, user_id in enumerate(user_ids)
+            ],
+        )
+
+        room_ids = [_object_id(rng) for _ in range(rooms)]
+        conn.executemany(
+            """
+            INSERT INTO rooms (room_id, room_name, creator, create_at)
+            VALUES (?, ?, ?, ?)
+        """,
+            [
+                (room_id, f"案件ルーム{i:03d}", rng.choice(user_ids), now.strftime("%Y-%m-%d %H:%M:%S"))
+                for i, room_id in enumerate(room_ids)
+            ],
+        )
+        # 少数のルームに案件が集まるよう、ルームの重みを 1/(順位) にする
+        room_weights = [1 / (i + 1) for i in range(rooms)]
+
+        order_rows = []
+        spot_rows = []
+        for i in range(orders):
+            msg_id = _object_id(rng)
+            received = now - timedelta(seconds=rng.randrange(180 * 24 * 3600))
+            latitude = longitude = None
+            if rng.random() >= NO_LOCATION_RATIO:
+                latitude, longitude = _location(rng)
+            completed = None
+            if rng.random() < completed_ratio:
+                completed = (received + timedelta(days=rng.randrange(1, 30))).strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                )
+            order_rows.append(
+                (
+                    msg_id,
+                    rng.choices(room_ids, room_weights)[0],
+                    rng.choice(user_ids),
+                    _object_id(rng) if latitude is not None else None,
+                    latitude,
+                    longitude,
+                    msg_id,
+                    f"{received:%y-%m-%d}-{i % 1000:03d}",
+                    rng.choice(STATUSES),
+                    rng.choice(URGENCIES),
+                    rng.choice(CUSTOMERS),
+                    rng.choice(REMARKS),
+                    received.strftime("%Y-%m-%d %H:%M:%S"),
+                    completed,
+                    received.strftime("%Y-%m-%d %H:%M:%S"),
+                )
+            )
+            # 写真の枚数は 0〜max_spots 枚 (平均がおおよそ spots_per_order 枚)
+            for _ in range(min(max_spots, int(rng.expovariate(1 / spots_per_order) + 0.5))):
+                filename = f"{received:%Y%m%d}_{_object_id(rng)}_{rng.getrandbits(32):08x}.jpg"
+                status_flag = rng.choice(("0", "1"))
+                spot_rows.append(
+                    (
+                        msg_id,
+                        rng.choice(user_ids),
+                        _object_id(rng),
+                        rng.choice(("true", "false")) if status_flag == "1" else "",
+                        f"/images/{filename}",
+                        filename,
+                        status_flag,
+                        "1" if rng.random() < DELETED_SPOT_RATIO else "0",
+                        received.strftime("%Y-%m-%d %H:%M:%S"),
+                    )
+                )
+
+        conn.executemany(
+            """
+            INSERT INTO operation_orders
+                (msg_id, room_id, user_id, location_id, latitude, longitude,
+                 instruction_id, instruction, status, urgency, customer_info, remarks,
+                 received_at, completed, update_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            order_rows,
+        )
+        conn.executemany(
+            """
+            INSERT INTO spot_info
+                (msg_id, user_id, image_id, repair_required, image_url, image_filename,
+                 status_flag, deleted, create_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            spot_rows,
+        )
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return {"orders": orders, "spots": len(spot_rows), "users": users, "rooms": rooms}
+
+
+# 報告テンプレートの見出しの書き方の揺れ (括弧・番号・前後の空白・言い換え・打ち間違い)
+HEADING_BRACKETS = (("【", "】"), ("[", "]"), ("［", "］"), ("(", ")"), ("（", "）"), ("〔", "〕"))
+HEADING_NUMBERS = {
+    "①指示": ("①", "1", "１", "1.", "１．", ""),
+    "②状況": ("②", "2", "２", "2、", ""),
+    "③緊急度": ("③", "3", "３", ""),
+    "④お客様情報": ("④", "4", "４", ""),
+    "⑤備考": ("⑤", "5", "５", ""),
+}
+HEADING_LABELS = {
+    "①指示": ("指示",),
+    "②状況": ("状況",),
+    "③緊急度": ("緊急度",),
+    "④お客様情報": ("お客様情報", "お客さま情報"),
+    "⑤備考": ("備考", "浦考"),
+}
+HEADING_SPACES = ("", " ", "　", "\t")
+
+
+def report_bodies(count, seed=1, variants=False):
+    """
+    報告メッセージの本文を count 件作り、(本文, 期待する項目の dict) の list を返す
+
+    variants=False：【①指示】 の形の見出し (旧 parse_body_text が読める形)。
+    前置き・空行・値の前後の空白・CRLF・項目の順番の入れ替え・欠けた項目・打ち間違い (⑤浦考) を混ぜる
+    variants=True：上に加えて、見出しの括弧・番号・空白・言い換えを揺らす
+    """
+    rng = random.Random(seed)
+    bodies = []
+    for i in range(count):
+        values = {
+            "①指示": f"{i % 100:02d}-{rng.randrange(1000):03d}",
+            "②状況": rng.choice(STATUSES),
+            "③緊急度": rng.choice(URGENCIES),
+            "④お客様情報": rng.choice(CUSTOMERS),
+            "⑤備考": rng.choice(REMARKS),
+        }
+        keys = list(values)
+        if rng.random() < 0.2:
+            rng.shuffle(keys)
+        # 指示・状況・緊急度は種類の判定に使うので残し、他は欠けることがある
+        keys = [k for k in keys if k in ("①指示", "②状況", "③緊急度") or rng.random() > 0.1]
+        lines = []
+        if rng.random() < 0.3:
+            lines += ["お疲れ様です。", "報告します。", ""]
+        for key in keys:
+            number, label = key[0], key[1:]
+            if key == "⑤備考" and rng.random() < 0.2:
+                label = "浦考"
+            if variants:
+                opening, closing = rng.choice(HEADING_BRACKETS)
+                number = rng.choice(HEADING_NUMBERS[key])
+                label = rng.choice(HEADING_LABELS[key])
+                s1, s2, s3, s4 = (rng.choice(HEADING_SPACES) for _ in range(4))
+                heading = f"{s1}{opening}{s2}{number}{s3}{label}{s4}{closing}"
+            else:
+                heading = f"【{number}{label}】"
+            padding = rng.choice(("", " ", "　", "  "))
+            lines.append(f"{heading}{padding}{values[key]}{rng.choice(('', ' ', '　'))}")
+            if rng.random() < 0.1:
+                lines.append("")
+        newline = "\r\n" if rng.random() < 0.2 else "\n"
+        expected = {key: (values[key] if key in keys else "") for key in values}
+        bodies.append((newline.join(lines), expected))
+    return bodies
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m bench.datagen")
+    parser.add_argument("path")
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--spots-per-order", type=float, default=1.5)
+    parser.add_argument("--max-spots", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--completed-ratio", type=float, default=COMPLETED_RATIO)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    counts = generate(
+        args.path,
+        orders=args.orders,
+        rooms=args.rooms,
+        users=args.users,
+        spots_per_order=args.spots_per_order,
+        max_spots=args.max_spots,
+        seed=args.seed,
+        completed_ratio=args.completed_ratio,
+    )
+    print(f"{args.path}: {counts} ({time.perf_counter() - started:.1f} 秒)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
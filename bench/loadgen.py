@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+負荷をかける側
+
+asyncio の上に最小限の HTTP/1.1 クライアントを置き、1 本の接続を使い回して送る。
+(requests などはスレッドを食い、クライアント側が先に詰まって遅延を測り損ねるため)
+
+closed_loop：同時数を決めて、応答が返ったら次を送る (読み込みの上限を見る)
+open_loop：毎秒何件と決めた時刻に送る。遅延は「送るはずだった時刻」から測るので、
+           サーバーが詰まって送信が遅れた分も遅延に含まれる (coordinated omission を避ける)
+"""
+import asyncio
+import json
+import time
+from collections import namedtuple
+
+
+# kind：集計の単位 (エンドポイント名など)、latency：秒、status：HTTP ステータス (接続エラーは 0)
+Sample = namedtuple("Sample", ["kind", "latency", "status"])
+
+# method, path, body (bytes / dict / None), headers (dict / None)
+Request = namedtuple("Request", ["method", "path", "body", "headers"], defaults=(None, None))
+
+Response = namedtuple("Response", ["status", "headers", "body"])
+
+
+class HttpConnection:
+    """
+    keep-alive で使い回す 1 本の接続
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, body=None, headers=None):
+        if self._writer is None:
+            await self._connect()
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode()
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b"")
+        try:
+            self._writer.write(data)
+            await self._writer.drain()
+            return await self._read_response(method)
+        except BaseException:
+            self.close()
+            raise
+
+    async def _read_response(self, method):
+        head = await self._reader.readuntil(b"\r\n\r\n")
+        status_line, *header_lines = head.decode("latin-1").split("\r\n")
+        status = int(status_line.split(" ", 2)[1])
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            body = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    await self._reader.readuntil(b"\r\n")
+                    break
+                chunks.append(await self._reader.readexactly(size))
+                await self._reader.readexactly(2)
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await self._reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await self._reader.read()
+            self.close()
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return Response(status, headers, body)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+async def _send(conn, kind, request, samples, started):
+    try:
+        response = await conn.request(*request)
+        status = response.status
+    except (OSError, asyncio.IncompleteReadError, ValueError):
+        response, status = None, 0
+    samples.append(Sample(kind, time.perf_counter() - started, status))
+    return response
+
+
+async def closed_loop(host, port, make_request, concurrency, duration, on_response=None):
+    """
+    concurrency 本の接続で duration 秒間、応答が返り次第次を送る
+    make_request(i) は (kind, Request) を返す。on_response(kind, Response) があれば呼ぶ
+    (Sample のリスト, 実際にかかった秒数) を返す
+    """
+    samples = []
+    counter = iter(range(1 << 62))
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        conn = HttpConnection(host, port)
+        try:
+            while time.perf_counter() < deadline:
+                kind, request = make_request(next(counter))
+                response = await _send(conn, kind, request, samples, time.perf_counter())
+                if on_response is not None and response is not None:
+                    on_response(kind, response)
+        finally:
+            conn.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+
+async def open_loop(host, port, make_request, rate, duration, connections=200,
+                    on_response=None):
+    """
+    毎秒 rate 件の一定間隔で duration 秒間送る (空いている接続から送る)
+    make_request(i) は (kind, Request) を返す。on_response(i, kind, Response) があれば呼ぶ
+    (Sample のリスト, 最後の応答までの秒数) を返す
+    """
+    samples = []
+    pending = asyncio.Queue()
+    total = int(rate * duration)
+
+    async def client():
+        conn = HttpConnection(host, port)
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                i, scheduled = item
+                kind, request = make_request(i)
+                response = await _send(conn, kind, request, samples, scheduled)
+                if on_response is not None and response is not None:
+                    on_response(i, kind, response)
+        finally:
+            conn.close()
+
+    clients = [asyncio.create_task(client()) for _ in range(connections)]
+    started = time.perf_counter()
+    for i in range(total):
+        scheduled = started + i / rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        pending.put_nowait((i, scheduled))
+    for _ in clients:
+        pending.put_nowait(None)
+    await asyncio.gather(*clients)
+    return samples, time.perf_counter() - started
+
+
+def percentile(sorted_values, p):
+    """
+    昇順に並んだ値の p パーセンタイル (nearest-rank)
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def latency_stats(latencies):
+    """
+    秒のリストからミリ秒の p50 / p95 / p99 / 最大 / 平均
+    """
+    values = sorted(latencies)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None, "mean": None}
+    return {
+        "p50": round(percentile(values, 50) * 1000, 3),
+        "p95": round(percentile(values, 95) * 1000, 3),
+        "p99": round(percentile(values, 99) * 1000, 3),
+        "max": round(values[-1] * 1000, 3),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+    }
+
+
+def summarize(samples, elapsed):
+    """
+    Sample のリストを {"requests", "errors", "throughput_rps", "latency_ms", "status"} にまとめる
+    errors は接続エラーと 5xx の数
+    """
+    status = {}
+    for sample in samples:
+        status[str(sample.status)] = status.get(str(sample.status), 0) + 1
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for s in samples if s.status == 0 or s.status >= 500),
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed > 0 else None,
+        "latency_ms": latency_stats([s.latency for s in samples]),
+        "status": status,
+    }
+
+
+def summarize_by_kind(samples, elapsed):
+    """
+    kind ごとに summarize した dict
+    """
+    kinds = {}
+    for sample in samples:
+        kinds.setdefault(sample.kind, []).append(sample)
+    return {kind: summarize(group, elapsed) for kind, group in kinds.items()}
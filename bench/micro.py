@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+"""
+プロセス内のマイクロベンチマーク (サーバーを起動せずに関数を直接呼ぶ)
+
+python -m bench.micro [ベンチマーク ...] [--out 結果.json]
+
+parser：報告メッセージ 1 件の解析時間 (message_parser と旧 parse_body_text)
+spots：案件 1 万件 × 写真 5 枚の DB での /get_locations の全件の組み立て時間
+       (案件ごとに写真を引く旧実装と。旧実装はインデックスを足す前のスキーマでも)
+bbox：10 万件の DB での /get_locations の組み立て時間と本文の大きさ (全件・表示範囲・差分)
+connections：Elgana の代わりへの取得 1 回の時間と張った接続の数 (共有の Session と、毎回 requests.get)
+nearby：10 万件の DB での近傍検索 (spatial.find_nearby) 1 回の時間 (R*Tree と全件を調べる場合)
+archive：10 万件の DB で 9 割 (完了済み) をアーカイブに移す前と後の /get_locations の組み立て時間
+
+各ベンチマークは計測値と確認 (checks) を返す。確認には速さのしきい値も含み、
+1 つでも通らなければ終了コード 1
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from bench import datagen
+from bench.run import RESULTS_DIR, _git
+
+
+def parse_body_text(body_text):
+    """
+    message_parser.py に置き換える前の項目の取り出し (比較用にそのまま残す)
+    """
+    fields = {
+        "①指示": "",
+        "②状況": "",
+        "③緊急度": "",
+        "④お客様情報": "",
+        "⑤備考": "",
+    }
+    for line in body_text.splitlines():
+        for key in fields.keys():
+            if line.startswith(f"【{key}】"):
+                fields[key] = line.replace(f"【{key}】", "").strip()
+            elif key == "⑤備考" and line.startswith("【⑤浦考】"):
+                fields["⑤備考"] = line.replace("【⑤浦考】", "").strip()
+    return fields
+
+
+def _per_call_us(fn, items, repeat):
+    """
+    items を repeat 回通して fn に渡し、1 件あたりのマイクロ秒 (最も速かった回) を返す
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            fn(item)
+        best = min(best, time.perf_counter() - started)
+    return round(best / len(items) * 1e6, 2)
+
+
+def parse_messages(messages=2000, repeat=5, max_us=50):
+    """
+    報告メッセージ messages 件を解析する時間 (1 件あたり) を、旧 parse_body_text と比べる
+    新しい解析は種類の判定 (parse) も含めて max_us マイクロ秒以内、旧実装より遅くないこと
+    """
+    from message_parser import parse_message
+
+    bodies = [body for body, _ in datagen.report_bodies(messages)]
+    msgs = [{"body": body, "type": "text", "extra": ""} for body in bodies]
+    legacy_us = _per_call_us(parse_body_text, bodies, repeat)
+    parse_us = _per_call_us(parse_message, msgs, repeat)
+    return {
+        "messages": messages,
+        "legacy_us": legacy_us,
+        "parse_us": parse_us,
+        "speedup": round(legacy_us / parse_us, 2),
+        "checks": {
+            f"parse_under_{max_us}us": parse_us <= max_us,
+            "not_slower_than_legacy": parse_us <= legacy_us,
+        },
+    }
+
+
+def get_locations_per_order(conn):
+    """
+    一括取得に置き換える前の /get_locations (案件ごとに spot_info を引く。比較用にそのまま残す)
+    """
+
+    class DictCursor(sqlite3.Cursor):
+        def fetchall_dict(self):
+            return list(map(dict, self.fetchall()))
+
+    locations = []
+    cursor = conn.cursor(factory=DictCursor)
+    cursor.execute(
+        """
+        SELECT
+            msg_id,
+            latitude,
+            longitude,
+            instruction,
+            status,
+            urgency,
+            customer_info,
+            remarks,
+            completed,
+            signal,
+            received_at,
+            update_at
+        FROM operation_orders
+    """
+    )
+    operations = cursor.fetchall_dict()
+    for operation in operations:
+        signal = operation.get("signal")
+        msg_id = operation.get("msg_id")
+        if signal == "0":
+            continue
+        discovery_image_dict_list = []
+        before_image_dict_list = []
+        after_image_dict_list = []
+        cursor.execute(
+            """
+        SELECT
+            s.repair_required,
+            s.height,
+            s.width,
+            s.depth,
+            s.image_url,
+            s.status_flag,
+            s.deleted,
+            s.cost,
+            s.term,
+            u.user_name,
+            u.org,
+            u.email_address,
+            s.create_at
+        FROM spot_info AS s
+        INNER JOIN user_info AS u ON s.user_id = u.user_id
+        WHERE s.msg_id = ?
+        """,
+            (msg_id,),
+        )
+        spots = cursor.fetchall_dict()
+        if spots:
+            for spot in spots:
+                repair_required = spot.get("repair_required")
+                status_flag = spot.get("status_flag")
+                if status_flag == "0":
+                    discovery_image_dict_list.append(spot)
+                elif status_flag == "1":
+                    if repair_required == "true":
+                        before_image_dict_list.append(spot)
+                    elif repair_required == "false":
+                        after_image_dict_list.append(spot)
+
+        if operation["completed"]:
+            operation_status = "3"
+        elif after_image_dict_list:
+            operation_status = "2"
+        elif before_image_dict_list:
+            operation_status = "1"
+        else:
+            operation_status = "0"
+        operation["operation_status"] = operation_status
+        operation["discovery_images"] = discovery_image_dict_list
+        operation["before_images"] = before_image_dict_list
+        operation["after_images"] = after_image_dict_list
+        locations.append(operation)
+    return locations
+
+
+IMAGE_LISTS = ("discovery_images", "before_images", "after_images")
+
+
+def _comparable(locations, order_keys, spot_keys):
+    """
+    order_keys・spot_keys の項目だけにして msg_id で引ける dict にする
+    (写真の並びは旧実装と違うので、並びを問わずに比べられるよう並べ直す)
+    """
+    projected = {}
+    for location in locations:
+        row = {key: location[key] for key in order_keys}
+        for key in IMAGE_LISTS:
+            row[key] = sorted(
+                [tuple(spot[k] for k in spot_keys) for spot in location[key]], key=repr
+            )
+        projected[location["msg_id"]] = row
+    return projected
+
+
+def _best_ms(fn, repeat):
+    """
+    fn() を repeat 回呼び、(最も速かった回のミリ秒, 最後の戻り値) を返す
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return round(best * 1000, 2), result
+
+
+def _statements(conn, fn):
+    """
+    fn() の間に conn が実行した SQL 文の数
+    """
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        fn()
+    finally:
+        conn.set_trace_callback(None)
+    return len(statements)
+
+
+def _drop_secondary_indexes(conn, tables):
+    """
+    tables の移行 (migrations.py) で足したインデックスを全て消し、移行前のスキーマにする
+    """
+    names = [
+        row[0]
+        for row in conn.execute(
+            f"""
+            SELECT name FROM sqlite_master
+            WHERE type = 'index' AND sql IS NOT NULL
+                AND tbl_name IN ({', '.join('?' * len(tables))})
+        """,
+            tables,
+        )
+    ]
+    for name in names:
+        conn.execute(f"DROP INDEX {name}")
+    conn.commit()
+    return names
+
+
+def spots_locations(
+    orders=10000, spots_per_order=5, repeat=5, max_ms=1000, max_statements=4, tolerance=1.0
+):
+    """
+    案件 orders 件 × 写真 spots_per_order 枚 (平均) の DB で、/get_locations の全件の中身を
+    案件ごとに写真を引く旧実装と一括取得 (query_locations) で組み立てる時間を比べる
+    旧実装と同じ項目が同じ値になり、SQL は件数によらず max_statements 文以内、
+    max_ms ミリ秒以内で、旧実装 (返す項目が少ない) の tolerance 倍より遅くないこと
+    旧実装はインデックスを足す前のスキーマ (移行前の本番と同じ。写真を引くたびに全件を走査する)
+    でも 1 回測り、一括取得がそれより速いこと
+    """
+    from db import connect
+    from elgana_api import query_locations
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "locations.db")
+        counts = datagen.generate(
+            path,
+            orders=orders,
+            spots_per_order=spots_per_order,
+            max_spots=spots_per_order * 3,
+        )
+        conn = connect(path)
+        try:
+            legacy_ms, legacy = _best_ms(lambda: get_locations_per_order(conn), repeat)
+            query_ms, current = _best_ms(
+                lambda: query_locations(conn, [], [], None), repeat
+            )
+            legacy_statements = _statements(conn, lambda: get_locations_per_order(conn))
+            query_statements = _statements(
+                conn, lambda: query_locations(conn, [], [], None)
+            )
+            baseline = connect(os.path.join(tmp, "baseline.db"))
+            try:
+                conn.backup(baseline)
+                dropped = _drop_secondary_indexes(
+                    baseline, ("operation_orders", "spot_info", "user_info")
+                )
+                baseline_ms, _ = _best_ms(lambda: get_locations_per_order(baseline), 1)
+            finally:
+                baseline.close()
+        finally:
+            conn.close()
+
+    order_keys = [key for key in legacy[0] if key not in IMAGE_LISTS]
+    spot_keys = list(
+        next(spot for location in legacy for key in IMAGE_LISTS for spot in location[key])
+    )
+    same = _comparable(legacy, order_keys, spot_keys) == _comparable(
+        current, order_keys, spot_keys
+    )
+    return {
+        "orders": orders,
+        "spots": counts["spots"],
+        "baseline_ms": baseline_ms,
+        "baseline_dropped_indexes": len(dropped),
+        "legacy_ms": legacy_ms,
+        "query_ms": query_ms,
+        "speedup": round(legacy_ms / query_ms, 2),
+        "speedup_vs_baseline": round(baseline_ms / query_ms, 1),
+        "legacy_statements": legacy_statements,
+        "query_statements": query_statements,
+        "checks": {
+            "same_as_legacy": same,
+            f"statements_at_most_{max_statements}": query_statements <= max_statements,
+            f"query_under_{max_ms}ms": query_ms <= max_ms,
+            "not_slower_than_legacy": query_ms <= legacy_ms * tolerance,
+            "faster_than_baseline_schema": query_ms < baseline_ms,
+        },
+    }
+
+
+def bbox_locations(
+    orders=100000, repeat=3, bbox="35.6,139.6,35.8,139.9", max_ms=250, max_delta_ms=5
+):
+    """
+    orders 件の DB で /get_locations の本文を組み立てる時間と大きさを、
+    全件・表示範囲 (bbox、未完了のみ)・変更なしの差分で比べる
+    表示範囲は max_ms ミリ秒以内で全件の 1/10 以下の大きさ、変更なしの差分は max_delta_ms 以内
+    """
+    from flask import Flask
+
+    from db import connect
+    from elgana_api import parse_locations_filters, query_locations
+
+    app = Flask(__name__)
+
+    def build(conn, args):
+        where, params, since = parse_locations_filters(args)
+        payload = query_locations(conn, where, params, since)
+        return app.json.response(payload).get_data()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "locations.db")
+        datagen.generate(path, orders=orders)
+        conn = connect(path)
+        try:
+            seq = conn.execute(
+                "SELECT seq FROM sync_state WHERE name = 'locations'"
+            ).fetchone()[0]
+            with app.app_context():
+                full_ms, full = _best_ms(lambda: build(conn, {}), repeat)
+                view = {"bbox": bbox, "status": "0,1,2"}
+                bbox_ms, body = _best_ms(lambda: build(conn, view), repeat)
+                delta = {**view, "updated_since": seq}
+                delta_ms, _ = _best_ms(lambda: build(conn, delta), repeat)
+        finally:
+            conn.close()
+    return {
+        "orders": orders,
+        "full_ms": full_ms,
+        "full_bytes": len(full),
+        "bbox_ms": bbox_ms,
+        "bbox_bytes": len(body),
+        "delta_ms": delta_ms,
+        "checks": {
+            f"bbox_under_{max_ms}ms": bbox_ms <= max_ms,
+            "bbox_body_under_tenth_of_full": len(body) * 10 <= len(full),
+            f"delta_under_{max_delta_ms}ms": delta_ms <= max_delta_ms,
+        },
+    }
+
+
+def archive_locations(orders=100000, completed_ratio=0.9, repeat=3, max_ratio=0.3):
+    """
+    orders 件のうち completed_ratio を完了済みにした DB で、完了済みを全てアーカイブ (archive.py) に
+    移す前と後の /get_locations の全件の組み立て時間 (本文まで) と query_locations の時間を比べる
+    移した後はどちらも移す前の max_ratio 倍以内、include_archived で全件が返ること
+    """
+    from flask import Flask
+
+    from archive import archive_completed, attach_archive, incremental_vacuum
+    from db import connect
+    from elgana_api import parse_locations_filters, query_locations
+
+    app = Flask(__name__)
+
+    def build(conn):
+        where, params, since = parse_locations_filters({})
+        payload = query_locations(conn, where, params, since)
+        return app.json.response(payload).get_data()
+
+    def measure(conn):
+        with app.app_context():
+            build_ms, body = _best_ms(lambda: build(conn), repeat)
+        query_ms, _ = _best_ms(lambda: query_locations(conn, [], [], None), repeat)
+        return build_ms, query_ms, len(body)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "locations.db")
+        datagen.generate(path, orders=orders, completed_ratio=completed_ratio)
+        conn = connect(path)
+        try:
+            before_ms, before_query_ms, before_bytes = measure(conn)
+            attach_archive(conn, os.path.join(tmp, "locations-archive.db"), create=True)
+            started = time.perf_counter()
+            counts = archive_completed(conn, "9999-12-31 23:59:59")
+            archive_s = round(time.perf_counter() - started, 2)
+            freed = incremental_vacuum(conn)
+            after_ms, after_query_ms, after_bytes = measure(conn)
+            live = conn.execute("SELECT COUNT(*) FROM operation_orders").fetchone()[0]
+            everything = len(query_locations(conn, [], [], None, include_archived=True))
+        finally:
+            conn.close()
+    return {
+        "orders": orders,
+        "archived": counts["orders"],
+        "archived_spots": counts["spots"],
+        "archive_s": archive_s,
+        "freed_pages": freed,
+        "before_ms": before_ms,
+        "after_ms": after_ms,
+        "before_query_ms": before_query_ms,
+        "after_query_ms": after_query_ms,
+        "before_bytes": before_bytes,
+        "after_bytes": after_bytes,
+        "checks": {
+            "archived_completed": live + counts["orders"] == orders
+            and live <= orders * (1 - completed_ratio) * 1.1,
+            "include_archived_returns_all": everything == orders,
+            f"get_locations_under_{max_ratio}x": after_ms <= before_ms * max_ratio,
+            f"query_under_{max_ratio}x": after_query_ms <= before_query_ms * max_ratio,
+        },
+    }
+
+
+def nearby_search(orders=100000, queries=500, radius_m=500, repeat=3, max_us=1000):
+    """
+    orders 件の DB で、案件のある場所の近く queries か所から半径 radius_m の近傍検索をする時間 (1 回あたり)
+    R*Tree は max_us マイクロ秒以内、全件を haversine で調べる場合と同じ結果になること
+    """
+    import random
+
+    from db import connect
+    from spatial import distance_m, find_nearby
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "locations.db")
+        datagen.generate(path, orders=orders)
+        conn = connect(path)
+        try:
+            rows = conn.execute(
+                """
+                SELECT msg_id, latitude, longitude FROM operation_orders
+                WHERE latitude IS NOT NULL AND signal IS NOT '0'
+            """
+            ).fetchall()
+            rng = random.Random(1)
+            # 案件のある場所から少しずらした点 (実際に近くに案件がある所を引く)
+            centers = []
+            for _ in range(queries):
+                _, latitude, longitude = rows[rng.randrange(len(rows))]
+                centers.append(
+                    (latitude + rng.gauss(0, 0.002), longitude + rng.gauss(0, 0.002))
+                )
+            search_us = _per_call_us(
+                lambda center: find_nearby(conn, *center, radius_m), centers, repeat
+            )
+            found = [
+                len(find_nearby(conn, *center, radius_m, limit=len(rows)))
+                for center in centers
+            ]
+
+            def brute_force(center):
+                return sum(
+                    1 for _, lat, lon in rows if distance_m(*center, lat, lon) <= radius_m
+                )
+
+            sample = centers[:20]
+            brute_force_us = _per_call_us(brute_force, sample, 1)
+            same = [brute_force(center) for center in sample] == found[: len(sample)]
+        finally:
+            conn.close()
+    return {
+        "orders": orders,
+        "radius_m": radius_m,
+        "mean_found": round(sum(found) / len(found), 1),
+        "search_us": search_us,
+        "brute_force_us": brute_force_us,
+        "checks": {
+            f"search_under_{max_us}us": search_us <= max_us,
+            "same_as_brute_force": same,
+        },
+    }
+
+
+def connection_reuse(calls=300, repeat=3, image_size=(64, 48), min_speedup=1.2):
+    """
+    Elgana の代わり (bench/stub_elgana.py) から calls 回写真を取る時間 (1 回あたり) を、
+    共有の Session (elgana_client) と毎回接続を張る requests.get で比べる
+    共有の Session は 1 本の接続で済み、min_speedup 倍以上速いこと
+    """
+    import requests
+
+    import elgana_client
+    from bench.stub_elgana import StubElgana
+
+    stub = StubElgana(latency_ms=0, image_size=image_size).start()
+    saved = elgana_client.LOGIN_API_URL, elgana_client.token_cache, elgana_client._session
+    try:
+        elgana_client.LOGIN_API_URL = stub.env()["LOGIN_API_URL"]
+        elgana_client.token_cache = elgana_client.TokenCache()
+        elgana_client._session = None
+        headers = elgana_client.elgana_headers(
+            elgana_client.get_access_token(), "application/octet-stream"
+        )
+        urls = [f"{stub.base_url}/file?roomId=r&fileId={i}" for i in range(calls)]
+
+        def fetch_pooled(url):
+            with elgana_client.get(url, headers=headers) as response:
+                response.raise_for_status()
+
+        def fetch_new(url):
+            with requests.get(url, headers=headers, timeout=10) as response:
+                response.raise_for_status()
+
+        before = stub.stats()["connections"]
+        pooled_us = _per_call_us(fetch_pooled, urls, repeat)
+        pooled_connections = stub.stats()["connections"] - before
+        before = stub.stats()["connections"]
+        new_us = _per_call_us(fetch_new, urls, repeat)
+        new_connections = stub.stats()["connections"] - before
+    finally:
+        elgana_client.get_session().close()
+        elgana_client.LOGIN_API_URL, elgana_client.token_cache, elgana_client._session = saved
+        stub.stop()
+    speedup = round(new_us / pooled_us, 2)
+    return {
+        "calls": calls * repeat,
+        "pooled_us": pooled_us,
+        "new_connection_us": new_us,
+        "speedup": speedup,
+        "pooled_connections": pooled_connections,
+        "new_connections": new_connections,
+        "checks": {
+            "pooled_uses_one_connection": pooled_connections <= 1,
+            f"speedup_at_least_{min_speedup}x": speedup >= min_speedup,
+        },
+    }
+
+
+# python -m bench.micro で選べるベンチマーク (この順に実行する)
+BENCHMARKS = {
+    "parser": parse_messages,
+    "spots": spots_locations,
+    "bbox": bbox_locations,
+    "nearby": nearby_search,
+    "connections": connection_reuse,
+    "archive": archive_locations,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m bench.micro")
+    parser.add_argument(
+        "benchmarks", nargs="*", help=f"既定は全て ({', '.join(BENCHMARKS)})"
+    )
+    parser.add_argument("--out", help="結果の JSON (既定は bench/results/micro-日時-コミット.json)")
+    args = parser.parse_args(argv)
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"不明なベンチマーク: {', '.join(unknown)}")
+
+    results = {}
+    for name in names:
+        print(f"{name} ...", flush=True)
+        results[name] = BENCHMARKS[name]()
+    for name, result in results.items():
+        values = {k: v for k, v in result.items() if k != "checks"}
+        print(f"{name:10} " + "  ".join(f"{k}={v}" for k, v in values.items()))
+        for check, ok in result["checks"].items():
+            print(f"  {'OK ' if ok else 'NG '} {check}")
+
+    commit = _git("rev-parse", "HEAD")
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"micro-{stamp}-{(commit or 'unknown')[:7]}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果: {out}")
+    return 0 if all(all(r["checks"].values()) for r in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
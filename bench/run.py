@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマークを通しで実行する
+
+1. 一時ディレクトリに DB を生成する (--db で既存の DB のコピーも使える)
+2. Elgana の代わり (stub_elgana) を起動する
+3. gunicorn.conf.py の設定で elgana_api を起動する (本番と同じく API は gthread ワーカー、
+   /events は GUNICORN_ROLE=events の gevent ワーカーの別サーバー)
+4. シナリオを順に実行し、結果を表で出して JSON に保存する
+   確認 (checks) を返すシナリオ (sse_fanout) は、1 つでも通らなければ終了コード 1
+
+python -m bench.run [シナリオ ...] [--orders 20000] [--workers 1] [--out 結果.json]
+結果の JSON には実行した条件 (コミット・引数・件数・SQLite の版など) も入る
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+from bench import datagen
+from bench.scenarios import SCENARIOS, Target
+from bench.stub_elgana import StubElgana
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+# サーバーの起動を待つ上限 (秒)
+STARTUP_TIMEOUT = 60
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _git(*args):
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _counts(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("operation_orders", "spot_info", "rooms", "user_info")
+        }
+    finally:
+        conn.close()
+
+
+def _wait_ready(port, process):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn が終了しました (終了コード {process.returncode})")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ingest_stats", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn の起動を待ちきれませんでした")
+
+
+def start_server(args, workdir, db_path, stub, role="api"):
+    """
+    gunicorn を起動し、応答するまで待って (プロセス, ポート) を返す
+    role="events" は /events 用のサーバー (gevent ワーカー 1 つ)
+    """
+    port = _free_port()
+    env = dict(os.environ)
+    env.update(
+        {
+            "DB_PATH": db_path,
+            "IMAGE_DIR": os.path.join(workdir, "images"),
+            "IMAGE_STORE": "local",
+            "GUNICORN_ROLE": role,
+            "LOG_LEVEL": "WARNING",
+        }
+    )
+    if stub is not None:
+        env.update(stub.env())
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    worker_class = "gevent" if role == "events" else args.worker_class
+    command = [
+        sys.executable, "-m", "gunicorn",
+        "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+        "-k", worker_class,
+        "-w", str(1 if role == "events" else args.workers),
+        "-b", f"127.0.0.1:{port}",
+        "--log-level", "warning",
+        "--error-logfile", os.path.join(workdir, f"gunicorn-{role}.log"),
+    ]
+    if worker_class == "gevent":
+        command += ["--worker-connections", str(args.worker_connections)]
+    elif args.threads:
+        command += ["--threads", str(args.threads)]
+    process = subprocess.Popen(
+        command,
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=open(os.path.join(workdir, f"server-{role}.log"), "wb"),
+    )
+    try:
+        _wait_ready(port, process)
+    except BaseException:
+        process.kill()
+        raise
+    return process, port
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def _scenario_kwargs(name, args):
+    if name == "map_load":
+        return {"concurrency": args.concurrency, "duration": args.duration}
+    if name == "webhook_burst":
+        return {"rate": args.webhook_rate, "duration": args.duration * 2}
+    if name == "image_ingest":
+        return {"rate": args.image_rate, "duration": args.duration * 2}
+    if name == "image_serve":
+        return {"concurrency": args.concurrency * 2, "duration": args.duration}
+    if name == "mixed":
+        return {"duration": args.duration * 2, "write_rate": args.webhook_rate / 5}
+    if name == "notify":
+        return {"duration": args.duration * 2, "failure_rate": args.upload_failure_rate}
+    if name == "sse_fanout":
+        return {"subscribers": args.subscribers}
+    return {}
+
+
+def _rows(result, prefix=""):
+    """
+    結果の dict から (名前, リクエスト数, rps, p50, p95, p99) の行を拾う
+    """
+    if "latency_ms" in result:
+        latency = result["latency_ms"]
+        yield (
+            prefix, result["requests"], result["throughput_rps"],
+            latency["p50"], latency["p95"], latency["p99"],
+        )
+        return
+    for key, value in result.items():
+        if isinstance(value, dict):
+            name = f"{prefix}.{key}" if prefix else key
+            if key.endswith("_ms") and "p50" in value:
+                yield name, None, None, value["p50"], value["p95"], value["p99"]
+            else:
+                yield from _rows(value, name)
+
+
+def print_table(results, file=sys.stdout):
+    print(f"{'':40} {'件数':>8} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=file)
+    for name, result in results.items():
+        for row in _rows(result, name):
+            label, count, rps, p50, p95, p99 = (
+                "-" if value is None else value for value in row
+            )
+            print(f"{label:40} {count:>8} {rps:>9} {p50:>9} {p95:>9} {p99:>9}", file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m bench.run")
+    parser.add_argument("scenarios", nargs="*", help=f"既定は全て ({', '.join(SCENARIOS)})")
+    parser.add_argument("--db", help="生成せずにこの DB のコピーを使う")
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--spots-per-order", type=float, default=1.5)
+    parser.add_argument("--max-spots", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--worker-class", default="gthread", help="API のワーカー")
+    parser.add_argument("--threads", type=int, default=0, help="既定は gunicorn.conf.py の値")
+    parser.add_argument("--worker-connections", type=int, default=1000)
+    parser.add_argument("--stub-latency-ms", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=5, help="1 段階あたりの秒数")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--webhook-rate", type=float, default=500)
+    parser.add_argument("--image-rate", type=float, default=5)
+    parser.add_argument("--subscribers", type=int, default=500)
+    parser.add_argument(
+        "--upload-failure-rate", type=float, default=0.3, help="notify で投稿を失敗させる割合"
+    )
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="サーバーに渡す環境変数 (繰り返し指定できる)")
+    parser.add_argument("--label", default="", help="結果に残す説明")
+    parser.add_argument("--out", help="結果の JSON (既定は bench/results/日時-コミット.json)")
+    parser.add_argument("--keep", action="store_true", help="作業ディレクトリを消さない")
+    args = parser.parse_args(argv)
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"不明なシナリオ: {', '.join(unknown)}")
+
+    workdir = tempfile.mkdtemp(prefix="elgana-bench-")
+    db_path = os.path.join(workdir, "locations.db")
+    stub = process = events_process = None
+    try:
+        started = time.perf_counter()
+        if args.db:
+            shutil.copyfile(args.db, db_path)
+        else:
+            datagen.generate(
+                db_path,
+                orders=args.orders,
+                rooms=args.rooms,
+                users=args.users,
+                spots_per_order=args.spots_per_order,
+                max_spots=args.max_spots,
+            )
+        data = _counts(db_path)
+        print(f"DB 準備 {time.perf_counter() - started:.1f} 秒: {data}", flush=True)
+
+        stub = StubElgana(latency_ms=args.stub_latency_ms).start()
+        process, port = start_server(args, workdir, db_path, stub)
+        events_port = None
+        if "sse_fanout" in names:
+            events_process, events_port = start_server(
+                args, workdir, db_path, stub, role="events"
+            )
+        target = Target("127.0.0.1", port, db_path, stub, events_port)
+
+        results = {}
+        for name in names:
+            print(f"{name} ...", flush=True)
+            results[name] = SCENARIOS[name](target, **_scenario_kwargs(name, args))
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/ingest_stats") as response:
+            ingest = json.load(response)
+    finally:
+        for server in (events_process, process):
+            if server is not None:
+                stop_server(server)
+        if stub is not None:
+            stub.stop()
+        if args.keep:
+            print(f"作業ディレクトリ: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+    for name, result in results.items():
+        for check, ok in result.get("checks", {}).items():
+            print(f"{name:10} {'OK ' if ok else 'NG '} {check}")
+    commit = _git("rev-parse", "HEAD")
+    report = {
+        "meta": {
+            "label": args.label,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+            "data": data,
+        },
+        "results": results,
+        "ingest_stats": ingest,
+    }
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"{stamp}-{(commit or 'unknown')[:7]}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果: {out}")
+    return 0 if all(all(r.get("checks", {}).values()) for r in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
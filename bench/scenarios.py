@@ -0,0 +1,733 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマークのシナリオ
+
+どれも Target (起動済みのサーバーと、その DB・Elgana の代わり) を受け取り、
+結果の dict を返す。遅延は loadgen.summarize の形 (p50 / p95 / p99 ミリ秒) で入る
+
+map_load：地図の読み込み (全件・304・範囲・差分・クラスター・近傍) をそれぞれ同時数を決めて連打
+webhook_burst：一定レートで webhook (報告・位置・一部は再送) を送り、受付の遅延と取り込み完了までを測る
+image_ingest：画像メッセージを送り、ダウンロード・保存・派生画像の生成が終わるまでを測る
+image_serve：取り込んだ画像 (元画像・中サイズ・サムネイル) を /images/ から同時に大量に取る
+mixed：地図の差分取得とクラスターを読み続けながら webhook を書き込む
+notify：Elgana への投稿を一部失敗させながら作業完了を登録し、応答と全通知が届くまでを測る
+sse_fanout：/events に多数つないだ状態で案件を足し、全員に届くまでの時間を測る
+"""
+import asyncio
+import json
+import random
+import sqlite3
+import time
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from bench.loadgen import (
+    HttpConnection,
+    Request,
+    closed_loop,
+    latency_stats,
+    open_loop,
+    summarize,
+    summarize_by_kind,
+)
+
+
+# host, port：サーバー、db_path：サーバーが使っている DB、stub：StubElgana (無ければ None)
+# events_port：/events 用のサーバー (GUNICORN_ROLE=events)。無ければ port の /events を使う
+Target = namedtuple(
+    "Target", ["host", "port", "db_path", "stub", "events_port"], defaults=(None,)
+)
+
+# 東京 23 区のあたり (南端, 西端, 北端, 東端)
+TOKYO_BBOX = (35.53, 139.56, 35.82, 139.92)
+# ズームと、その時に地図に映る範囲
+CLUSTER_VIEWS = {
+    5: (25.0, 127.0, 46.0, 150.0),
+    10: TOKYO_BBOX,
+    13: (35.66, 139.70, 35.70, 139.76),
+}
+
+REPORT_BODY = "【①指示】{n}\n【②状況】側溝の補修\n【③緊急度】{urgency}\n【④お客様情報】要請あり\n【⑤備考】ベンチマーク"
+LOCATION_BODY = "位置情報を送信しました"
+
+# 取り込みが終わるのを待つ上限 (秒)
+DRAIN_TIMEOUT = 300
+
+
+def _connect(target):
+    conn = sqlite3.connect(target.db_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA query_only = 1")
+    return conn
+
+
+def _last_job_id(target):
+    conn = _connect(target)
+    try:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM webhook_jobs").fetchone()[0]
+    finally:
+        conn.close()
+
+
+async def _wait_for_jobs(target, after_id, timeout=DRAIN_TIMEOUT):
+    """
+    after_id より後のジョブが全て終わるまで待ち、待った秒数を返す
+    """
+    conn = _connect(target)
+    started = time.perf_counter()
+    try:
+        while time.perf_counter() - started < timeout:
+            left = conn.execute(
+                """
+                SELECT COUNT(*) FROM webhook_jobs
+                WHERE id > ? AND status IN ('pending', 'running')
+            """,
+                (after_id,),
+            ).fetchone()[0]
+            if left == 0:
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        conn.close()
+    return round(time.perf_counter() - started, 3)
+
+
+def _job_results(target, after_id):
+    """
+    after_id より後のジョブの、積まれてから終わるまでの時間 (ミリ秒の統計) と状態ごとの数
+    """
+    conn = _connect(target)
+    try:
+        durations = [
+            row[0]
+            for row in conn.execute(
+                """
+                SELECT finished_at - enqueued_at FROM webhook_jobs
+                WHERE id > ? AND status = 'done'
+            """,
+                (after_id,),
+            )
+        ]
+        states = dict(
+            conn.execute(
+                "SELECT status, COUNT(*) FROM webhook_jobs WHERE id > ? GROUP BY status",
+                (after_id,),
+            ).fetchall()
+        )
+    finally:
+        conn.close()
+    return {"job_ms": latency_stats(durations), "jobs": states}
+
+
+def _sample_ids(target):
+    """
+    既存のルーム・作業者の ID (webhook の送り主に使う)
+    """
+    conn = _connect(target)
+    try:
+        rooms = [r[0] for r in conn.execute("SELECT room_id FROM rooms LIMIT 50")]
+        users = [r[0] for r in conn.execute("SELECT user_id FROM user_info LIMIT 200")]
+    finally:
+        conn.close()
+    return rooms or ["bench-room"], users or ["bench-user"]
+
+
+def _run_token():
+    # 実行ごとに msg_id が重ならないようにする
+    return "%08x" % (int(time.time() * 1000) & 0xFFFFFFFF)
+
+
+def _webhook(msg_id, room_id, user_id, kind, rng):
+    msg = {"id": msg_id, "roomId": room_id, "userId": user_id, "type": "text", "extra": ""}
+    if kind == "report":
+        msg["body"] = REPORT_BODY.format(n=msg_id[-6:], urgency=rng.choice("高中低"))
+    elif kind == "location":
+        lat, lon = TOKYO_BBOX[0] + rng.random() * 0.3, TOKYO_BBOX[1] + rng.random() * 0.36
+        msg["body"] = LOCATION_BODY
+        msg["extra"] = json.dumps({"lat": lat, "lon": lon})
+    return {"tag": "onMessage", "msg": msg}
+
+
+def _post(payload):
+    return Request("POST", "/elgana_api", payload)
+
+
+def _count_replies(counts):
+    def on_response(i, kind, response):
+        try:
+            message = json.loads(response.body).get("message")
+        except ValueError:
+            message = None
+        counts[message] = counts.get(message, 0) + 1
+
+    return on_response
+
+
+def map_load(target, concurrency=20, duration=5):
+    """
+    地図の読み込み方ごとに duration 秒ずつ、concurrency 本の接続で連打する
+    """
+
+    async def run():
+        conn = HttpConnection(target.host, target.port)
+        first = await conn.request(
+            "GET", "/get_locations", headers={"Accept-Encoding": "gzip"}
+        )
+        conn.close()
+        etag = first.headers.get("etag", "")
+        seq = int(first.headers.get("x-locations-seq", "0"))
+        rng = random.Random(1)
+
+        def bbox():
+            south, west, north, east = TOKYO_BBOX
+            dy, dx = rng.uniform(-0.05, 0.05), rng.uniform(-0.05, 0.05)
+            return f"{south + dy},{west + dx},{north + dy},{east + dx}"
+
+        gzip = {"Accept-Encoding": "gzip"}
+        phases = {
+            "locations_full": lambda: Request("GET", "/get_locations", None, gzip),
+            "locations_not_modified": lambda: Request(
+                "GET", "/get_locations", None, {**gzip, "If-None-Match": etag}
+            ),
+            "locations_bbox": lambda: Request(
+                "GET", "/get_locations?" + urlencode({"bbox": bbox()}), None, gzip
+            ),
+            "locations_delta": lambda: Request(
+                "GET", f"/get_locations?updated_since={max(0, seq - 50)}", None, gzip
+            ),
+            "nearby": lambda: Request(
+                "GET",
+                "/nearby?"
+                + urlencode(
+                    {
+                        "lat": 35.68 + rng.gauss(0, 0.05),
+                        "lon": 139.76 + rng.gauss(0, 0.05),
+                        "radius": 500,
+                    }
+                ),
+            ),
+        }
+        for zoom, view in CLUSTER_VIEWS.items():
+            query = urlencode({"zoom": zoom, "bbox": ",".join(map(str, view))})
+            phases[f"clusters_z{zoom}"] = (
+                lambda query=query: Request("GET", f"/get_clusters?{query}")
+            )
+
+        results = {}
+        for name, make in phases.items():
+            sizes = []
+            samples, elapsed = await closed_loop(
+                target.host,
+                target.port,
+                lambda i, make=make, name=name: (name, make()),
+                concurrency,
+                duration,
+                on_response=lambda kind, response: sizes.append(len(response.body)),
+            )
+            results[name] = summarize(samples, elapsed)
+            results[name]["bytes"] = round(sum(sizes) / len(sizes)) if sizes else 0
+        results["locations_full"]["seq"] = seq
+        return results
+
+    return asyncio.run(run())
+
+
+def webhook_burst(target, rate=500, duration=10, redelivery=0.1, connections=200):
+    """
+    毎秒 rate 件の webhook を duration 秒送る (報告と位置が半々、redelivery の割合で再送)
+    受付の遅延は予定した送信時刻から、取り込みはジョブが積まれてから終わるまでを測る
+    """
+    rooms, users = _sample_ids(target)
+    token = _run_token()
+    rng = random.Random(2)
+    total = int(rate * duration)
+    # i 番目に送るもの：(元の番号, 種類)。再送は前に送ったものをもう一度送る
+    plan = []
+    for i in range(total):
+        if i and rng.random() < redelivery:
+            plan.append(plan[rng.randrange(i)])
+        else:
+            plan.append((i, "report" if i % 2 else "location"))
+    payloads = {}
+
+    def make(i):
+        original, kind = plan[i]
+        if original not in payloads:
+            payloads[original] = _webhook(
+                f"wh{token}{original:08x}",
+                rooms[original % len(rooms)],
+                users[original % len(users)],
+                kind,
+                random.Random(original),
+            )
+        return kind, _post(payloads[original])
+
+    after_id = _last_job_id(target)
+    replies = {}
+
+    async def run():
+        samples, elapsed = await open_loop(
+            target.host,
+            target.port,
+            make,
+            rate,
+            duration,
+            connections,
+            on_response=_count_replies(replies),
+        )
+        drain = await _wait_for_jobs(target, after_id)
+        return samples, elapsed, drain
+
+    samples, elapsed, drain = asyncio.run(run())
+    unique = len({original for original, _ in plan})
+    result = {
+        "accept": summarize(samples, elapsed),
+        "sent": total,
+        "unique_messages": unique,
+        "replies": replies,
+        "drain_s": drain,
+        "jobs_per_s": round(unique / (elapsed + drain), 1),
+    }
+    result.update(_job_results(target, after_id))
+    return result
+
+
+def image_ingest(target, rate=5, duration=10, max_files=3, connections=20):
+    """
+    毎秒 rate 件の画像メッセージ (1〜max_files 枚) を duration 秒送り、
+    全ての画像の保存と派生画像 (サムネイル・中サイズ) の生成が終わるまでを測る
+    """
+    rooms, users = _sample_ids(target)
+    token = _run_token()
+    total = int(rate * duration)
+    messages = []
+    for i in range(total):
+        rng = random.Random(i)
+        msg_id = f"im{token}{i:08x}"
+        files = [f"{msg_id}-{k}" for k in range(rng.randint(1, max_files))]
+        messages.append(
+            {
+                "tag": "onMessage",
+                "msg": {
+                    "id": msg_id,
+                    "roomId": rooms[i % len(rooms)],
+                    "userId": users[i % len(users)],
+                    "type": "image",
+                    "body": "",
+                    "extra": "",
+                    "data": "\n".join(files),
+                },
+            }
+        )
+    images = sum(len(m["msg"]["data"].split("\n")) for m in messages)
+    stub_before = target.stub.stats() if target.stub else {}
+    after_id = _last_job_id(target)
+    replies = {}
+
+    async def wait_for_derivatives(timeout=DRAIN_TIMEOUT):
+        conn = _connect(target)
+        started = time.perf_counter()
+        done = 0
+        try:
+            while time.perf_counter() - started < timeout:
+                done = conn.execute(
+                    """
+                    SELECT COUNT(*) FROM spot_info
+                    WHERE msg_id >= ? AND msg_id < ? AND thumb_url IS NOT NULL
+                """,
+                    (f"im{token}", f"im{token}~"),
+                ).fetchone()[0]
+                if done >= images:
+                    break
+                await asyncio.sleep(0.1)
+        finally:
+            conn.close()
+        return done, round(time.perf_counter() - started, 3)
+
+    async def run():
+        samples, elapsed = await open_loop(
+            target.host,
+            target.port,
+            lambda i: ("image", _post(messages[i])),
+            rate,
+            duration,
+            connections,
+            on_response=_count_replies(replies),
+        )
+        drain = await _wait_for_jobs(target, after_id)
+        derived, waited = await wait_for_derivatives()
+        return samples, elapsed, drain, derived, waited
+
+    samples, elapsed, drain, derived, waited = asyncio.run(run())
+    stub_after = target.stub.stats() if target.stub else {}
+    result = {
+        "accept": summarize(samples, elapsed),
+        "messages": total,
+        "images": images,
+        "replies": replies,
+        "drain_s": drain,
+        "derivatives_done": derived,
+        "derivatives_wait_s": round(drain + waited, 3),
+        "images_per_s": round(derived / (elapsed + drain + waited), 2),
+        "elgana": {key: stub_after[key] - stub_before.get(key, 0) for key in stub_after},
+    }
+    result.update(_job_results(target, after_id))
+    return result
+
+
+def image_serve(target, concurrency=50, duration=5):
+    """
+    取り込み済みの画像を /images/ から concurrency 本の接続で duration 秒ずつ取る
+    元画像・中サイズ・サムネイルの全体、304 (If-None-Match)、先頭 64KB の Range を測り、
+    転送量 (MB/秒) も出す。画像が無ければ (image_ingest の前は) 何もしない
+    """
+    conn = _connect(target)
+    try:
+        rows = conn.execute(
+            """
+            SELECT image_url, medium_url, thumb_url FROM spot_info
+            WHERE thumb_url IS NOT NULL AND deleted IS NOT '1'
+            LIMIT 200
+        """
+        ).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return {"skipped": "no stored images"}
+
+    def etag(url):
+        return '"' + url.rsplit("/", 1)[-1].rsplit(".", 1)[0] + '"'
+
+    originals, mediums, thumbs = zip(*rows)
+    phases = {
+        "original": lambda i: Request("GET", originals[i % len(rows)]),
+        "medium": lambda i: Request("GET", mediums[i % len(rows)]),
+        "thumb": lambda i: Request("GET", thumbs[i % len(rows)]),
+        "not_modified": lambda i: Request(
+            "GET", thumbs[i % len(rows)], None, {"If-None-Match": etag(thumbs[i % len(rows)])}
+        ),
+        "range": lambda i: Request(
+            "GET", originals[i % len(rows)], None, {"Range": "bytes=0-65535"}
+        ),
+    }
+
+    async def run():
+        results = {}
+        for name, make in phases.items():
+            sizes = []
+            samples, elapsed = await closed_loop(
+                target.host,
+                target.port,
+                lambda i, make=make, name=name: (name, make(i)),
+                concurrency,
+                duration,
+                on_response=lambda kind, response: sizes.append(len(response.body)),
+            )
+            results[name] = summarize(samples, elapsed)
+            results[name]["bytes"] = round(sum(sizes) / len(sizes)) if sizes else 0
+            results[name]["mb_per_s"] = round(sum(sizes) / elapsed / 1e6, 1)
+        results["images"] = len(rows)
+        return results
+
+    return asyncio.run(run())
+
+
+def mixed(target, duration=10, readers=10, write_rate=100, connections=50):
+    """
+    readers 本の接続で地図の差分取得とクラスターを読み続けながら、
+    毎秒 write_rate 件の webhook を書き込む
+    """
+    rooms, users = _sample_ids(target)
+    token = _run_token()
+    after_id = _last_job_id(target)
+    replies = {}
+    state = {"seq": 0}
+
+    def read(i):
+        if i % 3 == 0:
+            view = ",".join(map(str, CLUSTER_VIEWS[10]))
+            return "clusters_z10", Request("GET", f"/get_clusters?zoom=10&bbox={view}")
+        # 圧縮させると seq を読むのに展開が要るので、差分は非圧縮で受け取る
+        return "locations_delta", Request(
+            "GET", f"/get_locations?updated_since={state['seq']}"
+        )
+
+    def on_read(kind, response):
+        if kind == "locations_delta" and response.status == 200:
+            state["seq"] = max(state["seq"], json.loads(response.body)["seq"])
+
+    def write(i):
+        kind = "report" if i % 2 else "location"
+        payload = _webhook(
+            f"mx{token}{i:08x}", rooms[i % len(rooms)], users[i % len(users)], kind,
+            random.Random(i),
+        )
+        return kind, _post(payload)
+
+    async def run():
+        conn = HttpConnection(target.host, target.port)
+        latest = await conn.request("GET", "/get_locations?updated_since=0")
+        conn.close()
+        state["seq"] = json.loads(latest.body)["seq"]
+        (reads, read_elapsed), (writes, write_elapsed) = await asyncio.gather(
+            closed_loop(target.host, target.port, read, readers, duration, on_read),
+            open_loop(
+                target.host,
+                target.port,
+                write,
+                write_rate,
+                duration,
+                connections,
+                on_response=_count_replies(replies),
+            ),
+        )
+        drain = await _wait_for_jobs(target, after_id)
+        return reads, read_elapsed, writes, write_elapsed, drain
+
+    reads, read_elapsed, writes, write_elapsed, drain = asyncio.run(run())
+    result = {
+        "reads": summarize_by_kind(reads, read_elapsed),
+        "writes": summarize(writes, write_elapsed),
+        "replies": replies,
+        "drain_s": drain,
+    }
+    result.update(_job_results(target, after_id))
+    return result
+
+
+# /completed の通知の本文 (elgana_api.completed)
+COMPLETED_TEXT = "作業完了登録をしました。"
+
+
+async def _wait_for_outbox(target, after_id, timeout=DRAIN_TIMEOUT):
+    """
+    after_id より後の通知が全て送られる (か dead になる) まで待ち、待った秒数を返す
+    """
+    conn = _connect(target)
+    started = time.perf_counter()
+    try:
+        while time.perf_counter() - started < timeout:
+            left = conn.execute(
+                """
+                SELECT COUNT(*) FROM outbox
+                WHERE id > ? AND status IN ('pending', 'sending')
+            """,
+                (after_id,),
+            ).fetchone()[0]
+            if left == 0:
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        conn.close()
+    return round(time.perf_counter() - started, 3)
+
+
+def notify(target, rate=20, duration=10, failure_rate=0.3, connections=20):
+    """
+    毎秒 rate 件、未完了の案件の作業完了を /completed に登録する
+    その間 Elgana の代わりへの投稿を failure_rate の割合で失敗 (503) させ、
+    /completed の応答時間と、全ての通知が届くまでの時間・取りこぼし (missed) を測る
+    """
+    if target.stub is None:
+        return {"skipped": "no stub"}
+    conn = _connect(target)
+    try:
+        orders = [
+            row[0]
+            for row in conn.execute(
+                """
+                SELECT msg_id FROM operation_orders
+                WHERE completed IS NULL AND msg_id IS NOT NULL
+                ORDER BY id
+                LIMIT ?
+            """,
+                (int(rate * duration),),
+            )
+        ]
+        after_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM outbox").fetchone()[0]
+    finally:
+        conn.close()
+    replies = {}
+    posted = len(target.stub.messages())
+    failures = target.stub.stats()["upload_failures"]
+    target.stub.upload_failure_rate = failure_rate
+
+    def complete(i):
+        return "completed", Request("POST", "/completed", {"msg_id": orders[i % len(orders)]})
+
+    async def run():
+        samples, elapsed = await open_loop(
+            target.host,
+            target.port,
+            complete,
+            rate,
+            min(duration, len(orders) / rate),
+            connections,
+            on_response=_count_replies(replies),
+        )
+        drain = await _wait_for_outbox(target, after_id)
+        return samples, elapsed, drain
+
+    try:
+        samples, elapsed, drain = asyncio.run(run())
+    finally:
+        target.stub.upload_failure_rate = 0.0
+
+    messages = target.stub.messages()[posted:]
+    delivered = sum(text.count(COMPLETED_TEXT) for _, text in messages)
+    conn = _connect(target)
+    try:
+        delays = [
+            row[0]
+            for row in conn.execute(
+                "SELECT sent_at - created_at FROM outbox WHERE id > ? AND status = 'sent'",
+                (after_id,),
+            )
+        ]
+        states = dict(
+            conn.execute(
+                "SELECT status, COUNT(*) FROM outbox WHERE id > ? GROUP BY status",
+                (after_id,),
+            ).fetchall()
+        )
+    finally:
+        conn.close()
+    completed = replies.get("completed_regist success!!", 0)
+    return {
+        "completed": summarize(samples, elapsed),
+        "replies": replies,
+        "drain_s": drain,
+        "notify_ms": latency_stats(delays),
+        "outbox": states,
+        "posts": len(messages),
+        "upload_failures": target.stub.stats()["upload_failures"] - failures,
+        "delivered": delivered,
+        "missed": completed - delivered,
+    }
+
+
+async def _subscribe(target, deliveries, ready):
+    """
+    /events を読み続け、届いた msg_id ごとに受信時刻を deliveries に足す
+    """
+    port = target.events_port or target.port
+    reader, writer = await asyncio.open_connection(target.host, port)
+    try:
+        writer.write(
+            f"GET /events HTTP/1.1\r\nHost: {target.host}\r\n"
+            "Accept: text/event-stream\r\n\r\n".encode()
+        )
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        if b" 200 " not in head.split(b"\r\n", 1)[0]:
+            ready.set_result(False)
+            return
+        ready.set_result(True)
+        buffer = b""
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                return
+            buffer += chunk
+            while b"\n\n" in buffer:
+                event, buffer = buffer.split(b"\n\n", 1)
+                for line in event.split(b"\n"):
+                    # チャンクの長さの行などが混ざっても data: の行だけ見る
+                    if b"data: " in line:
+                        data = json.loads(line.split(b"data: ", 1)[1])
+                        now = time.perf_counter()
+                        for msg_id in data.get("msg_ids", []):
+                            deliveries.setdefault(msg_id, []).append(now)
+    except (OSError, asyncio.IncompleteReadError):
+        if not ready.done():
+            ready.set_result(False)
+    finally:
+        writer.close()
+
+
+def sse_fanout(
+    target,
+    subscribers=500,
+    events=20,
+    interval=0.5,
+    timeout=10,
+    max_ack_ms=100,
+    max_delivery_ms=1000,
+):
+    """
+    /events に subscribers 本つなぎ、平均 interval 秒ごとに位置の webhook を 1 件送る
+    webhook の受付 (ack) の時間と、送ってから全員に変更 (その msg_id) が届くまでの時間を測る
+    間隔は揺らす (一定だと変更の監視の周期と揃い、毎回同じ遅延になるため)
+    全員がつながり取りこぼしがなく、ack の p99 が max_ack_ms、届くまでの p99 が
+    max_delivery_ms ミリ秒以内であることを確認 (checks) に入れる
+    """
+    rooms, users = _sample_ids(target)
+    token = _run_token()
+    rng = random.Random(3)
+
+    async def run():
+        deliveries = {}
+        loop = asyncio.get_running_loop()
+        readies = [loop.create_future() for _ in range(subscribers)]
+        started = time.perf_counter()
+        tasks = [
+            asyncio.create_task(_subscribe(target, deliveries, ready)) for ready in readies
+        ]
+        connected = sum(await asyncio.gather(*readies))
+        connect_s = time.perf_counter() - started
+
+        conn = HttpConnection(target.host, target.port)
+        each, slowest, acks, missed = [], [], [], 0
+        for k in range(events):
+            msg_id = f"ev{token}{k:08x}"
+            payload = _webhook(msg_id, rooms[0], users[0], "location", random.Random(k))
+            sent = time.perf_counter()
+            await conn.request("POST", "/elgana_api", payload)
+            acks.append(time.perf_counter() - sent)
+            while (
+                len(deliveries.get(msg_id, ())) < connected
+                and time.perf_counter() - sent < timeout
+            ):
+                await asyncio.sleep(0.005)
+            got = deliveries.get(msg_id, [])
+            missed += connected - len(got)
+            each.extend(t - sent for t in got)
+            if got:
+                slowest.append(max(got) - sent)
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * interval)
+        conn.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        ack_ms, delivery_ms = latency_stats(acks), latency_stats(each)
+        return {
+            "subscribers": subscribers,
+            "connected": connected,
+            "connect_s": round(connect_s, 3),
+            "events": events,
+            "ack_ms": ack_ms,
+            "delivery_ms": delivery_ms,
+            "all_delivered_ms": latency_stats(slowest),
+            "missed": missed,
+            "checks": {
+                f"connected_{subscribers}": connected == subscribers,
+                "none_missed": missed == 0,
+                f"ack_p99_under_{max_ack_ms}ms": bool(acks)
+                and ack_ms["p99"] <= max_ack_ms,
+                f"delivery_p99_under_{max_delivery_ms}ms": bool(each)
+                and delivery_ms["p99"] <= max_delivery_ms,
+            },
+        }
+
+    return asyncio.run(run())
+
+
+# python -m bench.run で選べるシナリオ (この順に実行する)
+SCENARIOS = {
+    "map_load": map_load,
+    "webhook_burst": webhook_burst,
+    "image_ingest": image_ingest,
+    "image_serve": image_serve,
+    "mixed": mixed,
+    "notify": notify,
+    "sse_fanout": sse_fanout,
+}
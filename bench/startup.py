@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+起動時間の計測と、複数ワーカーでの動作確認 (スモークテスト)
+
+python -m bench.startup [--workers 4] [--runs 5] [--orders 2000]
+
+import：新しいインタープリタで elgana_api を import する時間と create_app() の時間 (移行済みの DB)
+migrate：python migrations.py の時間 (新しい DB と移行済みの DB)
+boot：gunicorn.conf.py で空の DB から起動し、最初の応答と全ワーカーの応答までの時間
+smoke：複数ワーカーで webhook・作業完了の通知・/events を通し、画像のダウンロード中に
+       SIGTERM を送って、ダウンロードと派生画像の保存が終わってから止まることを確かめる
+結果を表で出して JSON に保存し、スモークテストの確認が 1 つでも通らなければ終了コード 1
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bench import datagen
+from bench.run import RESULTS_DIR, ROOT, STARTUP_TIMEOUT, _free_port, _git
+from bench.scenarios import COMPLETED_TEXT, REPORT_BODY
+from bench.stub_elgana import StubElgana
+
+
+CONFIG = os.path.join(ROOT, "gunicorn.conf.py")
+
+# 新しいインタープリタで import と create_app() の時間を測る
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import elgana_api
+imported = time.perf_counter()
+elgana_api.create_app()
+created = time.perf_counter()
+elgana_api.shutdown()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "modules": len(sys.modules),
+    "pillow": "PIL" in sys.modules,
+}))
+"""
+
+# スモークテストで各段階を待つ上限 (秒)
+SMOKE_TIMEOUT = 60
+
+
+def _env(workdir, db_path, stub=None):
+    env = dict(os.environ)
+    env.update(
+        {
+            "DB_PATH": db_path,
+            "IMAGE_DIR": os.path.join(workdir, "images"),
+            "IMAGE_STORE": "local",
+            "LOG_LEVEL": "WARNING",
+        }
+    )
+    if stub is not None:
+        env.update(stub.env())
+    return env
+
+
+def _median(values):
+    return round(statistics.median(values), 1) if values else None
+
+
+def _spawn(command, env):
+    started = time.perf_counter()
+    output = subprocess.run(
+        command, cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return (time.perf_counter() - started) * 1000, output
+
+
+def measure_import(workdir, db_path, runs):
+    """
+    インタープリタ自体の起動・elgana_api の import・create_app() の時間 (中央値)
+    """
+    env = _env(workdir, db_path)
+    interpreter, imports, apps, probe = [], [], [], {}
+    for _ in range(runs):
+        interpreter.append(_spawn([sys.executable, "-c", "pass"], env)[0])
+        wall, output = _spawn([sys.executable, "-c", IMPORT_PROBE], env)
+        probe = json.loads(output.strip().splitlines()[-1])
+        imports.append(probe["import_ms"])
+        apps.append(probe["create_app_ms"])
+    return {
+        "interpreter_ms": _median(interpreter),
+        "import_ms": _median(imports),
+        "create_app_ms": _median(apps),
+        "modules": probe["modules"],
+        "pillow_loaded": probe["pillow"],
+    }
+
+
+def measure_migrate(workdir, db_path, runs):
+    """
+    python migrations.py の時間 (新しい DB・移行済みの DB、中央値)
+    """
+    env = _env(workdir, db_path)
+    command = [sys.executable, os.path.join(ROOT, "migrations.py")]
+    fresh, noop = [], []
+    for i in range(runs):
+        path = os.path.join(workdir, f"migrate-{i}.db")
+        fresh.append(_spawn([*command, path], env)[0])
+        noop.append(_spawn([*command, db_path], env)[0])
+    return {"fresh_ms": _median(fresh), "migrated_ms": _median(noop)}
+
+
+def _get_json(port, path, timeout=2):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=timeout) as r:
+        return json.load(r)
+
+
+def _post_json(port, path, body):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}{path}",
+        data=json.dumps(body, ensure_ascii=False).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as r:
+        return r.status, json.load(r)
+
+
+def _worker_pids(port, workers, deadline):
+    """
+    同時に問い合わせて、応答したワーカーの pid を workers 個そろうまで集める
+    """
+    pids = set()
+    with ThreadPoolExecutor(max_workers=workers * 4) as pool:
+        while len(pids) < workers and time.perf_counter() < deadline:
+            for stats in pool.map(
+                lambda _: _try_stats(port), range(workers * 4)
+            ):
+                if stats is not None:
+                    pids.add(stats["pid"])
+    return pids
+
+
+def _try_stats(port):
+    try:
+        return _get_json(port, "/ingest_stats")
+    except OSError:
+        return None
+
+
+def start_gunicorn(workdir, env, workers, log_name):
+    port = _free_port()
+    command = [
+        sys.executable, "-m", "gunicorn",
+        "-c", CONFIG,
+        "-w", str(workers),
+        "-b", f"127.0.0.1:{port}",
+        "--log-level", "info",
+        "--error-logfile", os.path.join(workdir, log_name),
+    ]
+    process = subprocess.Popen(
+        command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
+    )
+    return process, port
+
+
+def stop_gunicorn(process, timeout=STARTUP_TIMEOUT):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def measure_boot(workdir, workers, runs):
+    """
+    空の DB から gunicorn を起動し、最初の応答と全ワーカーの応答までの時間 (中央値)
+    マスターが移行してからワーカーを fork するので、同時の移行で落ちるワーカーは出ない
+    """
+    first, ready, failures = [], [], 0
+    for i in range(runs):
+        db_path = os.path.join(workdir, f"boot-{i}.db")
+        started = time.perf_counter()
+        process, port = start_gunicorn(
+            workdir, _env(workdir, db_path), workers, f"boot-{i}.log"
+        )
+        deadline = started + STARTUP_TIMEOUT
+        try:
+            while _try_stats(port) is None:
+                if process.poll() is not None or time.perf_counter() > deadline:
+                    raise RuntimeError(f"gunicorn が起動しませんでした ({workdir}/boot-{i}.log)")
+                time.sleep(0.01)
+            first.append((time.perf_counter() - started) * 1000)
+            pids = _worker_pids(port, workers, deadline)
+            if len(pids) == workers:
+                ready.append((time.perf_counter() - started) * 1000)
+            else:
+                failures += 1
+        finally:
+            stop_gunicorn(process)
+    return {
+        "workers": workers,
+        "first_response_ms": _median(first),
+        "all_workers_ms": _median(ready),
+        "incomplete": failures,
+    }
+
+
+def _wait(check, timeout=SMOKE_TIMEOUT):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.05)
+    return None
+
+
+def _query(db_path, sql, params=()):
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        return conn.execute(sql, params).fetchone()
+    finally:
+        conn.close()
+
+
+def _open_events(port):
+    """
+    /events につないでヘッダーを読み、ソケットを返す
+    """
+    sock = socket.create_connection(("127.0.0.1", port), timeout=SMOKE_TIMEOUT)
+    sock.sendall(
+        b"GET /events HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n"
+    )
+    head = b""
+    while b"\r\n\r\n" not in head:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        head += chunk
+    return sock, head.startswith(b"HTTP/1.1 200")
+
+
+def _read_until_ended(sock):
+    """
+    /events の本文が終わる (最後のチャンクが届くか切断される) まで読んで閉じる
+    (EventSource と同じく、終わった接続は使い回さずにつなぎ直す)
+    """
+    tail = b""
+    try:
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            tail = (tail + chunk)[-5:]
+            if tail == b"0\r\n\r\n":
+                break
+    except OSError:
+        pass
+    ended = time.perf_counter()
+    sock.close()
+    return ended
+
+
+def smoke(workdir, db_path, workers, latency_ms):
+    """
+    複数ワーカーで一通りのリクエストを流し、SIGTERM で実行中の取り込みを待って止まるかを見る
+    {確認の名前: 通ったか} と、終了にかかった時間を返す
+    """
+    stub = StubElgana(latency_ms=latency_ms).start()
+    env = _env(workdir, db_path, stub)
+    checks, timings = {}, {}
+    process, port = start_gunicorn(workdir, env, workers, "smoke.log")
+    events = None
+    try:
+        if _wait(lambda: _try_stats(port), STARTUP_TIMEOUT) is None:
+            raise RuntimeError(f"gunicorn が起動しませんでした ({workdir}/smoke.log)")
+        deadline = time.perf_counter() + STARTUP_TIMEOUT
+        checks["all_workers_respond"] = len(_worker_pids(port, workers, deadline)) == workers
+
+        token = "%08x" % (int(time.time() * 1000) & 0xFFFFFFFF)
+        report_id, image_id = f"su{token}r", f"su{token}i"
+        status, reply = _post_json(
+            port,
+            "/elgana_api",
+            {
+                "tag": "onMessage",
+                "msg": {
+                    "id": report_id,
+                    "roomId": "smoke-room",
+                    "userId": "smoke-user",
+                    "type": "text",
+                    "body": REPORT_BODY.format(n="smoke", urgency="高"),
+                    "extra": "",
+                },
+            },
+        )
+        checks["webhook_accepted"] = status == 200 and reply.get("message") == "accepted"
+        checks["webhook_processed"] = bool(
+            _wait(
+                lambda: _query(
+                    db_path, "SELECT 1 FROM operation_orders WHERE msg_id = ?", (report_id,)
+                )
+            )
+        )
+        status, _ = _post_json(port, "/completed", {"msg_id": report_id})
+        checks["completed"] = status == 200
+        checks["notification_sent"] = bool(
+            _wait(
+                lambda: any(
+                    room == "smoke-room" and COMPLETED_TEXT in text
+                    for room, text in stub.messages()
+                )
+            )
+        )
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{port}/get_locations", timeout=SMOKE_TIMEOUT
+        ) as response:
+            checks["get_locations"] = response.status == 200
+
+        events, checks["events_connected"] = _open_events(port)
+
+        # 画像のダウンロード中 (Elgana の代わりが latency_ms 待たせている間) に止める
+        downloads = stub.stats()["downloads"]
+        _post_json(
+            port,
+            "/elgana_api",
+            {
+                "tag": "onMessage",
+                "msg": {
+                    "id": image_id,
+                    "roomId": "smoke-room",
+                    "userId": "smoke-user",
+                    "type": "image",
+                    "body": "",
+                    "extra": "",
+                    "data": f"{image_id}-0\n{image_id}-1",
+                },
+            },
+        )
+        _wait(lambda: stub.stats()["downloads"] > downloads)
+        terminated = time.perf_counter()
+        process.send_signal(signal.SIGTERM)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            closed = pool.submit(_read_until_ended, events)
+            try:
+                process.wait(timeout=STARTUP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            timings["events_ended_s"] = round(closed.result() - terminated, 2)
+        timings["shutdown_s"] = round(time.perf_counter() - terminated, 2)
+        checks["clean_exit"] = process.returncode == 0
+
+        # 画像メッセージが最後に積んだジョブ
+        job = _query(db_path, "SELECT status FROM webhook_jobs ORDER BY id DESC LIMIT 1")
+        checks["download_drained"] = job is not None and job[0] == "done"
+        spots = _query(
+            db_path,
+            """
+            SELECT COUNT(*), COUNT(thumb_url) FROM spot_info WHERE msg_id = ?
+        """,
+            (image_id,),
+        )
+        checks["images_recorded"] = spots[0] == 2
+        checks["derivatives_recorded"] = spots[1] == 2
+    finally:
+        if events is not None:
+            events.close()
+        stop_gunicorn(process)
+        stub.stop()
+    with open(os.path.join(workdir, "smoke.log"), encoding="utf-8", errors="replace") as f:
+        log = f.read()
+    checks["no_errors_logged"] = "Traceback" not in log and "WORKER TIMEOUT" not in log
+    return {"workers": workers, "stub_latency_ms": latency_ms, "checks": checks, **timings}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m bench.startup")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument(
+        "--stub-latency-ms", type=float, default=1000, help="スモークテストでの Elgana の応答の遅さ"
+    )
+    parser.add_argument("--out", help="結果の JSON (既定は bench/results/startup-日時-コミット.json)")
+    parser.add_argument("--keep", action="store_true", help="作業ディレクトリを消さない")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="elgana-startup-")
+    db_path = os.path.join(workdir, "locations.db")
+    try:
+        datagen.generate(db_path, orders=args.orders)
+        print("import ...", flush=True)
+        results = {"import": measure_import(workdir, db_path, args.runs)}
+        print("migrate ...", flush=True)
+        results["migrate"] = measure_migrate(workdir, db_path, args.runs)
+        print("boot ...", flush=True)
+        results["boot"] = measure_boot(workdir, args.workers, args.runs)
+        print("smoke ...", flush=True)
+        results["smoke"] = smoke(workdir, db_path, args.workers, args.stub_latency_ms)
+    finally:
+        if args.keep:
+            print(f"作業ディレクトリ: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for name in ("import", "migrate", "boot"):
+        print(f"{name:8} " + "  ".join(f"{k}={v}" for k, v in results[name].items()))
+    smoke_result = results["smoke"]
+    print(
+        f"smoke    終了 {smoke_result.get('shutdown_s')} 秒 "
+        f"(/events が終わるまで {smoke_result.get('events_ended_s')} 秒)"
+    )
+    for name, ok in smoke_result["checks"].items():
+        print(f"  {'OK ' if ok else 'NG '} {name}")
+
+    commit = _git("rev-parse", "HEAD")
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"startup-{stamp}-{(commit or 'unknown')[:7]}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果: {out}")
+    return 0 if all(smoke_result["checks"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
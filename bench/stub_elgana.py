@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Elgana API のローカルの代わり (ベンチマーク用)
+
+POST /login：アクセストークンを返す (expires_in 付き)
+GET  /file?roomId=&fileId=：写真 (EXIF の向き付きの JPEG) を返す。トークンが無ければ 401
+    (image_padding を指定すると写真の後ろにその大きさの詰め物を付け、少しずつ送る)
+POST /upload：チャットへの投稿を受け付ける (upload_failure_rate の割合で 503 を返す)
+
+latency_ms で応答を遅らせ、実際の Elgana までの往復を真似る。
+ログイン・取得・投稿の回数と張られた接続の数を数えるので、
+トークンや keep-alive の使い回しが効いているかも確認できる
+
+python -m bench.stub_elgana [--port 8900] [--latency-ms 20] [--upload-failure-rate 0.3]
+"""
+import argparse
+import io
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# 写真の大きさ (スマートフォンで撮った程度)
+IMAGE_SIZE = (4000, 3000)
+TOKEN_TTL = 3600
+# 詰め物を送る単位
+PADDING_CHUNK = 64 * 1024
+
+
+def make_photo(size=IMAGE_SIZE, seed=1):
+    """
+    縦向き (Orientation=6) の EXIF 付き JPEG を作る
+    単色だと極端に小さくなるので、ノイズを混ぜて実際の写真に近い大きさにする
+    """
+    import piexif
+    from PIL import Image
+
+    rng = random.Random(seed)
+    base = Image.linear_gradient("L").resize(size).convert("RGB")
+    noise = Image.effect_noise(size, 48).convert("RGB")
+    tint = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    photo = Image.blend(Image.blend(base, noise, 0.35), tint, 0.3)
+    exif = piexif.dump(
+        {
+            "0th": {
+                piexif.ImageIFD.Orientation: 6,
+                piexif.ImageIFD.Make: b"bench",
+                piexif.ImageIFD.Model: b"stub",
+            }
+        }
+    )
+    buf = io.BytesIO()
+    photo.save(buf, "JPEG", quality=85, exif=exif)
+    return buf.getvalue()
+
+
+def tag_photo(photo, file_id):
+    """
+    先頭にコメント (COM) を挟み、fileId ごとに中身 (ハッシュ) の違う写真にする
+    同じ写真だと保存先で重複として扱われ、派生画像の生成も省かれてしまうため
+    """
+    comment = file_id.encode()[:65000]
+    return photo[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + photo[2:]
+
+
+class StubElgana:
+    """
+    別スレッドで動く Elgana の代わり
+
+    stats()：logins / downloads / uploads / upload_failures / unauthorized /
+             connections / bytes_sent
+    messages()：受け付けた投稿の (roomIds, text) の list
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency_ms=20,
+        image_size=IMAGE_SIZE,
+        upload_failure_rate=0.0,
+        image_padding=0,
+    ):
+        self._latency = latency_ms / 1000
+        # 大きな画像の取り込みを真似るため写真の後ろに付けるバイト数
+        # (JPEG は終端 (EOI) より後ろを読まないので、画像としてはそのまま扱える)
+        self.image_padding = image_padding
+        self._photo = make_photo(image_size)
+        self._tokens = set()
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            (
+                "logins",
+                "downloads",
+                "uploads",
+                "upload_failures",
+                "unauthorized",
+                "connections",
+                "bytes_sent",
+            ),
+            0,
+        )
+        self._messages = []
+        self.upload_failure_rate = upload_failure_rate
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        """
+        サーバー側に渡す環境変数 (elgana_client.py / elgana_api.py が読む)
+        """
+        return {
+            "LOGIN_API_URL": f"{self.base_url}/login",
+            "ELGANA_API_URL": f"{self.base_url}/file",
+            "ELGANA_UPLOAD_URL": f"{self.base_url}/upload",
+            "LOGIN_ID": "bench",
+            "PASSWORD": "bench",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="stub-elgana", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def messages(self):
+        with self._lock:
+            return list(self._messages)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # ヘッダーと本文を別々に書くので、keep-alive の接続で遅延 ACK (40ms) を待たないようにする
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                stub._count("connections")
+
+            def _send(self, status, body, content_type="application/json", padding=0):
+                if stub._latency:
+                    time.sleep(stub._latency)
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body) + padding))
+                self.end_headers()
+                self.wfile.write(body)
+                # 詰め物は同じバッファを使い回して送り、スタブ側でメモリを取らない
+                chunk = bytes(min(padding, PADDING_CHUNK))
+                remaining = padding
+                while remaining:
+                    self.wfile.write(chunk[:remaining])
+                    remaining -= min(remaining, len(chunk))
+                stub._count("bytes_sent", len(body) + padding)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def _authorized(self):
+                with stub._lock:
+                    return self.headers.get("X-MBL-ACCESS-TOKEN") in stub._tokens
+
+            def do_POST(self):
+                body = self._read_body()
+                path = urlparse(self.path).path
+                if path == "/login":
+                    token = f"stub-{random.getrandbits(64):016x}"
+                    with stub._lock:
+                        stub._tokens.add(token)
+                    stub._count("logins")
+                    self._send(
+                        200, {"result": {"access_token": token, "expires_in": TOKEN_TTL}}
+                    )
+                elif path == "/upload":
+                    if not self._authorized():
+                        stub._count("unauthorized")
+                        return self._send(401, {"error": "unauthorized"})
+                    if random.random() < stub.upload_failure_rate:
+                        stub._count("upload_failures")
+                        return self._send(503, {"error": "unavailable"})
+                    message = json.loads(body or b"{}")
+                    with stub._lock:
+                        stub._messages.append((message.get("roomIds"), message.get("text")))
+                    stub._count("uploads")
+                    self._send(200, {"result": "ok"})
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/file" or "fileId" not in parse_qs(url.query):
+                    return self._send(404, {"error": "not found"})
+                if not self._authorized():
+                    stub._count("unauthorized")
+                    return self._send(401, {"error": "unauthorized"})
+                stub._count("downloads")
+                file_id = parse_qs(url.query)["fileId"][0]
+                self._send(
+                    200,
+                    tag_photo(stub._photo, file_id),
+                    "image/jpeg",
+                    padding=stub.image_padding,
+                )
+
+        return Handler
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m bench.stub_elgana")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--upload-failure-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    stub = StubElgana(
+        args.host,
+        args.port,
+        args.latency_ms,
+        upload_failure_rate=args.upload_failure_rate,
+    ).start()
+    for name, value in stub.env().items():
+        print(f"{name}={value}")
+    try:
+        while True:
+            time.sleep(10)
+            print(stub.stats(), flush=True)
+    except KeyboardInterrupt:
+        stub.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
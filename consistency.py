@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+書き込み時に持たせている派生値の整合性チェック
+
+operation_orders.operation_status・spot_info.bucket・rooms の件数・地図の集計
+(map_points / map_cells) を元のテーブルから Python で全部計算し直し、
+保存されている値と比べる。判定は get_locations が以前その場で行っていたものと同じ
+
+python consistency.py           差分を表示
+python consistency.py --repair  差分があれば計算し直した値で置き換える
+"""
+import sys
+
+from db import connect
+
+
+def _expected_bucket(spot):
+    if spot["status_flag"] == "0":
+        return 0
+    if spot["status_flag"] == "1":
+        if spot["repair_required"] == "true":
+            return 1
+        if spot["repair_required"] == "false":
+            return 2
+    return None
+
+
+def expected_values(conn):
+    """
+    元のテーブルだけから計算した
+    {"bucket": {spot.id: 区分}, "operation_status": {order.id: 状態},
+     "rooms": {room_id: (total, completed, incomplete)},
+     "map_points": {order.id: (緯度, 経度, 緊急度, 状態)},
+     "map_cells": {(z, cx, cy, 緊急度, 状態): (件数, 緯度の合計, 経度の合計)}}
+    """
+    buckets = {}
+    # msg_id ごとの作業前・作業後の画像の有無 (user_info と結合できるものだけ)
+    has_before, has_after = set(), set()
+    spots = conn.execute(
+        """
+        SELECT s.id, s.msg_id, s.status_flag, s.repair_required,
+            u.user_id IS NOT NULL AS joined
+        FROM spot_info AS s
+        LEFT JOIN (SELECT DISTINCT user_id FROM user_info) AS u
+            ON s.user_id = u.user_id
+    """
+    )
+    for spot in spots:
+        bucket = _expected_bucket(spot)
+        buckets[spot["id"]] = bucket
+        if spot["joined"] and spot["msg_id"] is not None:
+            if bucket == 1:
+                has_before.add(spot["msg_id"])
+            elif bucket == 2:
+                has_after.add(spot["msg_id"])
+
+    statuses = {}
+    rooms = {}
+    points = {}
+    orders = conn.execute(
+        """
+        SELECT id, msg_id, room_id, latitude, longitude, urgency, completed, signal
+        FROM operation_orders
+    """
+    )
+    for order in orders:
+        if order["completed"]:
+            status = "3"
+        elif order["msg_id"] in has_after:
+            status = "2"
+        elif order["msg_id"] in has_before:
+            status = "1"
+        else:
+            status = "0"
+        statuses[order["id"]] = status
+        if order["signal"] == "0":
+            continue
+        total, completed, incomplete = rooms.get(order["room_id"], (0, 0, 0))
+        rooms[order["room_id"]] = (
+            total + 1,
+            completed + (status == "3"),
+            incomplete + (status != "3"),
+        )
+        if order["latitude"] is not None and order["longitude"] is not None:
+            points[order["id"]] = (
+                order["latitude"],
+                order["longitude"],
+                order["urgency"] or "",
+                status,
+            )
+
+    cells = {}
+    levels = conn.execute("SELECT z, cell_deg FROM map_zoom_levels").fetchall()
+    for latitude, longitude, urgency, status in points.values():
+        for z, cell_deg in levels:
+            key = (
+                z,
+                int((longitude + 180) / cell_deg),
+                int((latitude + 90) / cell_deg),
+                urgency,
+                status,
+            )
+            n, lat_sum, lon_sum = cells.get(key, (0, 0.0, 0.0))
+            cells[key] = (n + 1, lat_sum + latitude, lon_sum + longitude)
+
+    return {
+        "bucket": buckets,
+        "operation_status": statuses,
+        "rooms": rooms,
+        "map_points": points,
+        "map_cells": cells,
+    }
+
+
+def stored_values(conn):
+    """
+    expected_values と同じ形で、DB に保存されている値を返す
+    rooms は rooms テーブルにある部屋だけ
+    """
+    return {
+        "bucket": {
+            row["id"]: row["bucket"]
+            for row in conn.execute("SELECT id, bucket FROM spot_info")
+        },
+        "operation_status": {
+            row["id"]: row["operation_status"]
+            for row in conn.execute("SELECT id, operation_status FROM operation_orders")
+        },
+        "rooms": {
+            row["room_id"]: (
+                row["total_count"],
+                row["completed_count"],
+                row["incomplete_count"],
+            )
+            for row in conn.execute(
+                "SELECT room_id, total_count, completed_count, incomplete_count FROM rooms"
+            )
+        },
+        "map_points": {
+            row["order_id"]: tuple(row)[1:]
+            for row in conn.execute(
+                """
+                SELECT order_id, latitude, longitude, urgency, operation_status
+                FROM map_points
+            """
+            )
+        },
+        "map_cells": {
+            tuple(row)[:5]: tuple(row)[5:]
+            for row in conn.execute(
+                """
+                SELECT z, cx, cy, urgency, operation_status, n, lat_sum, lon_sum
+                FROM map_cells
+            """
+            )
+        },
+    }
+
+
+def _same(expected, stored):
+    # 座標の合計は足し引きを繰り返すので誤差を許す
+    if isinstance(expected, tuple) and isinstance(stored, tuple):
+        return len(expected) == len(stored) and all(
+            _same(e, s) for e, s in zip(expected, stored)
+        )
+    if isinstance(expected, float) and isinstance(stored, float):
+        return abs(expected - stored) < 1e-6
+    return expected == stored
+
+
+def check(conn):
+    """
+    {名前: [(キー, 計算し直した値, 保存されている値), ...]} を返す (差分なしは空リスト)
+    """
+    expected = expected_values(conn)
+    stored = stored_values(conn)
+    diffs = {}
+    for name in expected:
+        keys = set(expected[name]) | set(stored[name])
+        if name == "rooms":
+            # 部屋の行が無い room_id は数える先が無いので対象外
+            keys = set(stored[name])
+        diffs[name] = [
+            (key, expected[name].get(key), stored[name].get(key))
+            for key in sorted(keys, key=repr)
+            if not _same(expected[name].get(key), stored[name].get(key))
+        ]
+    return diffs
+
+
+def repair(conn):
+    """
+    operation_status・rooms・地図の集計を計算し直した値で置き換える
+    (bucket は生成列なのでずれることはない)
+    """
+    from migrations import ROOM_COUNTS_SQL
+
+    expected = expected_values(conn)
+    stored = stored_values(conn)
+    conn.execute("BEGIN")
+    try:
+        fixed = [
+            (status, order_id)
+            for order_id, status in expected["operation_status"].items()
+            if stored["operation_status"].get(order_id) != status
+        ]
+        conn.executemany(
+            "UPDATE operation_orders SET operation_status = ? WHERE id = ?", fixed
+        )
+        # operation_status だけの更新では row_seq は進まない (migrations.py v9) ので、
+        # 差分取得・ETag に反映されるよう直した案件の row_seq を進める
+        if fixed:
+            conn.execute("UPDATE sync_state SET seq = seq + 1 WHERE name = 'locations'")
+            conn.executemany(
+                """
+                UPDATE operation_orders
+                SET row_seq = (SELECT seq FROM sync_state WHERE name = 'locations')
+                WHERE id = ?
+            """,
+                [(order_id,) for _, order_id in fixed],
+            )
+        conn.execute(ROOM_COUNTS_SQL)
+        # map_points のトリガーが map_cells を増減させるので、両方空にしてから入れ直す
+        conn.execute("DELETE FROM map_points")
+        conn.execute("DELETE FROM map_cells")
+        conn.executemany(
+            """
+            INSERT INTO map_points
+                (order_id, latitude, longitude, urgency, operation_status)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            [(order_id, *point) for order_id, point in expected["map_points"].items()],
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def main(argv):
+    conn = connect()
+    try:
+        diffs = check(conn)
+        for name, rows in diffs.items():
+            print(f"{name}: 差分 {len(rows)} 件")
+            for key, expected, stored in rows[:20]:
+                print(f"  {key}: 計算 {expected!r} / 保存 {stored!r}")
+        if "--repair" in argv and any(diffs.values()):
+            repair(conn)
+            remaining = sum(len(rows) for rows in check(conn).values())
+            print("修復しました" if remaining == 0 else f"修復後も差分 {remaining} 件")
+            return 0 if remaining == 0 else 1
+        return 1 if any(diffs.values()) else 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite 接続の管理
+
+スレッドごとに接続を 1 本だけ開いて使い回す。
+接続は WAL / synchronous=NORMAL / busy_timeout 付きで開くので、
+webhook の書き込み中も地図の読み込みが待たされない。
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from metrics import install_query_counter
+
+
+load_dotenv()
+
+DB_PATH = os.getenv(
+    "DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "locations.db")
+)
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# 接続ごとにキャッシュするプリペアドステートメントの数
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+_local = threading.local()
+
+
+class Connection(sqlite3.Connection):
+    """
+    接続ごとの状態を持てる sqlite3.Connection
+    attached：ATTACH 済みの DB の名前 -> 開いた形 ("ro" / "rw")
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attached = {}
+
+
+def connect(path=None):
+    """
+    設定済みの新しい接続を開く (使い回さない用途向け)
+    ATTACH で file: の URI (?mode=ro など) を使えるよう uri=True で開く
+    (file: で始まらない path はそのままファイル名として扱われる)
+    """
+    conn = sqlite3.connect(
+        path or DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=Connection,
+        uri=True,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    install_query_counter(conn)
+    return conn
+
+
+def get_db():
+    """
+    このスレッド用の接続を返す (なければ開く)
+    fork 後の子プロセスでは親の接続を使わずに開き直す
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def close_db():
+    """
+    このスレッドの接続を閉じる
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+@contextmanager
+def transaction():
+    """
+    with transaction() as conn: の中の書き込みをまとめてコミットする
+    例外時はロールバックして送出し直す
+    """
+    conn = get_db()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
@@ -1,115 +1,91 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    jsonify,
+    request,
+    send_from_directory,
+)
 import sqlite3
 import os
 import json
-import requests
-import traceback
+import logging
+import mimetypes
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from archive import attach_archive
+from db import connect, get_db
+from elgana_client import call_with_token, elgana_headers
+import elgana_client
+from events import ChangeFeed, TooManySubscribers
+from export import export_csv, export_geojson
+import image_derivatives
+from image_store import (
+    CHUNK_SIZE,
+    ImageRejected,
+    LocalImageStore,
+    content_hash,
+    get_image_store,
+)
+from ingest import JobQueue
+from logs import sample_payload, setup_logging
+import metrics
+from metrics import timed
+from message_parser import parse_message
+from migrations import migrate
+from outbox import OutboxDispatcher, enqueue_message
+import request_metrics
+from response_cache import ResponseCache
+from spatial import NEARBY_MAX_RADIUS_M, find_duplicate, find_nearby
+from writer import get_writer
+
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 # ↓ 後ほど .env へ格納
-DB_PATH = os.path.join(os.path.dirname(__file__), "locations.db")
 ELGANA_API_URL = os.getenv("ELGANA_API_URL")
-LOGIN_API_URL = os.getenv("LOGIN_API_URL")
 ELGANA_UPLOAD_URL = os.getenv("ELGANA_UPLOAD_URL")
 RICHMENU_API_URL = os.getenv("RICHMENU_API_URL")
 CREATEROOM_API_URL = os.getenv("CREATEROOM_API_URL")
-LOGIN_ID = os.getenv("LOGIN_ID")
-PASSWORD = os.getenv("PASSWORD")
+# 画像メッセージ内の複数ファイルを同時にダウンロードする数
+IMAGE_DOWNLOAD_WORKERS = int(os.getenv("IMAGE_DOWNLOAD_WORKERS", "4"))
+# nginx の internal な location (例 /_images) を指定すると、/images/ の本体の送信を
+# X-Accel-Redirect で nginx に任せる
+IMAGE_ACCEL_REDIRECT = os.getenv("IMAGE_ACCEL_REDIRECT", "").rstrip("/")
+
+# ルートは create_app() で Flask アプリに登録する
+api = Blueprint("api", __name__)
 
-app = Flask(__name__)
+_download_pool = None
+_download_pool_pid = None
+_download_pool_lock = threading.Lock()
 
 
 def init_db():
     """
     DB初期化
-    locations & potohle テーブルがなければ作成
+    migrations.py の未適用の移行 (テーブル作成・カラム補正・インデックス) を適用
     """
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    conn = connect()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
 
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS operation_orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            msg_id TEXT,
-            room_id TEXT,
-            user_id TEXT,
-            location_id TEXT,
-            latitude REAL,
-            longitude REAL,
-            instruction_id TEXT,
-            instruction TEXT,
-            status TEXT,
-            urgency TEXT,
-            customer_info TEXT,
-            remarks TEXT,
-            received_at TEXT,
-            completed TEXT,
-            update_at TEXT
-        )
-    """
-    )
 
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS spot_info (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            msg_id TEXT,
-            image_id TEXT,
-            repair_required TEXT,
-            hight TEXT,
-            width TEXT,
-            depth TEXT,
-            image_url TEXT,
-            image_filename TEXT,
-            deleted TEXT 
-        )
+def upload_message(conn, msg_id, tmp_text):
     """
-    )
-
-    conn.commit()
-    conn.close()
-
-
-def get_access_token():
+    案件のルームへの通知 (指示・完了日時と tmp_text) を outbox に積む
+    conn の書き込みと同じトランザクションでコミットされ、送信は outbox.py の送信スレッドが行う
+    案件が無ければ積まずに False
     """
-    Elgana にログインしてトークンを取得する
-
-    headers：Elgana へのリクエストヘッダーを定義
-    payload：Elgana へのログインIDとパスワードを定義
-
-    response：このリクエストの応答を格納
-
-    response = { result": {"access_token": "#######"}, ..}
-    """
-
-    headers = {
-        "X-MBL-COMPANY-ID": "infra-sisb",
-        "X-MBL-OS": "windows",
-        "X-MBL-CLIENT": "10",
-        "X-MBL-DID": "123451",
-        "Content-Type": "application/json",
-    }
-    payload = {"login_id": LOGIN_ID, "password": PASSWORD}
-    try:
-        response = requests.post(LOGIN_API_URL, headers=headers, json=payload)
-        print("Login response: ", response.status_code, response.text)
-        if response.status_code == 200:
-            return response.json().get("result", {}).get("access_token")
-        else:
-            return None
-    except Exception as e:
-        print("ログインAPI通信エラー:", e)
-        return None
-
-
-def upload_message(msg_id, tmp_text):
-    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute(
         """
@@ -124,84 +100,193 @@ def upload_message(msg_id, tmp_text):
         (msg_id,),
     )
     room_id = cursor.fetchone()
-    conn.close()
+    if room_id is None:
+        logger.error("upload_message 失敗！！ : 案件がありません %s", msg_id)
+        return False
     message_text = f"""指示: {room_id[1]}
 {room_id[2]}
 {tmp_text}"""
+    enqueue_message(conn, room_id[0], message_text)
+    return True
 
-    upload_message_token = get_access_token()
-    message_headers = {
-        "X-MBL-COMPANY-ID": "infra-sisb",
-        "X-MBL-OS": "windows",
-        "X-MBL-CLIENT": "10",
-        "X-MBL-DID": "123451",
-        "X-MBL-ACCESS-TOKEN": upload_message_token,
-        "Content-Type": "application/json",
-    }
+
+def send_message(room_id, text):
+    """
+    ルームのチャットに text を投稿する (outbox.py の送信スレッドから呼ばれる)
+    応答を返す。アクセストークンが取れなければ None
+    """
     message_payload = {
         "extra": "",
-        "roomIds": room_id[0],
-        "text": message_text,
+        "roomIds": room_id,
+        "text": text,
         "type": "text",
     }
-    try:
-        message_response = requests.post(
-            ELGANA_UPLOAD_URL, headers=message_headers, json=message_payload
-        )
-        print(
-            "upload_message 成功！！:",
-            message_response.status_code,
-            message_response.text,
+
+    def send(token):
+        return elgana_client.post(
+            ELGANA_UPLOAD_URL, headers=elgana_headers(token), json=message_payload
         )
-    except Exception as ume:
-        print("upload_message 失敗！！ :", ume)
-        traceback.print_exc()
+
+    with timed("outbound_message"):
+        return call_with_token(send)
 
 
+@timed("image_download")
 def download_image(room_id, file_id):
     """
-    room_id, file_id を指定した url で subproccess を用いて APIリクエストを行い、
-    ・画像のバイナリデータ
-    ・保存する際のファイル名                                             を返す
+    room_id, file_id を指定した url から画像を取得し、画像の保存先へそのまま流し込む
+    保存結果 (StoredImage：ファイル名・URL・サイズ・ハッシュ等) を返す。失敗時は None
     """
 
-    token = get_access_token()
-    if not token:
-        print("アクセストークン取得失敗")
-        return None, None
-
     url = f"{ELGANA_API_URL}?roomId={room_id}&fileId={file_id}"
-    tmp_path = f"/tmp/{file_id}.jpg"
+
+    def send(token):
+        return elgana_client.get(
+            url,
+            headers=elgana_headers(token, "application/octet-stream"),
+            stream=True,
+        )
 
     try:
-        headers = {
-            "X-MBL-COMPANY-ID": "infra-sisb",
-            "X-MBL-OS": "windows",
-            "X-MBL-CLIENT": "10",
-            "X-MBL-DID": "123451",
-            "X-MBL-ACCESS-TOKEN": token,
-            "Content-Type": "application/octet-stream",
-        }
-        response = requests.get(url, headers=headers)
+        response = call_with_token(send)
+        if response is None:
+            logger.error("アクセストークン取得失敗")
+            return None
 
-        if response.status_code == 200:
-            with open(tmp_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+        with response:
+            if response.status_code != 200:
+                logger.warning("download image error: %s", response.status_code)
+                return None
+            stored = get_image_store().save_stream(
+                response.iter_content(chunk_size=CHUNK_SIZE)
+            )
+        logger.debug(
+            "download image 保存: %s %s %s",
+            stored.filename,
+            stored.size,
+            "新規" if stored.created else "既存",
+        )
+        return stored
 
-        # 取得した jpg ファイルを開き、バイナリデータを image_data に格納
-        with open(tmp_path, "rb") as f:
-            image_data = f.read()
+    except ImageRejected as e:
+        logger.warning("download image 不正な画像: %s %s", file_id, e)
+        return None
+    except Exception as e:
+        logger.exception("download image error: %s", e)
+        return None
 
-        # kind.extention で判別したフォーマットの拡張子を返し、filename にfile_id.jpgを格納
-        filename = f"{file_id}.jpg"
-        return image_data, filename
 
-    except Exception as e:
-        print("download image error:", e)
-        traceback.print_exc()
-        return None, None
+def _get_download_pool():
+    global _download_pool, _download_pool_pid
+    with _download_pool_lock:
+        if _download_pool is None or _download_pool_pid != os.getpid():
+            _download_pool = ThreadPoolExecutor(
+                max_workers=IMAGE_DOWNLOAD_WORKERS,
+                thread_name_prefix="image-download",
+            )
+            _download_pool_pid = os.getpid()
+    return _download_pool
+
+
+def ingest_images(room_id, data, record):
+    """
+    画像メッセージの data に改行区切りで並ぶ file_id を並列にダウンロードし、
+    取得できた画像をまとめて record(images) で spot_info に記録する
+    file_id ごとの成否を結果に含め、1 枚も取れなければ 500 (再試行対象) を返す
+    """
+    file_ids = [line.strip() for line in data.split("\n") if line.strip()]
+    logger.debug("file_ids: %s", file_ids)
+    if not file_ids:
+        return {"error": "fileId not found"}, 400
+
+    pool = _get_download_pool()
+    results = list(pool.map(lambda file_id: download_image(room_id, file_id), file_ids))
+
+    files = []
+    images = []
+    for file_id, stored in zip(file_ids, results):
+        if stored:
+            logger.debug("✅ 成功 fileId: %s", file_id)
+            images.append(stored)
+            files.append({"file_id": file_id, "ok": True, "filename": stored.filename})
+        else:
+            logger.warning("❌ 画像取得に失敗 fileId: %s", file_id)
+            files.append({"file_id": file_id, "ok": False})
+
+    if not images:
+        return {"error": "Failed to download image", "files": files}, 500
+    record(images)
+    generate_derivatives(images)
+    if len(images) < len(file_ids):
+        return {"message": "insert_image partially failed", "files": files}, 207
+    return {"message": "insert_image successfully", "files": files}, 200
+
+
+def generate_derivatives(images):
+    """
+    保存した画像のサムネイル・中サイズ画像の生成をプロセスプールに投げる
+    同じ画像 (同じファイル名) の派生画像が既にあればそれを使い回す
+    """
+    store = get_image_store()
+    conn = get_db()
+    for stored in images:
+        row = conn.execute(
+            """
+            SELECT thumb_url, thumb_width, thumb_height,
+                medium_url, medium_width, medium_height
+            FROM spot_info
+            WHERE image_filename = ?
+                AND thumb_url IS NOT NULL
+            LIMIT 1
+        """,
+            (stored.filename,),
+        ).fetchone()
+        if row:
+            record_derivatives(
+                stored,
+                {"thumb": tuple(row[0:3]), "medium": tuple(row[3:6])},
+            )
+            continue
+        try:
+            image_derivatives.submit(store, stored, record_derivatives)
+        except Exception as e:
+            logger.exception("derivatives 投入失敗！！ %s: %s", stored.filename, e)
+
+
+def record_derivatives(stored, derivatives):
+    """
+    派生画像の URL と寸法を、その画像を参照する spot_info 行に記録
+    失敗時は例外を送出する (image_derivatives.submit の完了処理が記録する)
+    """
+    thumb_url, thumb_width, thumb_height = derivatives["thumb"]
+    medium_url, medium_width, medium_height = derivatives["medium"]
+
+    def write(conn):
+        conn.execute(
+            """
+            UPDATE spot_info
+            SET
+                thumb_url = ?,
+                thumb_width = ?,
+                thumb_height = ?,
+                medium_url = ?,
+                medium_width = ?,
+                medium_height = ?
+            WHERE image_filename = ?
+        """,
+            (
+                thumb_url,
+                thumb_width,
+                thumb_height,
+                medium_url,
+                medium_width,
+                medium_height,
+                stored.filename,
+            ),
+        )
+
+    get_writer().run(write)
+    logger.debug("record_derivatives 成功！！ %s", stored.filename)
 
 
 def insert_info(
@@ -209,12 +294,12 @@ def insert_info(
 ):
     """
     ./location.db の operation_orders テーブルにデータを挿入
+    書き込みに失敗したら WriteBatcher の例外をそのまま送出する (以下の insert_* / update_* も同じ)
     """
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
+
+    def write(conn):
+        conn.execute(
             """
             INSERT INTO operation_orders (msg_id, room_id, user_id, instruction_id, instruction, status, urgency, customer_info, remarks, received_at)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -232,65 +317,73 @@ def insert_info(
                 now_str,
             ),
         )
-        print("insert_info 成功！！")
-    except Exception as iie:
-        print("insert_info 失敗！！ ", iie)
-        traceback.print_exc()
-    finally:
-        conn.commit()
-        conn.close()
+
+    get_writer().run(write)
+    logger.debug("insert_info 成功！！")
 
 
 def insert_locations(message_id, room_id, user_id, latitude, longitude):
     """
     ./location.db の operation_orders テーブルの該当のカラムに latitude, logitude を追加する
+    近くに未完了の案件があれば duplicate_of にその msg_id を記録して返す
     """
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
+
+    def write(conn):
+        duplicate_of = find_duplicate(conn, message_id, latitude, longitude)
+        conn.execute(
             """
-            INSERT INTO operation_orders (msg_id, room_id, user_id, location_id, latitude, longitude, received_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO operation_orders (msg_id, room_id, user_id, location_id, latitude, longitude, received_at, duplicate_of)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """,
-            (message_id, room_id, user_id, message_id, latitude, longitude, now_str),
+            (
+                message_id,
+                room_id,
+                user_id,
+                message_id,
+                latitude,
+                longitude,
+                now_str,
+                duplicate_of,
+            ),
         )
-        print("insert_locations 成功！！")
-    except Exception as ile:
-        print("insert_locations 失敗！！ ", ile)
-        traceback.print_exc()
-    finally:
-        conn.commit()
-        conn.close()
+        return duplicate_of
 
+    duplicate_of = get_writer().run(write)
+    logger.debug("insert_locations 成功！！")
+    if duplicate_of:
+        logger.info("重複の可能性あり： %s -> %s", message_id, duplicate_of)
+    return duplicate_of
 
-def insert_image(message_id, room_id, user_id, filename):
+
+def insert_image(message_id, room_id, user_id, images):
+    """
+    画像メッセージ 1 件分の operation_orders 行と、画像ごとの spot_info 行を挿入
+    images：保存済み画像 (StoredImage) のリスト
+    """
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
+
+    def write(conn):
+        conn.execute(
             """
             INSERT INTO operation_orders (msg_id, room_id, user_id, received_at)
             VALUES (?, ?, ?, ?)
         """,
             (message_id, room_id, user_id, now_str),
         )
-        cursor.execute(
+        conn.executemany(
             """
-            INSERT INTO spot_info (msg_id, image_id, image_filename, deleted)
-            VALUES (?, ?, ?, ?)
+            INSERT INTO spot_info (msg_id, image_id, image_url, image_filename, deleted)
+            VALUES (?, ?, ?, ?, ?)
         """,
-            (message_id, message_id, filename, "0"),
+            [
+                (message_id, message_id, image.url, image.filename, "0")
+                for image in images
+            ],
         )
-        print("insert_image 成功！！")
-    except Exception as iie:
-        print("insert_image 失敗！！ ", iie)
-        traceback.print_exc()
-    finally:
-        conn.commit()
-        conn.close()
+
+    get_writer().run(write)
+    logger.debug("insert_image 成功！！")
 
 
 def update_info(
@@ -298,10 +391,9 @@ def update_info(
 ):
     regist = []
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
+
+    def write(conn):
+        conn.execute(
             """
             UPDATE operation_orders
             SET
@@ -334,35 +426,32 @@ def update_info(
         #     WHERE msg_id = ?
         # """, (remessage_id,))
         # regist = cursor.fetchone()
-        print("update_info 成功！！")
-    except Exception as uie:
-        print("update_info 失敗！！ ", uie)
-        traceback.print_exc()
-    finally:
-        conn.commit()
-        conn.close()
-        # if regist[0] is not None and regist[1] is not None:
-        #     insert_completed(remessage_id)
+
+    get_writer().run(write)
+    logger.debug("update_info 成功！！")
+    # if regist[0] is not None and regist[1] is not None:
+    #     insert_completed(remessage_id)
 
 
 def update_locations(remessage_id, message_id, latitude, longitude):
     regist = []
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
+
+    def write(conn):
+        duplicate_of = find_duplicate(conn, remessage_id, latitude, longitude)
+        conn.execute(
             """
             UPDATE operation_orders
             SET
                 location_id = ?,
                 latitude = ?,
                 longitude = ?,
-                update_at = ?
+                update_at = ?,
+                duplicate_of = ?
             WHERE
                 msg_id = ?
         """,
-            (message_id, latitude, longitude, now_str, remessage_id),
+            (message_id, latitude, longitude, now_str, duplicate_of, remessage_id),
         )
         # cursor.execute("""
         #     SELECT
@@ -371,30 +460,36 @@ def update_locations(remessage_id, message_id, latitude, longitude):
         #     WHERE msg_id = ?
         # """, (remessage_id,))
         # regist = cursor.fetchone()
-        print("update_locations 成功！！")
-    except Exception as ule:
-        print("update_locations 失敗！！ ", ule)
-        traceback.print_exc()
-    finally:
-        conn.commit()
-        conn.close()
-        # if regist[0] is not None:
-        #     insert_completed(remessage_id)
+        return duplicate_of
 
+    duplicate_of = get_writer().run(write)
+    logger.debug("update_locations 成功！！")
+    if duplicate_of:
+        logger.info("重複の可能性あり： %s -> %s", remessage_id, duplicate_of)
+    return duplicate_of
+    # if regist[0] is not None:
+    #     insert_completed(remessage_id)
 
-def update_image(remessage_id, message_id, filename):
+
+def update_image(remessage_id, message_id, images):
+    """
+    返信の画像を元メッセージの spot_info 行として画像ごとに挿入
+    images：保存済み画像 (StoredImage) のリスト
+    """
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
+
+    def write(conn):
+        conn.executemany(
             """
-            INSERT INTO spot_info (msg_id, image_id, image_filename, deleted)
-            VALUES (?, ?, ?, ?)
+            INSERT INTO spot_info (msg_id, image_id, image_url, image_filename, deleted)
+            VALUES (?, ?, ?, ?, ?)
         """,
-            (remessage_id, message_id, filename, "0"),
+            [
+                (remessage_id, message_id, image.url, image.filename, "0")
+                for image in images
+            ],
         )
-        cursor.execute(
+        conn.execute(
             """
             UPDATE operation_orders
             SET 
@@ -403,62 +498,167 @@ def update_image(remessage_id, message_id, filename):
         """,
             (now_str, remessage_id),
         )
-        print("update_image 成功！！")
-    except Exception as uie:
-        print("update_image 失敗！！ ", uie)
-        traceback.print_exc()
-    finally:
-        conn.commit()
-        conn.close()
 
+    get_writer().run(write)
+    logger.debug("update_image 成功！！")
 
-def parse_body_text(body_text):
-    fields = {
-        "①指示": "",
-        "②状況": "",
-        "③緊急度": "",
-        "④お客様情報": "",
-        "⑤備考": "",
-    }
-    for line in body_text.splitlines():
-        for key in fields.keys():
-            if line.startswith(f"【{key}】"):
-                fields[key] = line.replace(f"【{key}】", "").strip()
-            elif key == "⑤備考" and line.startswith("【⑤浦考】"):
-                fields["⑤備考"] = line.replace("【⑤浦考】", "").strip()
-    return fields
 
-
-@app.route("/elgana_api", methods=["POST"])
+@api.route("/elgana_api", methods=["POST"])
 def elgana_api():
-    data = request.get_json()
-    print("Received JSON:", json.dumps(data, indent=2, ensure_ascii=False))
+    """
+    webhook の受け口
+    形式だけ確認してジョブキューに積み、処理の完了を待たずに 200 を返す
+    """
+    data = request.get_json(silent=True)
+    # 受信内容の記録は重いので、DEBUG の時に LOG_PAYLOAD_SAMPLE の割合だけ行う
+    if logger.isEnabledFor(logging.DEBUG) and sample_payload():
+        logger.debug("Received JSON", extra={"payload": data})
 
     if (
         not data
         or "msg" not in data
         or "body" not in data["msg"]
-        or data["tag"] == "onReadUpdate"
+        or data.get("tag") == "onReadUpdate"
     ):
         return jsonify({"error": "Invalid JSON format"}), 400
+    if any(key not in data["msg"] for key in ("roomId", "userId", "id")):
+        return jsonify({"error": "Invalid JSON format"}), 400
+
+    # 再送されたメッセージは積まずに 200 を返し、それ以上再送させない
+    job_id, created = job_queue.enqueue(data, message_id=data["msg"]["id"])
+    if not created:
+        logger.info("重複した webhook のため無視： %s", data["msg"]["id"])
+        return jsonify({"message": "duplicate", "job_id": job_id}), 200
+    return jsonify({"message": "accepted", "job_id": job_id}), 200
+
+
+@api.route("/ingest_stats", methods=["GET"])
+def ingest_stats():
+    return jsonify(
+        {
+            **job_queue.stats(),
+            # writer・outbox の回数は応答したワーカーの分
+            "pid": os.getpid(),
+            "writer": get_writer().stats(),
+            "outbox": notifications.stats(),
+        }
+    )
+
+
+@api.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    処理時間・回数を Prometheus のテキスト形式で返す (metrics.py)
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def collect_gauges():
+    """
+    /metrics に載せる現在値 (キュー・書き込み・配信・キャッシュ・トークン)
+    """
+    queue_stats = job_queue.stats()
+    writer_stats = get_writer().stats()
+    outbox_stats = notifications.stats()
+    feed_stats = change_feed.stats()
+    cache_stats = locations_cache.stats()
+    token_stats = elgana_client.token_cache.stats()
+    return {
+        "ingest_queue_depth": ("gauge", "Pending webhook jobs", queue_stats["depth"]),
+        "ingest_jobs_dead": ("gauge", "Webhook jobs that gave up", queue_stats["dead"]),
+        "ingest_oldest_pending_seconds": (
+            "gauge",
+            "Age of the oldest pending job",
+            queue_stats["oldest_pending_age"],
+        ),
+        "ingest_duplicates_total": (
+            "counter",
+            "Redelivered webhooks rejected",
+            queue_stats["duplicates"],
+        ),
+        "outbox_depth": ("gauge", "Pending chat notifications", outbox_stats["depth"]),
+        "outbox_dead": ("gauge", "Chat notifications that gave up", outbox_stats["dead"]),
+        "outbox_oldest_pending_seconds": (
+            "gauge",
+            "Age of the oldest unsent notification",
+            outbox_stats["oldest_pending_age"],
+        ),
+        "db_writer_pending": (
+            "gauge",
+            "Writes waiting for the writer thread",
+            writer_stats["pending"],
+        ),
+        "db_writer_writes_total": (
+            "counter",
+            "Writes executed by the writer thread",
+            writer_stats["writes"],
+        ),
+        "db_writer_batches_total": (
+            "counter",
+            "Transactions committed by the writer thread",
+            writer_stats["batches"],
+        ),
+        "events_subscribers": (
+            "gauge",
+            "Connected /events clients",
+            feed_stats["subscribers"],
+        ),
+        "locations_cache_hits_total": (
+            "counter",
+            "get_locations cached body hits",
+            cache_stats["hits"],
+        ),
+        "locations_cache_builds_total": (
+            "counter",
+            "get_locations bodies built",
+            cache_stats["builds"],
+        ),
+        "locations_cache_bytes": (
+            "gauge",
+            "get_locations cached bodies incl. compressed copies",
+            cache_stats["bytes"],
+        ),
+        "token_cache_misses_total": (
+            "counter",
+            "Access token cache misses",
+            token_stats["misses"],
+        ),
+        "token_cache_failures_total": (
+            "counter",
+            "Access token fetch failures",
+            token_stats["failures"],
+        ),
+    }
+
+
+metrics.register_collector(collect_gauges)
 
+
+def handle_message(data):
+    """
+    ジョブキューのワーカーから呼ばれ、webhook 1 件を処理する
+    (結果の dict, ステータスコード) を返し、5xx の場合は再試行される
+    DB への書き込みの失敗は握りつぶさずに送出し、ジョブキューに再試行させる
+    """
     msg = data["msg"]
     body_text = msg["body"]
     room_id = msg["roomId"]
     user_id = msg["userId"]
     message_id = msg["id"]
 
-    print("Raw body_text:\n", body_text)
+    logger.debug("Raw body_text: %s", body_text)
+    with timed("parse"):
+        parsed = parse_message(msg)
+    fields = parsed.fields
 
     if not msg.get("reMsg"):
-        if "指示" in body_text and "状況" in body_text and "緊急度" in body_text:
-            fields = parse_body_text(body_text)
+        if parsed.kind == "report":
             instruction = fields["①指示"]
             status = fields["②状況"]
             urgency = fields["③緊急度"]
             customer_info = fields["④お客様情報"]
             remarks = fields["⑤備考"]
-            print(f"Parsed fields: {fields}")
+            logger.debug("Parsed fields: %s", fields)
             insert_info(
                 message_id,
                 room_id,
@@ -469,53 +669,45 @@ def elgana_api():
                 customer_info,
                 remarks,
             )
-            return jsonify({"message": "insert_info successfully"}), 200
+            return {"message": "insert_info successfully"}, 200
 
-        if "位置情報を送信しました" in body_text and msg["extra"]:
+        if parsed.kind == "location":
             extra_data = json.loads(msg["extra"])
             latitude = extra_data.get("lat")
             longitude = extra_data.get("lon")
             if latitude is not None and longitude is not None:
                 insert_locations(message_id, room_id, user_id, latitude, longitude)
-                return jsonify({"message": "insert_message successfully"}), 200
+                return {"message": "insert_message successfully"}, 200
             else:
-                return jsonify({"error": "Latitude or longitude not found"}), 400
-
-        if msg["type"] == "image":
-            file_lines = msg.get("data", "").split("\n")
-            print("file_lines:", file_lines)
-            for file_id_candidate in file_lines:
-                print(f"試行 fileId: {file_id_candidate}")
-                image_data, filename = download_image(room_id, file_id_candidate)
-                if image_data:
-                    print(f"✅ 成功 fileId: {file_id_candidate}")
-                    insert_image(message_id, room_id, user_id, filename)
-                    return jsonify({"message": "insert_image successfully"}), 200
-                else:
-                    print("❌ 画像取得に失敗（全fileId試行済）")
-                    return jsonify({"error": "Failed to download image"}), 500
-
-        if "テストカルーセル" == body_text:
+                return {"error": "Latitude or longitude not found"}, 400
+
+        if parsed.kind == "image":
+            return ingest_images(
+                room_id,
+                msg.get("data", ""),
+                lambda images: insert_image(message_id, room_id, user_id, images),
+            )
+
+        if parsed.kind == "carousel":
             carousel_result = upload_carousel(room_id)
             if carousel_result:
-                print("upload_carousel success!!")
-                return jsonify({"message": "uploadcarousel successfully"}), 200
+                logger.debug("upload_carousel success!!")
+                return {"message": "uploadcarousel successfully"}, 200
             else:
-                print("upload_carousel failed...")
-                return jsonify({"error": "Failed to upload carousel"}), 500
+                logger.error("upload_carousel failed...")
+                return {"error": "Failed to upload carousel"}, 500
 
-        return jsonify({"error": "Message ignored"}), 400
+        return {"error": "Message ignored"}, 400
 
     elif msg.get("reMsg") and msg.get("reMsg") != "0":
         remessage_id = msg["reMsg"]
-        if "指示" in body_text and "状況" in body_text and "緊急度" in body_text:
-            fields = parse_body_text(body_text)
+        if parsed.kind == "report":
             instruction = fields["①指示"]
             status = fields["②状況"]
             urgency = fields["③緊急度"]
             customer_info = fields["④お客様情報"]
             remarks = fields["⑤備考"]
-            print(f"Parsed fields: {fields}")
+            logger.debug("Parsed fields: %s", fields)
             update_info(
                 remessage_id,
                 message_id,
@@ -525,132 +717,617 @@ def elgana_api():
                 customer_info,
                 remarks,
             )
-            return jsonify({"message": "insert_info successfully"}), 200
+            return {"message": "insert_info successfully"}, 200
 
-        if "位置情報を送信しました" in body_text and msg["extra"]:
+        if parsed.kind == "location":
             extra_data = json.loads(msg["extra"])
             latitude = extra_data.get("lat")
             longitude = extra_data.get("lon")
             if latitude is not None and longitude is not None:
                 update_locations(remessage_id, message_id, latitude, longitude)
-                return jsonify({"message": "insert_message successfully"}), 200
+                return {"message": "insert_message successfully"}, 200
             else:
-                return jsonify({"error": "Latitude or longitude not found"}), 400
+                return {"error": "Latitude or longitude not found"}, 400
 
-        if msg["type"] == "image":
-            file_lines = msg.get("data", "").split("\n")
-            print("file_lines:", file_lines)
-            for file_id_candidate in file_lines:
-                print(f"試行 fileId: {file_id_candidate}")
-                image_data, filename = download_image(room_id, file_id_candidate)
-                if image_data:
-                    print(f"✅ 成功 fileId: {file_id_candidate}")
-                    update_image(remessage_id, message_id, filename)
-                    return jsonify({"message": "insert_image successfully"}), 200
-                else:
-                    print("❌ 画像取得に失敗（全fileId試行済）")
-                    return jsonify({"error": "Failed to download image"}), 500
+        if parsed.kind == "image":
+            return ingest_images(
+                room_id,
+                msg.get("data", ""),
+                lambda images: update_image(remessage_id, message_id, images),
+            )
+
+        return {"error": "reMessage ignored"}, 400
 
-        return jsonify({"error": "reMessage ignored"}), 400
+    return {"error": "Message ignored"}, 400
 
-    return jsonify({"error": "Message ignored"}), 400
+
+job_queue = JobQueue(handle_message)
+# /completed などの通知の送信 (outbox.py)
+notifications = OutboxDispatcher(send_message)
 
 
 class DictCursor(sqlite3.Cursor):
+    def __init__(self, *args):
+        super().__init__(*args)
+        # sqlite3.Row を経由せずタプルから dict にする (件数の多い /get_locations で効く)
+        self.row_factory = None
+
     def fetchall_dict(self):
-        return list(map(dict, self.fetchall()))
+        rows = self.fetchall()
+        if not rows:
+            return []
+        names = [column[0] for column in self.description]
+        return [dict(zip(names, row)) for row in rows]
 
 
-@app.route("/get_locations", methods=["GET"])
+# /get_locations の status で指定できる operation_status
+OPERATION_STATUSES = ("0", "1", "2", "3")
+
+
+def parse_bbox(value):
+    """
+    "南端緯度,西端経度,北端緯度,東端経度" を (south, west, north, east) にする
+    値が不正なら ValueError
+    """
+    try:
+        south, west, north, east = (float(v) for v in value.split(","))
+    except ValueError:
+        raise ValueError("bbox is not correct")
+    if south > north or west > east:
+        raise ValueError("bbox is not correct")
+    return south, west, north, east
+
+
+def parse_locations_filters(args):
+    """
+    /get_locations のクエリパラメータを operation_orders の絞り込み条件にする
+    (条件式の list, パラメータの list, updated_since) を返す
+    値が不正なら ValueError
+    """
+    where = []
+    params = []
+
+    since = args.get("updated_since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            raise ValueError("updated_since is not correct")
+
+    def column(name, selective=True):
+        # 統計 (ANALYZE) が無いと SQLite は等号の付く索引を選びがちなので、
+        # より絞り込める条件がある時は + を付けてその列の索引を使わせない
+        # (差分は row_seq、それ以外は表示範囲・ルームの索引から引く)
+        return name if since is None and selective else f"+{name}"
+
+    bbox = args.get("bbox")
+    if bbox:
+        south, west, north, east = parse_bbox(bbox)
+        where.append(
+            f"{column('latitude')} BETWEEN ? AND ? "
+            f"AND {column('longitude')} BETWEEN ? AND ?"
+        )
+        params += [south, north, west, east]
+
+    room_id = args.get("room_id")
+    if room_id:
+        where.append(f"{column('room_id')} = ?")
+        params.append(room_id)
+
+    status = args.get("status")
+    if status:
+        statuses = sorted(set(status.split(",")))
+        if not set(statuses) <= set(OPERATION_STATUSES):
+            raise ValueError("status is not correct")
+        # 状態は 4 通りしかないので、表示範囲がある時はそちらから引く
+        # (ルームとの組み合わせは idx_operation_orders_room_status を使う)
+        column_name = column("operation_status", selective=not bbox)
+        where.append(f"{column_name} IN ({', '.join('?' * len(statuses))})")
+        params += statuses
+
+    if since is not None:
+        # 前回以降に変わった案件だけ (spot_info・user_info の変更も row_seq に反映される)
+        where.append("row_seq > ?")
+        params.append(since)
+
+    return where, params, since
+
+
+# /get_locations の組み立て済み応答 (seq が変わるまで使い回す)
+locations_cache = ResponseCache()
+
+
+@api.route("/get_locations", methods=["GET"])
 def get_locations():
+    """
+    operation_orders と spot_info を一括取得して地図用 JSON を返す
+    spot_info は 1 回のクエリで全件取得し、msg_id ごとに振り分ける
+    operation_status と画像の区分 (bucket) は書き込み時に計算済みのものを使う (migrations.py v9)
+
+    データのバージョン (seq) が同じ間は組み立て済みの本文を返し、
+    ETag が一致すれば 304、Accept-Encoding に応じて gzip / brotli で圧縮する (response_cache.py)
+
+    絞り込み (いずれも省略可)
+    bbox：南端緯度,西端経度,北端緯度,東端経度 (LatLngBounds.toUrlValue() の形)
+    room_id：ルーム ID
+    status：operation_status (0〜3、カンマ区切りで複数可)
+    updated_since：前回の応答の seq
+    include_archived：1 ならアーカイブ (archive.py) に移した案件も返す (updated_since とは併用不可)
+
+    updated_since なし：案件の配列 (seq は X-Locations-Seq ヘッダー)
+    updated_since あり：{"seq", "locations": 変わった案件,
+                         "removed": 削除された・条件から外れた案件の msg_id}
+    """
+    try:
+        where, params, since = parse_locations_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    include_archived = request.args.get("include_archived") == "1"
+    if include_archived and since is not None:
+        # アーカイブに移した案件は差分では removed になるので、差分とは組み合わせない
+        return (
+            jsonify({"error": "include_archived cannot be used with updated_since"}),
+            400,
+        )
+
+    conn = get_db()
+    # seq を最初に読む。書き込みは 1 つずつ確定するので、この seq までの変更は
+    # 以降の SELECT に必ず含まれる (後の変更が混ざっても次の差分で同じ案件を返すだけ)
+    seq = conn.execute(
+        "SELECT seq FROM sync_state WHERE name = 'locations'"
+    ).fetchone()[0]
+
+    def build():
+        with timed("db_query"):
+            payload = query_locations(conn, where, params, since, include_archived)
+        headers = {}
+        if since is None:
+            headers["X-Locations-Seq"] = str(seq)
+            # 別オリジンのフロントエンドからも読めるようにする
+            headers["Access-Control-Expose-Headers"] = "X-Locations-Seq"
+        else:
+            payload = {"seq": seq, **payload}
+        return current_app.json.response(payload).get_data(), headers
+
+    key = tuple(sorted(request.args.items(multi=True)))
+    return locations_cache.respond(request, key, seq, build)
+
+
+def query_locations(conn, where, params, since, include_archived=False):
+    """
+    /get_locations の中身を組み立てる
+    updated_since なしは案件の list、ありは {"locations", "removed"} を返す
+    include_archived=True ならアーカイブ (archive.py) の案件も続けて返す
+    """
     locations = []
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
     cursor = conn.cursor(factory=DictCursor)
-    cursor.execute(
-        """
-        SELECT
-            msg_id,
-            latitude,
-            longitude,
-            instruction,
-            status,
-            urgency,
-            customer_info,
-            remarks,
-            completed,
-            signal,
-            received_at,
-            update_at
-        FROM operation_orders
-    """
-    )
-    operations = cursor.fetchall_dict()
-    for operation in operations:
-        signal = operation.get("signal")
-        msg_id = operation.get("msg_id")
-        if signal == "0":
-            continue
-        discovery_image_dict_list = []
-        before_image_dict_list = []
-        after_image_dict_list = []
+    changed = set()
+    if since is not None:
         cursor.execute(
             """
-        SELECT
-            s.repair_required,
-            s.height,
-            s.width,
-            s.depth,
-            s.image_url,
-            s.status_flag,
-            s.deleted,
-            s.cost,
-            s.term,
-            u.user_name,
-            u.org,
-            u.email_address,
-            s.create_at
-        FROM spot_info AS s
-        INNER JOIN user_info AS u ON s.user_id = u.user_id
-        WHERE s.msg_id = ?
+            SELECT msg_id FROM operation_orders WHERE row_seq > ?
+            UNION
+            SELECT msg_id FROM order_tombstones WHERE seq > ?
         """,
-            (msg_id,),
+            (since, since),
+        )
+        changed = {row["msg_id"] for row in cursor.fetchall_dict()}
+
+    schemas = ["main"]
+    if include_archived and attach_archive(conn):
+        schemas.append("archive")
+    order_filter = f"WHERE {' AND '.join(where)}" if where else ""
+    # 非表示 (signal = '0') の案件は返さない
+    visible = "AND" if where else "WHERE"
+    operations = []
+    # msg_id ごとに (発見, 作業前, 作業後) の画像リストを振り分ける
+    spot_buckets = {}
+    for schema in schemas:
+        cursor.execute(
+            f"""
+            SELECT
+                msg_id,
+                latitude,
+                longitude,
+                instruction,
+                status,
+                urgency,
+                customer_info,
+                remarks,
+                completed,
+                signal,
+                received_at,
+                update_at,
+                duplicate_of,
+                operation_status
+            FROM {schema}.operation_orders
+            {order_filter} {visible} signal IS NOT '0'
+        """,
+            params,
+        )
+        operations += cursor.fetchall_dict()
+        spot_filter = ""
+        if where:
+            spot_filter = (
+                "AND s.msg_id IN "
+                f"(SELECT msg_id FROM {schema}.operation_orders {order_filter})"
+            )
+        cursor.execute(
+            f"""
+            SELECT
+                s.msg_id,
+                s.bucket,
+                s.repair_required,
+                s.height,
+                s.width,
+                s.depth,
+                s.image_url,
+                s.status_flag,
+                s.deleted,
+                s.cost,
+                s.term,
+                u.user_name,
+                u.org,
+                u.email_address,
+                s.create_at,
+                s.thumb_url,
+                s.thumb_width,
+                s.thumb_height,
+                s.medium_url,
+                s.medium_width,
+                s.medium_height
+            FROM {schema}.spot_info AS s
+            INNER JOIN user_info AS u ON s.user_id = u.user_id
+            WHERE s.msg_id IS NOT NULL AND s.bucket IS NOT NULL {spot_filter}
+            ORDER BY s.id
+            """,
+            params,
+        )
+        for spot in cursor.fetchall_dict():
+            msg_id = spot.pop("msg_id")
+            buckets = spot_buckets.setdefault(msg_id, ([], [], []))
+            buckets[spot.pop("bucket")].append(spot)
+
+    for operation in operations:
+        discovery_image_dict_list, before_image_dict_list, after_image_dict_list = (
+            spot_buckets.get(operation.get("msg_id"), ([], [], []))
         )
-        spots = cursor.fetchall_dict()
-        if spots:
-            for spot in spots:
-                repair_required = spot.get("repair_required")
-                status_flag = spot.get("status_flag")
-                if status_flag == "0":
-                    discovery_image_dict_list.append(spot)
-                elif status_flag == "1":
-                    if repair_required == "true":
-                        before_image_dict_list.append(spot)
-                    elif repair_required == "false":
-                        after_image_dict_list.append(spot)
-
-        if operation["completed"]:
-            operation_status = "3"
-        elif after_image_dict_list:
-            operation_status = "2"
-        elif before_image_dict_list:
-            operation_status = "1"
-        else:
-            operation_status = "0"
-        operation["operation_status"] = operation_status
         operation["discovery_images"] = discovery_image_dict_list
         operation["before_images"] = before_image_dict_list
         operation["after_images"] = after_image_dict_list
         locations.append(operation)
-    conn.close()
-    return jsonify(locations)
+
+    if since is None:
+        return locations
+    returned = {operation["msg_id"] for operation in locations}
+    removed = sorted(msg_id for msg_id in changed - returned if msg_id is not None)
+    return {"locations": locations, "removed": removed}
+
+
+@api.route("/get_clusters", methods=["GET"])
+def get_clusters():
+    """
+    ズームの低い地図用に、表示範囲の案件をグリッドのセルごとにまとめて返す
+    map_cells (migrations.py v7) の集計を読むだけなので、案件数によらず表示範囲のセル数で決まる
+
+    zoom：地図のズーム (集計のある最大ズームを超える場合はそこで集計)
+    bbox：南端緯度,西端経度,北端緯度,東端経度
+
+    {"zoom", "clusters": [{"latitude", "longitude", "count",
+                           "urgency": {緊急度: 件数}, "operation_status": {状態: 件数}}]}
+    latitude / longitude はセル内の案件の重心
+    """
+    try:
+        zoom = int(request.args.get("zoom", ""))
+        south, west, north, east = parse_bbox(request.args.get("bbox", ""))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = get_db()
+    level = conn.execute(
+        "SELECT z, cell_deg FROM map_zoom_levels ORDER BY ABS(z - ?) LIMIT 1",
+        (zoom,),
+    ).fetchone()
+    cell_deg = level["cell_deg"]
+    cursor = conn.cursor(factory=DictCursor)
+    with timed("db_query"):
+        cursor.execute(
+            """
+            SELECT cx, cy, urgency, operation_status, n, lat_sum, lon_sum
+            FROM map_cells
+            WHERE z = ? AND cx BETWEEN ? AND ? AND cy BETWEEN ? AND ?
+        """,
+            (
+                level["z"],
+                int((west + 180) / cell_deg),
+                int((east + 180) / cell_deg),
+                int((south + 90) / cell_deg),
+                int((north + 90) / cell_deg),
+            ),
+        )
+        rows = cursor.fetchall_dict()
+
+    # 緊急度・状態ごとに分かれている行をセルごとに合算する
+    cells = {}
+    for row in rows:
+        cell = cells.setdefault(
+            (row["cx"], row["cy"]),
+            {
+                "count": 0,
+                "lat_sum": 0.0,
+                "lon_sum": 0.0,
+                "urgency": {},
+                "operation_status": {},
+            },
+        )
+        cell["count"] += row["n"]
+        cell["lat_sum"] += row["lat_sum"]
+        cell["lon_sum"] += row["lon_sum"]
+        urgency, operation_status = row["urgency"], row["operation_status"]
+        cell["urgency"][urgency] = cell["urgency"].get(urgency, 0) + row["n"]
+        cell["operation_status"][operation_status] = (
+            cell["operation_status"].get(operation_status, 0) + row["n"]
+        )
+
+    clusters = []
+    for cell in cells.values():
+        clusters.append(
+            {
+                "latitude": cell.pop("lat_sum") / cell["count"],
+                "longitude": cell.pop("lon_sum") / cell["count"],
+                **cell,
+            }
+        )
+    return jsonify({"zoom": level["z"], "clusters": clusters})
+
+
+@api.route("/nearby", methods=["GET"])
+def nearby():
+    """
+    指定した地点から radius メートル以内の案件を近い順に返す (spatial.py)
+
+    lat / lon：中心の緯度経度
+    radius：半径 (メートル、省略時 50)
+    open_only：1 なら未完了の案件だけ
+    exclude：除く msg_id (省略可)
+    """
+    try:
+        latitude = float(request.args.get("lat", ""))
+        longitude = float(request.args.get("lon", ""))
+        radius = float(request.args.get("radius", "50"))
+    except ValueError:
+        return jsonify({"error": "lat, lon and radius must be numbers"}), 400
+    if not 0 < radius <= NEARBY_MAX_RADIUS_M:
+        return jsonify({"error": f"radius must be 0-{NEARBY_MAX_RADIUS_M:g}"}), 400
+
+    with timed("db_query"):
+        orders = find_nearby(
+            get_db(),
+            latitude,
+            longitude,
+            radius,
+            exclude_msg_id=request.args.get("exclude"),
+            open_only=request.args.get("open_only") == "1",
+        )
+    return jsonify({"orders": orders})
+
+
+def parse_date_bound(value, name, end=False):
+    """
+    "YYYY-MM-DD" または "YYYY-MM-DD HH:MM:SS" を received_at などと比べられる文字列にする
+    end=True で日付だけの場合はその日の終わりまでを含める
+    値が不正なら ValueError
+    """
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} is not correct")
+    if end and len(value) == 10:
+        return parsed.strftime("%Y-%m-%d 23:59:59")
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_export_filters(args):
+    """
+    /export のクエリパラメータを export.py の絞り込み条件 (o. で operation_orders を参照) にする
+    (条件式の list, パラメータの list) を返す。値が不正なら ValueError
+    """
+    where = []
+    params = []
+
+    room_id = args.get("room_id")
+    if room_id:
+        where.append("o.room_id = ?")
+        params.append(room_id)
+
+    status = args.get("status")
+    if status:
+        statuses = sorted(set(status.split(",")))
+        if not set(statuses) <= set(OPERATION_STATUSES):
+            raise ValueError("status is not correct")
+        where.append(f"o.operation_status IN ({', '.join('?' * len(statuses))})")
+        params += statuses
+
+    # 受信日・完了日の範囲 (両端を含む)
+    for column in ("received_at", "completed"):
+        prefix = "received" if column == "received_at" else "completed"
+        start = args.get(f"{prefix}_from")
+        if start:
+            where.append(f"o.{column} >= ?")
+            params.append(parse_date_bound(start, f"{prefix}_from"))
+        end = args.get(f"{prefix}_to")
+        if end:
+            where.append(f"o.{column} <= ?")
+            params.append(parse_date_bound(end, f"{prefix}_to", end=True))
+
+    return where, params
+
+
+# /export/orders.<形式> の (生成器, Content-Type)
+EXPORT_FORMATS = {
+    "csv": (export_csv, "text/csv"),
+    "geojson": (export_geojson, "application/geo+json"),
+}
+
+
+@api.route("/export/orders.<fmt>", methods=["GET"])
+def export_orders(fmt):
+    """
+    案件と現場写真・作業者をまとめて CSV / GeoJSON で出力する (export.py)
+    全件を組み立てずに 1 行ずつ流すので、件数が多くてもメモリは増えない
+
+    絞り込み (いずれも省略可)
+    room_id：ルーム ID
+    status：operation_status (0〜3、カンマ区切りで複数可)
+    received_from / received_to：受信日時の範囲 (YYYY-MM-DD または YYYY-MM-DD HH:MM:SS)
+    completed_from / completed_to：完了日時の範囲 (同上)
+    include_archived：1 ならアーカイブ (archive.py) に移した案件も出す
+    """
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format must be csv or geojson"}), 404
+    try:
+        where, params = parse_export_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    generate, mimetype = EXPORT_FORMATS[fmt]
+    filename = f"orders-{datetime.now(ZoneInfo('Asia/Tokyo')):%Y%m%d-%H%M%S}.{fmt}"
+    return Response(
+        generate(
+            where, params, include_archived=request.args.get("include_archived") == "1"
+        ),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "no-store",
+            # プロキシに溜めずに流させる
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+# 名前にハッシュの入った画像は中身が変わらないので、ブラウザに 1 年持たせる
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600
+
+
+def image_visible(conn, filename):
+    """
+    filename の画像を参照する、削除されていない spot_info があるか
+    ハッシュで名付けた画像と派生画像は元画像のハッシュで、以前の形式の名前は image_filename で探す
+    アーカイブ (archive.py) に移した写真も、include_archived で返すので見せる
+    """
+    digest = content_hash(filename)
+    if digest is None:
+        condition, params = "image_filename = ?", (filename,)
+    else:
+        # 拡張子は問わない ("." の次の文字が "/")
+        condition, params = "image_filename >= ? AND image_filename < ?", (
+            f"{digest}.",
+            f"{digest}/",
+        )
+    schemas = ["main"]
+    if attach_archive(conn):
+        schemas.append("archive")
+    for schema in schemas:
+        row = conn.execute(
+            f"""
+            SELECT 1 FROM {schema}.spot_info
+            WHERE {condition} AND deleted IS NOT '1'
+            LIMIT 1
+        """,
+            params,
+        ).fetchone()
+        if row is not None:
+            return True
+    return False
+
+
+@api.route("/images/<filename>", methods=["GET"])
+def serve_image(filename):
+    """
+    ローカルに保存した画像 (IMAGE_STORE=local) を返す
+    参照する spot_info が全て削除済みなら 404
+
+    本体は WSGI サーバーの file_wrapper (gunicorn の sync / gthread ワーカーでは sendfile) で
+    そのまま送り、Range (206) と If-None-Match / If-Modified-Since (304) に応える。
+    IMAGE_ACCEL_REDIRECT があれば確認だけして、送信 (Range・304 も) は nginx に任せる
+    ハッシュで名付けた画像は ETag をファイル名にし、immutable で 1 年キャッシュさせる。
+    削除後に共有キャッシュから配られないよう private にする。
+    以前の形式の名前は中身が変わり得るので、毎回確認させる (no-cache)
+    """
+    store = get_image_store()
+    if not isinstance(store, LocalImageStore) or not image_visible(get_db(), filename):
+        return jsonify({"error": "image not found"}), 404
+
+    hashed = content_hash(filename) is not None
+    if IMAGE_ACCEL_REDIRECT:
+        response = Response(
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+        response.headers["X-Accel-Redirect"] = f"{IMAGE_ACCEL_REDIRECT}/{filename}"
+        if hashed:
+            response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+        else:
+            response.cache_control.no_cache = True
+    elif hashed:
+        response = send_from_directory(
+            store.root,
+            filename,
+            etag=filename.rsplit(".", 1)[0],
+            max_age=IMAGE_CACHE_MAX_AGE,
+        )
+    else:
+        response = send_from_directory(store.root, filename)
+
+    if hashed:
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+    # Range を送らない初回の 200 にも付け、途中からの再取得ができることを知らせる
+    response.headers.setdefault("Accept-Ranges", "bytes")
+    return response
+
+
+change_feed = ChangeFeed()
+
+
+@api.route("/events", methods=["GET"])
+def events():
+    """
+    地図の変更を Server-Sent Events で流す (events.py)
+
+    イベントは {"seq", "since", "msg_ids"} だけなので、受け取ったら
+    /get_locations?updated_since= で中身を取る。"reload" が付いていたら全件取り直す
+    再接続時は Last-Event-ID (または last_event_id) の seq 以降の変更から送る
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get(
+        "last_event_id"
+    )
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({"error": "last_event_id must be an integer"}), 400
+
+    try:
+        subscriber = change_feed.subscribe()
+    except TooManySubscribers:
+        return jsonify({"error": "too many subscribers"}), 503
+    return Response(
+        change_feed.stream(subscriber, last_event_id),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # nginx などのプロキシに溜めずにすぐ流させる
+            "X-Accel-Buffering": "no",
+        },
+    )
 
 
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 
-@app.route("/completed", methods=["POST"])
+@api.route("/completed", methods=["POST"])
 def completed():
 
     data = request.get_json()
@@ -660,8 +1337,8 @@ def completed():
     if not msg_id:
         return ({"error": "msg_id is not correct"}), 400
 
+    conn = get_db()
     try:
-        conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         cursor.execute(
             """
@@ -672,7 +1349,10 @@ def completed():
             (now_str, msg_id),
         )
         result_completed_regist = cursor.rowcount
-        if result_completed_regist == 1:
+        # 完了の通知は完了の記録と一緒にコミットし、送信は待たない
+        if result_completed_regist == 1 and upload_message(
+            conn, msg_id, "作業完了登録をしました。"
+        ):
             conn.commit()
             result_json = {"message": "completed_regist success!!"}
             result_code = 200
@@ -680,20 +1360,19 @@ def completed():
             conn.rollback()
             result_json = {"message": "completed_regist failed..."}
             result_code = 400
-        conn.close()
     except Exception as cre:
-        print("completed_regist 失敗！！ ", cre)
-        traceback.print_exc()
+        conn.rollback()
+        logger.exception("completed_regist 失敗！！ %s", cre)
         result_json = {"error": cre}
         result_code = 400
 
     if result_code == 200:
-        upload_message(msg_id, "作業完了登録をしました。")
+        notifications.wake()
 
     return jsonify(result_json), result_code
 
 
-@app.route("/deleted", methods=["POST"])
+@api.route("/deleted", methods=["POST"])
 def deleted():
     data = request.get_json()
     msg_id = data.get("msg_id")
@@ -703,7 +1382,7 @@ def deleted():
     if msg_id is None or image_url is None or deleted is None:
         return jsonify({"message": "msg_id and image_url are required"}), 400
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
 
     if deleted == "0":
@@ -726,9 +1405,9 @@ def deleted():
                 conn.rollback()
                 result_json = {"message": "image_delete failed..."}
                 result_code = 400
-            conn.close()
         except Exception as e:
-            traceback.print_exc()
+            conn.rollback()
+            logger.exception("image_deleted 失敗！！ %s", e)
             result_json = {"error": "image_deleted error"}
             result_code = 500
 
@@ -752,18 +1431,62 @@ def deleted():
                 conn.rollback()
                 result_json = {"message": "image_delete failed..."}
                 result_code = 400
-            conn.close()
         except Exception as e:
-            traceback.print_exc()
+            conn.rollback()
+            logger.exception("image_deleted 失敗！！ %s", e)
             result_json = {"error": "image_deleted error"}
             result_code = 500
 
     return jsonify(result_json), result_code
 
 
-init_db()
+def create_app(role="api"):
+    """
+    Flask アプリを作って返す (gunicorn は gunicorn.conf.py の 'elgana_api:create_app(...)' を読み込む)
+    import しただけでは DB にもスレッドにも触らず、ここでログの設定・ルートの登録・
+    スキーマの確認と、webhook のジョブ・通知の送信スレッドの起動を行う
+    (移行はマスターが fork 前に済ませているので、ワーカーでは適用済みの版を読むだけ)
+
+    role="events" は /events 専用の gevent ワーカー用で、ジョブ・通知の送信スレッドを起動しない
+    (SQLite を使う処理を greenlet で動かして、購読者への配信を止めないため)
+    """
+    started = time.perf_counter()
+    setup_logging()
+    app = Flask(__name__)
+    request_metrics.init_app(app)
+    app.register_blueprint(api)
+    init_db()
+    if role != "events":
+        job_queue.start()
+        notifications.start()
+    logger.info("create_app 成功！！ %.1f ms", (time.perf_counter() - started) * 1000)
+    return app
+
+
+def shutdown(timeout=30):
+    """
+    プロセスの終了前に呼ぶ (gunicorn.conf.py の worker_exit)
+    /events の接続を閉じ、新しいジョブ・通知の取得をやめて、実行中の webhook
+    (画像のダウンロード) と派生画像の生成が終わるのを待ってから、
+    書き込みスレッドに残った書き込みを流して止める。timeout は全体で待つ秒数
+    """
+    started = time.monotonic()
+
+    def remaining():
+        return max(timeout - (time.monotonic() - started), 0)
+
+    change_feed.stop(remaining())
+    job_queue.stop(remaining())
+    notifications.stop(remaining())
+    with _download_pool_lock:
+        pool = _download_pool if _download_pool_pid == os.getpid() else None
+    if pool is not None:
+        pool.shutdown(wait=True)
+    image_derivatives.shutdown()
+    get_writer().stop(remaining())
+    logger.info("shutdown 成功！！ %.1f s", time.monotonic() - started)
 
 
 if __name__ == "__main__":
-    print("Database initialized.")
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # 開発用 (デバッグモードは FLASK_DEBUG=1 の時だけ)。本番は gunicorn.conf.py で起動する
+    create_app().run(host="0.0.0.0", port=5000)
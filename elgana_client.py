@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Elgana API への外向き通信
+
+・keep-alive の requests.Session を 1 プロセス 1 つ共有し、接続を使い回す
+  (タイムアウト・5xx/接続エラー時のリトライ付き)
+・ログインで取得したトークンを有効期限の少し前まで使い回し、
+  期限切れ・401 の時だけロック付きで取り直す (同時リクエストで二重ログインしない)
+"""
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import record_outbound, timed
+
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LOGIN_API_URL = os.getenv("LOGIN_API_URL")
+LOGIN_ID = os.getenv("LOGIN_ID")
+PASSWORD = os.getenv("PASSWORD")
+# ログイン応答に有効期限 (expires_in) が無い場合に使う有効秒数
+TOKEN_TTL = float(os.getenv("ELGANA_TOKEN_TTL", "1800"))
+# 期限のこの秒数前になったら取り直す
+TOKEN_REFRESH_MARGIN = float(os.getenv("ELGANA_TOKEN_REFRESH_MARGIN", "60"))
+# 接続プールの大きさ (同時に張っておく Elgana への接続数)
+HTTP_POOL_SIZE = int(os.getenv("ELGANA_HTTP_POOL_SIZE", "10"))
+CONNECT_TIMEOUT = float(os.getenv("ELGANA_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("ELGANA_READ_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.getenv("ELGANA_HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("ELGANA_HTTP_BACKOFF", "0.5"))
+
+# 全リクエスト共通の X-MBL-* ヘッダー
+BASE_HEADERS = {
+    "X-MBL-COMPANY-ID": "infra-sisb",
+    "X-MBL-OS": "windows",
+    "X-MBL-CLIENT": "10",
+    "X-MBL-DID": "123451",
+}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def elgana_headers(token=None, content_type="application/json"):
+    """
+    共通ヘッダーにアクセストークンと Content-Type を足したものを返す
+    """
+    headers = dict(BASE_HEADERS)
+    if token:
+        headers["X-MBL-ACCESS-TOKEN"] = token
+    headers["Content-Type"] = content_type
+    return headers
+
+
+def _build_session():
+    # 接続エラーはメソッドを問わず、5xx・読み込みエラーは GET などの冪等なメソッドだけ再試行
+    # (チャット投稿の POST を二重に送らないため)
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """
+    プロセス共有の Session を返す (fork 後は作り直す)
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def request(method, url, **kwargs):
+    """
+    共有 Session で送り、宛先のパスごとのステータス・時間を記録する
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    endpoint = urlparse(url).path or url
+    started = time.perf_counter()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except Exception:
+        record_outbound(endpoint, "error", time.perf_counter() - started)
+        raise
+    record_outbound(endpoint, response.status_code, time.perf_counter() - started)
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def login():
+    """
+    Elgana にログインしてトークンを取得する
+
+    payload：Elgana へのログインIDとパスワードを定義
+
+    response = { result": {"access_token": "#######", "expires_in": ...}, ..}
+    (access_token, 有効秒数) を返す。失敗時は (None, None)
+    """
+
+    payload = {"login_id": LOGIN_ID, "password": PASSWORD}
+    try:
+        response = post(LOGIN_API_URL, headers=elgana_headers(), json=payload)
+        logger.info("Login response: %s", response.status_code)
+        if response.status_code == 200:
+            result = response.json().get("result", {})
+            return result.get("access_token"), result.get("expires_in")
+        else:
+            return None, None
+    except Exception as e:
+        logger.warning("ログインAPI通信エラー: %s", e)
+        return None, None
+
+
+class TokenCache:
+    """
+    アクセストークンのキャッシュ
+
+    hits：キャッシュから返した回数
+    misses：キャッシュが無効でログインが必要になった回数
+    refreshes：ログインに成功してトークンを入れ替えた回数
+    failures：ログインに失敗した回数
+    invalidations：401 などで破棄した回数
+    """
+
+    def __init__(self, fetch=login, ttl=TOKEN_TTL, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "refreshes": 0,
+            "failures": 0,
+            "invalidations": 0,
+        }
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _valid_token(self):
+        if self._token and time.monotonic() < self._expires_at - self._refresh_margin:
+            return self._token
+        return None
+
+    def get(self):
+        """
+        有効なトークンを返す。取得できなければ None
+        """
+        token = self._valid_token()
+        if token:
+            self._count("hits")
+            return token
+
+        with self._lock:
+            # ロック待ちの間に他のスレッドが取り直していればそれを使う
+            token = self._valid_token()
+            if token:
+                self._count("hits")
+                return token
+
+            self._count("misses")
+            with timed("token_fetch"):
+                token, expires_in = self._fetch()
+            if not token:
+                self._count("failures")
+                return None
+            self._token = token
+            self._expires_at = time.monotonic() + float(expires_in or self._ttl)
+            self._count("refreshes")
+            return token
+
+    def invalidate(self, token=None):
+        """
+        トークンを破棄する。token を渡した場合は、それがまだ使われている時だけ破棄
+        """
+        with self._lock:
+            if self._token and (token is None or token == self._token):
+                self._token = None
+                self._expires_at = 0.0
+                self._count("invalidations")
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+token_cache = TokenCache()
+
+
+def get_access_token():
+    return token_cache.get()
+
+
+def call_with_token(send):
+    """
+    send(token) でリクエストを送り、401 ならトークンを取り直して 1 回だけ再送する
+    トークンが取れない場合は None を返す
+    """
+    token = get_access_token()
+    if not token:
+        return None
+    response = send(token)
+    if response.status_code == 401:
+        # stream=True の応答は読み切るか閉じるまで接続がプールに戻らない
+        # (401 の本文は小さいので読み捨てて、接続を閉じずにプールに戻す)
+        response.raw.drain_conn()
+        response.close()
+        token_cache.invalidate(token)
+        token = get_access_token()
+        if not token:
+            return None
+        response = send(token)
+    return response
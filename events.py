@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+地図の変更のプッシュ配信 (Server-Sent Events、/events)
+
+プロセスに 1 つの監視スレッドが sync_state の seq (migrations.py v6) を見張り、
+進んでいたらその間に変わった案件の msg_id を購読者ごとのキューに配る。
+webhook・/completed・/deleted・外部システムのどの書き込みも seq を進めるので、
+どこで書かれても届く。イベントは小さく保ち、中身はクライアントが
+/get_locations?updated_since= で取りに行く (ETag 付きで使い回される)
+
+イベントの id は seq。再接続時に Last-Event-ID が送られてくれば、
+その seq 以降に変わった分をまとめて 1 件送ってから続きを流す
+
+待機中の接続は生成器の中でキューを待つだけなので、/events だけを受ける
+gevent ワーカーのサーバー (GUNICORN_ROLE=events、gunicorn.conf.py を参照) で動かせば
+接続ごとにスレッドを占有しない。API 側の gthread ワーカーでは 1 接続 1 スレッドになる
+"""
+import json
+import logging
+import os
+import queue
+import threading
+
+from db import get_db
+
+
+# seq を見に行く間隔 (秒)
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "0.5"))
+# 何も無い時に接続確認のコメントを送る間隔 (秒)
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+# 1 プロセスあたりの購読者数の上限
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "1000"))
+# 購読者ごとに溜めておくイベント数 (溢れたら取り直しを促す)
+EVENTS_QUEUE_SIZE = 100
+# 1 イベントに載せる msg_id の上限 (超えたら載せずに取り直しを促す)
+EVENTS_MAX_IDS = 500
+# 切断後の再接続までの待ち (ミリ秒、EventSource の retry)
+EVENTS_RETRY_MS = 3000
+
+logger = logging.getLogger(__name__)
+
+
+class TooManySubscribers(Exception):
+    """
+    購読者数が EVENTS_MAX_SUBSCRIBERS に達している
+    """
+
+
+def current_seq(conn):
+    return conn.execute(
+        "SELECT seq FROM sync_state WHERE name = 'locations'"
+    ).fetchone()[0]
+
+
+def changes_between(conn, since, until):
+    """
+    seq が since より後・until 以下で変わった (消えたものも含む) 案件のイベント
+    {"seq": until, "since": since, "msg_ids": [...]}
+    件数が多い時は msg_ids の代わりに "reload": true
+    """
+    rows = conn.execute(
+        """
+        SELECT msg_id FROM operation_orders WHERE row_seq > ? AND row_seq <= ?
+        UNION
+        SELECT msg_id FROM order_tombstones WHERE seq > ? AND seq <= ?
+        LIMIT ?
+    """,
+        (since, until, since, until, EVENTS_MAX_IDS + 1),
+    ).fetchall()
+    event = {"seq": until, "since": since}
+    msg_ids = sorted(row[0] for row in rows if row[0] is not None)
+    if len(msg_ids) > EVENTS_MAX_IDS:
+        event["reload"] = True
+    else:
+        event["msg_ids"] = msg_ids
+    return event
+
+
+def format_event(event):
+    data = json.dumps(event, ensure_ascii=False)
+    return f"id: {event['seq']}\nevent: change\ndata: {data}\n\n"
+
+
+class ChangeFeed:
+    """
+    seq の監視と購読者への配信
+
+    subscribers：接続中の購読者数
+    published：配ったイベント数
+    dropped：キューが溢れて取り直しを促した回数
+    """
+
+    def __init__(
+        self,
+        poll_interval=EVENTS_POLL_INTERVAL,
+        heartbeat=EVENTS_HEARTBEAT,
+        max_subscribers=EVENTS_MAX_SUBSCRIBERS,
+    ):
+        self._poll_interval = poll_interval
+        self._heartbeat = heartbeat
+        self._max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stats = {"published": 0, "dropped": 0}
+
+    def start(self):
+        """
+        このプロセスの監視スレッドを起動する (起動済みなら何もしない)
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._subscribers = set()
+            self._thread = threading.Thread(
+                target=self._poll_loop, name="change-feed", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        # 待機中の接続を終わらせる
+        for subscriber in subscribers:
+            self._offer(subscriber, None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self):
+        self.start()
+        with self._lock:
+            if len(self._subscribers) >= self._max_subscribers:
+                raise TooManySubscribers()
+            subscriber = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _offer(self, subscriber, event):
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            # 受け取りが追いつかない購読者は溜まった分を捨て、全件の取り直しを促す
+            with self._lock:
+                self._stats["dropped"] += 1
+            while True:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    break
+            reload = dict(event or {}, reload=True)
+            reload.pop("msg_ids", None)
+            subscriber.put_nowait(reload if event else None)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._stats["published"] += 1
+        for subscriber in subscribers:
+            self._offer(subscriber, event)
+
+    def _poll_loop(self):
+        conn = get_db()
+        seq = None
+        while not self._stopping.is_set():
+            try:
+                latest = current_seq(conn)
+                if seq is not None and latest > seq:
+                    self.publish(changes_between(conn, seq, latest))
+                seq = latest
+            except Exception:
+                logger.exception("変更の監視失敗！！")
+            self._stopping.wait(self._poll_interval)
+
+    def stream(self, subscriber, last_event_id=None):
+        """
+        text/event-stream の本文を生成する (切断されたら購読をやめる)
+        last_event_id があれば、その後の変更をまとめた 1 件から始める
+        """
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n"
+            sent = None
+            if last_event_id is not None:
+                conn = get_db()
+                latest = current_seq(conn)
+                if latest > last_event_id:
+                    yield format_event(changes_between(conn, last_event_id, latest))
+                sent = latest
+            while True:
+                try:
+                    event = subscriber.get(timeout=self._heartbeat)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    return
+                # 再開時にまとめて送った分と重なるイベントは飛ばす
+                if sent is not None and event["seq"] <= sent:
+                    continue
+                sent = event["seq"]
+                yield format_event(event)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "subscribers": len(self._subscribers)}
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+案件 (operation_orders) と現場写真 (spot_info)・作業者 (user_info) の一括出力
+
+月次の報告などで全件を出すためのもので、/get_locations のように全件を
+dict に組み立ててから JSON にするのではなく、カーソルから 1 行ずつ読んで
+CSV / GeoJSON の断片を生成器で流す。件数によらずメモリは一定で、
+最初の行から送り始められる
+
+行は案件の id 順、同じ案件の写真は続けて並ぶ (写真は spot_info の id 順)。
+写真のない案件も出す (CSV では写真の列が空の 1 行、GeoJSON では images が空)
+include_archived=True ではアーカイブ (archive.py) に移した案件も id 順に混ぜて出す
+"""
+import csv
+import heapq
+import io
+import json
+import time
+from itertools import islice
+from operator import itemgetter
+
+from archive import attach_archive
+from db import connect
+
+
+# これだけ行を読んだら 1 回分として送る
+EXPORT_CHUNK_ROWS = 500
+
+# (列名, SELECT 式)
+ORDER_COLUMNS = (
+    ("msg_id", "o.msg_id"),
+    ("room_id", "o.room_id"),
+    ("instruction", "o.instruction"),
+    ("status", "o.status"),
+    ("urgency", "o.urgency"),
+    ("customer_info", "o.customer_info"),
+    ("remarks", "o.remarks"),
+    ("received_at", "o.received_at"),
+    ("completed", "o.completed"),
+    ("update_at", "o.update_at"),
+    ("operation_status", "o.operation_status"),
+    ("duplicate_of", "o.duplicate_of"),
+    ("reporter_name", "r.user_name"),
+    ("reporter_org", "r.org"),
+    ("latitude", "o.latitude"),
+    ("longitude", "o.longitude"),
+)
+SPOT_COLUMNS = (
+    ("spot_id", "s.id"),
+    ("bucket", "s.bucket"),
+    ("repair_required", "s.repair_required"),
+    ("height", "s.height"),
+    ("width", "s.width"),
+    ("depth", "s.depth"),
+    ("cost", "s.cost"),
+    ("term", "s.term"),
+    ("image_url", "s.image_url"),
+    ("status_flag", "s.status_flag"),
+    ("deleted", "s.deleted"),
+    ("photographer_name", "u.user_name"),
+    ("photographer_org", "u.org"),
+    ("photographed_at", "s.create_at"),
+)
+
+
+def iter_rows(conn, where, params, schema="main"):
+    """
+    条件 (operation_orders は o、spot_info は s で参照) に合う (案件, 写真) の行を順に返す
+    各行の先頭は案件の id (まとめる単位)、続いて ORDER_COLUMNS・SPOT_COLUMNS の順
+    写真のない案件は写真の列が全て None の 1 行になる
+    schema="archive" でアーカイブの案件・写真を読む (作業者は運用中の user_info)
+    """
+    columns = ", ".join(expr for _, expr in ORDER_COLUMNS + SPOT_COLUMNS)
+    # 非表示 (signal = '0') の案件は /get_locations と同じく出さない
+    conditions = " AND ".join(["o.signal IS NOT '0'", *where])
+    cursor = conn.execute(
+        f"""
+        SELECT o.id, {columns}
+        FROM {schema}.operation_orders AS o
+        LEFT JOIN user_info AS r ON r.user_id = o.user_id
+        LEFT JOIN {schema}.spot_info AS s ON s.msg_id = o.msg_id
+        LEFT JOIN user_info AS u ON u.user_id = s.user_id
+        WHERE {conditions}
+        ORDER BY o.id, s.id
+    """,
+        params,
+    )
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def _stream(where, params, encode, path=None, include_archived=False):
+    """
+    専用の接続で読み、encode(行の iterator) が返す断片 (EXPORT_CHUNK_ROWS 行ずつ) を順に返す
+    読み終わる (または途中で切断される) まで 1 つの読み取りトランザクションなので、
+    出力の途中で書き込まれた案件は混ざらない
+    """
+    conn = connect(path)
+    # sqlite3.Row は列名で引かないので、変換の軽いタプルで受け取る
+    conn.row_factory = None
+    sources = []
+    rows = pieces = None
+    try:
+        schemas = ["main"]
+        if include_archived and attach_archive(conn):
+            schemas.append("archive")
+        conn.execute("BEGIN")
+        sources = [iter_rows(conn, where, params, schema) for schema in schemas]
+        rows = sources[0]
+        if len(sources) > 1:
+            # どちらも案件の id 順なので、並べ直さずに突き合わせて混ぜる
+            rows = heapq.merge(*sources, key=itemgetter(0))
+        pieces = encode(rows)
+        for piece in pieces:
+            yield piece
+            # 読み込みと変換は他に処理を譲らないので、断片ごとに譲る
+            # (gevent ワーカーで他の接続や監視 (heartbeat) を止めないため)
+            time.sleep(0)
+    finally:
+        # カーソルを閉じてから接続を閉じる
+        for generator in (pieces, rows, *sources):
+            if generator is not None:
+                generator.close()
+        conn.rollback()
+        conn.close()
+
+
+def _batches(rows):
+    while True:
+        batch = list(islice(rows, EXPORT_CHUNK_ROWS))
+        if not batch:
+            return
+        yield batch
+
+
+def _encode_csv(rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    # Excel で開いても文字化けしないよう BOM を付ける
+    out.write("\ufeff")
+    writer.writerow([name for name, _ in ORDER_COLUMNS + SPOT_COLUMNS])
+    for batch in _batches(rows):
+        writer.writerows(row[1:] for row in batch)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+
+def _feature(order, spots):
+    properties = dict(zip((name for name, _ in ORDER_COLUMNS[:-2]), order[:-2]))
+    latitude, longitude = order[-2:]
+    properties["images"] = spots
+    geometry = None
+    if latitude is not None and longitude is not None:
+        geometry = {"type": "Point", "coordinates": [longitude, latitude]}
+    return json.dumps(
+        {"type": "Feature", "geometry": geometry, "properties": properties},
+        ensure_ascii=False,
+    )
+
+
+def _encode_geojson(rows):
+    # 同じ案件の行は続いて来るので、案件が変わったら 1 件の Feature にする
+    spot_start = 1 + len(ORDER_COLUMNS)
+    spot_names = [name for name, _ in SPOT_COLUMNS]
+    head = '{"type": "FeatureCollection", "features": ['
+    features = []
+    order_id = order = None
+    spots = []
+    for batch in _batches(rows):
+        for row in batch:
+            if order is None or row[0] != order_id:
+                if order is not None:
+                    features.append(_feature(order, spots))
+                order_id, order = row[0], row[1:spot_start]
+                spots = []
+            if row[spot_start] is not None:
+                spots.append(dict(zip(spot_names, row[spot_start:])))
+        if features:
+            yield head + ",".join(features)
+            head = ","
+            features = []
+    if order is not None:
+        features.append(_feature(order, spots))
+    yield head + ",".join(features) + "]}"
+
+
+def export_csv(where, params, path=None, include_archived=False):
+    """
+    1 行目が列名の CSV (1 行が案件と写真 1 枚) を少しずつ返す生成器
+    """
+    return _stream(where, params, _encode_csv, path, include_archived)
+
+
+def export_geojson(where, params, path=None, include_archived=False):
+    """
+    案件 1 件を Feature (座標のない案件は geometry が null、写真は properties.images) にした
+    GeoJSON の FeatureCollection を少しずつ返す生成器
+    """
+    return _stream(where, params, _encode_geojson, path, include_archived)
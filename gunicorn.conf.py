@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+本番の gunicorn の設定 (gunicorn は起動したディレクトリの gunicorn.conf.py を読む)
+
+gunicorn -c gunicorn.conf.py                       # API (/events 以外)
+GUNICORN_ROLE=events gunicorn -c gunicorn.conf.py  # /events だけを受ける (nginx で振り分ける)
+
+・スキーマの移行はマスターがワーカーを fork する前に 1 回だけ流す (migrations.py)
+  マスターには elgana_api・db を読み込まない。gevent のパッチ前に作ったロックや
+  スレッドローカルをワーカーが引き継ぐと、greenlet 間で接続を取り合うため
+・API のワーカーは gthread。sqlite3 の呼び出し (busy_timeout の待ち・大きな /get_locations の
+  組み立て) は gevent に処理を譲らないので、gevent では 1 つの遅いクエリがそのワーカーの
+  全接続 (webhook の受付・/events の心拍) を止めてしまう。スレッドなら他の要求は待たされない
+・ワーカー数は CPU 数 (最大 4)。SQLite への書き込みは全プロセスで同時に 1 つしか通らず、
+  プロセスごとの書き込みスレッドがまとめてコミットするので、プロセスを増やすほど
+  まとまりが小さくなってロック待ちが増える
+・/events は開いたままの接続を多数抱えるので、別の gunicorn (GUNICORN_ROLE=events) の
+  gevent ワーカー 1 つで worker_connections 本まで受ける。こちらは webhook のジョブ・通知の送信を
+  動かさず、SQLite には変更の監視の短い読み込み (EVENTS_POLL_INTERVAL ごと) しか行わない
+・終了時 (SIGTERM) は /events の接続を閉じ、実行中の webhook (画像のダウンロード) と
+  派生画像の生成を graceful_timeout まで待ってから抜ける (elgana_api.shutdown)
+
+GUNICORN_* の環境変数か、コマンドラインの引数で上書きできる
+"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# "api" (既定) か "events"
+ROLE = os.getenv("GUNICORN_ROLE", "api")
+if ROLE not in ("api", "events"):
+    raise ValueError(f"GUNICORN_ROLE must be api or events: {ROLE}")
+
+wsgi_app = f"elgana_api:create_app({ROLE!r})"
+if ROLE == "events":
+    bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5001")
+    worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+    workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+else:
+    bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+    worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+    workers = int(os.getenv("GUNICORN_WORKERS", str(min(os.cpu_count() or 1, 4))))
+# gevent ワーカー 1 つあたりの同時接続数 (/events の購読者)
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+# gthread ワーカー 1 つあたりのスレッド数 (同時に処理する要求の数)
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+# SIGTERM から実行中の処理を待つ秒数 (過ぎたらマスターが SIGKILL する)
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+# アプリはワーカーが fork 後に読み込む (gevent のパッチより前に読み込まない)
+preload_app = False
+
+
+def on_starting(server):
+    """
+    マスターの起動時に、ワーカーの fork より前にスキーマを移行する
+    (別プロセスで流し、マスターには db.py などを読み込まない)
+    失敗したらワーカーを起動せずに終了する
+    """
+    started = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, "migrations.py")], check=True)
+    server.log.info("migrate 成功！！ (%.0f ms)", (time.perf_counter() - started) * 1000)
+
+
+def post_worker_init(worker):
+    """
+    SIGTERM を受けたら /events の接続を閉じる
+    (開いたままだと graceful_timeout まで接続が空かず、終了処理の時間が無くなる)
+    """
+    import elgana_api
+
+    handle_exit = worker.handle_exit
+
+    def on_exit(sig, frame):
+        handle_exit(sig, frame)
+        # シグナルハンドラーの中では待てないので、別の greenlet (スレッド) で閉じる
+        if worker.__class__.__module__ == "gunicorn.workers.ggevent":
+            import gevent
+
+            gevent.spawn(elgana_api.change_feed.stop)
+        else:
+            threading.Thread(target=elgana_api.change_feed.stop, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_exit)
+
+
+def worker_exit(server, worker):
+    """
+    ワーカーの終了時に、実行中の画像のダウンロード・派生画像の生成と
+    残った書き込み・通知の送信を終わらせる
+    """
+    if "elgana_api" not in sys.modules:
+        return
+    sys.modules["elgana_api"].shutdown(timeout=worker.cfg.graceful_timeout)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+スポット画像の派生画像 (サムネイル・中サイズ) 生成
+
+取り込み時に EXIF の向きを補正した縮小画像を作り、メタデータを落として
+WebP (または JPEG) で保存する。Pillow の処理は重いので別プロセスのプールで行い、
+webhook のワーカーは完了を待たない。Pillow・piexif はプールの子プロセスだけが読み込む。
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+IMAGE_THUMB_SIZE = int(os.getenv("IMAGE_THUMB_SIZE", "320"))
+IMAGE_MEDIUM_SIZE = int(os.getenv("IMAGE_MEDIUM_SIZE", "1280"))
+# webp / jpeg
+IMAGE_DERIVATIVE_FORMAT = os.getenv("IMAGE_DERIVATIVE_FORMAT", "webp").lower()
+IMAGE_DERIVATIVE_QUALITY = int(os.getenv("IMAGE_DERIVATIVE_QUALITY", "80"))
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv("IMAGE_DERIVATIVE_WORKERS", "2"))
+
+# (名前, 長辺の最大ピクセル)
+DERIVATIVES = (("thumb", IMAGE_THUMB_SIZE), ("medium", IMAGE_MEDIUM_SIZE))
+
+logger = logging.getLogger(__name__)
+
+# EXIF Orientation ごとの補正 (Image.Transpose の名前。1 はそのまま)
+_ORIENTATION_TRANSPOSE = {
+    2: "FLIP_LEFT_RIGHT",
+    3: "ROTATE_180",
+    4: "FLIP_TOP_BOTTOM",
+    5: "TRANSPOSE",
+    6: "ROTATE_270",
+    7: "TRANSVERSE",
+    8: "ROTATE_90",
+}
+# プールの子プロセスに前もって読み込ませるモジュール
+_PRELOAD = [
+    __name__,
+    "PIL.Image",
+    "PIL.JpegImagePlugin",
+    "PIL.WebPImagePlugin",
+    "piexif",
+]
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _orientation(image):
+    """
+    EXIF の Orientation を piexif で読む (壊れた EXIF は補正なし扱い)
+    """
+    import piexif
+
+    exif = image.info.get("exif")
+    if not exif:
+        return 1
+    try:
+        return piexif.load(exif)["0th"].get(piexif.ImageIFD.Orientation, 1)
+    except Exception:
+        return 1
+
+
+def render_derivatives(source_path, out_dir, stem):
+    """
+    別プロセスで実行される
+    {名前: (出力パス, 幅, 高さ)} を返す
+    """
+    from PIL import Image
+
+    ext = "webp" if IMAGE_DERIVATIVE_FORMAT == "webp" else "jpg"
+    results = {}
+    with Image.open(source_path) as source:
+        image = source
+        method = _ORIENTATION_TRANSPOSE.get(_orientation(source))
+        if method is not None:
+            image = image.transpose(Image.Transpose[method])
+        if image.mode not in ("RGB", "RGBA") or ext == "jpg":
+            image = image.convert("RGB")
+
+        for name, size in DERIVATIVES:
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+            path = os.path.join(out_dir, f"{stem}_{name}.{ext}")
+            # exif / icc 等は渡さないので、保存時にメタデータは落ちる
+            if ext == "webp":
+                resized.save(path, "WEBP", quality=IMAGE_DERIVATIVE_QUALITY, method=4)
+            else:
+                resized.save(
+                    path, "JPEG", quality=IMAGE_DERIVATIVE_QUALITY, optimize=True
+                )
+            results[name] = (path, resized.width, resized.height)
+    return results
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # スレッドを持つプロセスから fork しないよう forkserver を使い、
+            # 子プロセスにはこのモジュールと Pillow だけを読み込ませる
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(_PRELOAD)
+            _pool = ProcessPoolExecutor(
+                max_workers=IMAGE_DERIVATIVE_WORKERS, mp_context=context
+            )
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def shutdown(wait=True):
+    """
+    このプロセスのプールを閉じる
+    wait なら生成中・待ちの派生画像が保存され、on_done が呼ばれるまで待つ
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        pool = _pool if _pool_pid == os.getpid() else None
+        _pool = _pool_pid = None
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+def submit(store, stored, on_done):
+    """
+    保存済み画像の派生画像生成をプロセスプールに投げる
+    生成後に派生画像を store に保存し、on_done(stored, {名前: (url, 幅, 高さ)}) を呼ぶ
+    投げられなかった場合 (終了処理でプールが閉じた後など) は一時ファイルを消して例外をそのまま上げる
+    """
+    stem = stored.filename.rsplit(".", 1)[0]
+    out_dir = tempfile.mkdtemp(prefix="derivatives-")
+    source_path, source_is_temp = None, False
+    try:
+        source_path, source_is_temp = store.fetch_local(stored.filename)
+        future = _get_pool().submit(render_derivatives, source_path, out_dir, stem)
+    except Exception:
+        if source_is_temp:
+            os.remove(source_path)
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise
+
+    def done(future):
+        try:
+            derivatives = {}
+            for name, (path, width, height) in future.result().items():
+                url = store.save_file(path, os.path.basename(path))
+                derivatives[name] = (url, width, height)
+            on_done(stored, derivatives)
+        except Exception as e:
+            logger.exception("derivatives 失敗！！ %s: %s", stored.filename, e)
+        finally:
+            if source_is_temp:
+                os.remove(source_path)
+            for name in os.listdir(out_dir):
+                os.remove(os.path.join(out_dir, name))
+            os.rmdir(out_dir)
+
+    future.add_done_callback(done)
+    return future
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+画像の保存先
+
+ダウンロードした画像をメモリに溜めずにチャンク単位で保存先へ流し込む。
+流しながら SHA-256 を計算し、ファイル名を「ハッシュ.拡張子」にすることで
+同じ画像は 1 つしか保存しない。形式の判定は先頭バイトを filetype で見る。
+
+IMAGE_STORE=local (既定)：IMAGE_DIR に保存し IMAGE_BASE_URL/ファイル名 で参照
+IMAGE_STORE=s3        ：S3 互換ストレージ (IMAGE_S3_BUCKET / IMAGE_S3_PREFIX)
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import uuid
+from collections import namedtuple
+
+import filetype
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+IMAGE_STORE = os.getenv("IMAGE_STORE", "local")
+IMAGE_DIR = os.getenv(
+    "IMAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+)
+IMAGE_BASE_URL = os.getenv("IMAGE_BASE_URL", "/images")
+IMAGE_S3_BUCKET = os.getenv("IMAGE_S3_BUCKET")
+IMAGE_S3_PREFIX = os.getenv("IMAGE_S3_PREFIX", "elgana-images/")
+IMAGE_S3_ENDPOINT_URL = os.getenv("IMAGE_S3_ENDPOINT_URL")
+IMAGE_S3_PUBLIC_URL = os.getenv("IMAGE_S3_PUBLIC_URL")
+# 1 枚あたりの上限サイズ (バイト)
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(64 * 1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+# filetype が形式判定に使う先頭バイト数
+SIGNATURE_BYTES = 8192
+
+# 保存した画像 (ハッシュ.拡張子) と派生画像 (ハッシュ_名前.拡張子) のファイル名
+_HASHED_NAME = re.compile(r"([0-9a-f]{64})(?:_[a-z]+)?\.[0-9a-z]+")
+
+StoredImage = namedtuple(
+    "StoredImage", ["filename", "url", "size", "sha256", "mime", "created"]
+)
+
+
+class ImageRejected(Exception):
+    """
+    画像ではない・大きすぎるなどで保存しなかった
+    """
+
+
+def content_hash(filename):
+    """
+    ファイル名に入っている元画像の SHA-256 (派生画像なら元画像のもの)
+    ハッシュで名付けていない (以前の形式の) ファイル名なら None
+    """
+    match = _HASHED_NAME.fullmatch(filename)
+    return match.group(1) if match else None
+
+
+class _ValidatingStream:
+    """
+    チャンクのイテレータを包み、ハッシュ・サイズ上限・形式判定をしながら流す
+    read() もできるので boto3 の upload_fileobj にそのまま渡せる
+    """
+
+    def __init__(self, chunks, max_bytes=IMAGE_MAX_BYTES):
+        self._chunks = iter(chunks)
+        self._max_bytes = max_bytes
+        self._buffer = b""
+        self._head = b""
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.kind = None
+        self._iter = None
+
+    def _check_head(self, final=False):
+        if self.kind is not None:
+            return
+        if len(self._head) < SIGNATURE_BYTES and not final:
+            return
+        kind = filetype.guess(self._head)
+        if kind is None or not kind.mime.startswith("image/"):
+            raise ImageRejected("not an image")
+        self.kind = kind
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            self.size += len(chunk)
+            if self.size > self._max_bytes:
+                raise ImageRejected(f"image larger than {self._max_bytes} bytes")
+            if len(self._head) < SIGNATURE_BYTES:
+                self._head += chunk[: SIGNATURE_BYTES - len(self._head)]
+                self._check_head()
+            self.sha256.update(chunk)
+            yield chunk
+        if self.size == 0:
+            raise ImageRejected("empty body")
+        self._check_head(final=True)
+
+    def read(self, size=-1):
+        if self._iter is None:
+            self._iter = iter(self)
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._iter, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class LocalImageStore:
+    def __init__(self, root=IMAGE_DIR, base_url=IMAGE_BASE_URL):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+
+    def path_for(self, filename):
+        return os.path.join(self.root, filename)
+
+    def url_for(self, filename):
+        return f"{self.base_url}/{filename}"
+
+    def exists(self, filename):
+        return os.path.exists(self.path_for(filename))
+
+    def save_stream(self, chunks):
+        """
+        チャンクを同じディレクトリの一時ファイルに書き、最後に rename で確定する
+        """
+        os.makedirs(self.root, exist_ok=True)
+        stream = _ValidatingStream(chunks)
+        fd, part_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in stream:
+                    f.write(chunk)
+            filename = f"{stream.sha256.hexdigest()}.{stream.kind.extension}"
+            created = not self.exists(filename)
+            if created:
+                os.replace(part_path, self.path_for(filename))
+            else:
+                os.remove(part_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        return StoredImage(
+            filename,
+            self.url_for(filename),
+            stream.size,
+            stream.sha256.hexdigest(),
+            stream.kind.mime,
+            created,
+        )
+
+    def fetch_local(self, filename):
+        """
+        ローカルで読めるパスと、それが使い終わったら消すべき一時ファイルかを返す
+        """
+        return self.path_for(filename), False
+
+    def save_file(self, path, filename):
+        """
+        生成済みのファイル (派生画像など) を保存先へ移し、URL を返す
+        """
+        os.makedirs(self.root, exist_ok=True)
+        os.replace(path, self.path_for(filename))
+        return self.url_for(filename)
+
+
+class S3ImageStore:
+    def __init__(
+        self,
+        bucket=IMAGE_S3_BUCKET,
+        prefix=IMAGE_S3_PREFIX,
+        endpoint_url=IMAGE_S3_ENDPOINT_URL,
+        public_url=IMAGE_S3_PUBLIC_URL,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.public_url = (
+            public_url or f"https://{bucket}.s3.amazonaws.com"
+        ).rstrip("/")
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+
+                    self._client = boto3.client("s3", endpoint_url=self.endpoint_url)
+        return self._client
+
+    def url_for(self, filename):
+        return f"{self.public_url}/{self.prefix}{filename}"
+
+    def exists(self, filename):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + filename)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return False
+            raise
+
+    def save_stream(self, chunks):
+        """
+        一時キーへストリームのままアップロードし、ハッシュ確定後に本来のキーへコピーする
+        (マルチパートの分割サイズ × 並列数までしかメモリを使わない)
+        """
+        from boto3.s3.transfer import TransferConfig
+
+        stream = _ValidatingStream(chunks)
+        tmp_key = f"{self.prefix}incoming/{uuid.uuid4().hex}"
+        config = TransferConfig(multipart_chunksize=8 * 1024 * 1024, max_concurrency=2)
+        try:
+            self.client.upload_fileobj(stream, self.bucket, tmp_key, Config=config)
+            filename = f"{stream.sha256.hexdigest()}.{stream.kind.extension}"
+            created = not self.exists(filename)
+            if created:
+                self.client.copy_object(
+                    Bucket=self.bucket,
+                    Key=self.prefix + filename,
+                    CopySource={"Bucket": self.bucket, "Key": tmp_key},
+                    ContentType=stream.kind.mime,
+                    MetadataDirective="REPLACE",
+                )
+        finally:
+            self.client.delete_object(Bucket=self.bucket, Key=tmp_key)
+        return StoredImage(
+            filename,
+            self.url_for(filename),
+            stream.size,
+            stream.sha256.hexdigest(),
+            stream.kind.mime,
+            created,
+        )
+
+    def fetch_local(self, filename):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+        os.close(fd)
+        self.client.download_file(self.bucket, self.prefix + filename, path)
+        return path, True
+
+    def save_file(self, path, filename):
+        kind = filetype.guess(path)
+        extra = {"ContentType": kind.mime} if kind else {}
+        self.client.upload_file(
+            path, self.bucket, self.prefix + filename, ExtraArgs=extra
+        )
+        os.remove(path)
+        return self.url_for(filename)
+
+
+_store = None
+
+
+def get_image_store():
+    global _store
+    if _store is None:
+        if IMAGE_STORE == "s3":
+            _store = S3ImageStore()
+        else:
+            _store = LocalImageStore()
+    return _store
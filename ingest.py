@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+webhook の非同期取り込み
+
+/elgana_api は受け取った JSON を webhook_jobs テーブルに積んで即座に 200 を返し、
+実際の解析・DB 書き込み・画像ダウンロードはワーカースレッドが行う。
+失敗したジョブは間隔を空けて再試行し、上限回数を超えたものは dead にして残す。
+
+Elgana は webhook を再送してくるので、メッセージ ID (msg.id) を processed_messages
+(主キー) に記録し、同じ ID は積まずに最初のジョブ ID を返す。直近の ID はプロセス内の
+LRU にも持ち、再送の大半は DB に触れずに弾く
+
+ジョブの積み込み・取得・完了の書き込みは writer.py の書き込みスレッドに渡し、
+同時に来た他の書き込みとまとめてコミットする
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db import get_db
+from writer import get_writer
+
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))
+# 再試行までの待ち秒数 (試行回数ごとに 2 倍)
+INGEST_RETRY_DELAY = float(os.getenv("INGEST_RETRY_DELAY", "5"))
+# 他プロセスが積んだジョブを拾いに行く間隔
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "1"))
+# running のまま この秒数を過ぎたジョブは、ワーカーが落ちたとみなして拾い直す
+INGEST_JOB_TIMEOUT = float(os.getenv("INGEST_JOB_TIMEOUT", "600"))
+# done のジョブを残しておく秒数
+INGEST_RETENTION = float(os.getenv("INGEST_RETENTION", str(7 * 24 * 3600)))
+# 統計で処理時間を集計する直近の秒数
+STATS_WINDOW = 300
+# プロセス内で覚えておく受付済みメッセージ ID の数
+INGEST_DEDUP_CACHE_SIZE = int(os.getenv("INGEST_DEDUP_CACHE_SIZE", "10000"))
+# processed_messages を残しておく秒数 (これより古い再送は新しいメッセージとして扱う)
+INGEST_DEDUP_RETENTION = float(
+    os.getenv("INGEST_DEDUP_RETENTION", str(30 * 24 * 3600))
+)
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    SQLite の webhook_jobs テーブルを使ったジョブキュー
+
+    handler(payload) は (結果の dict, ステータスコード) を返す。
+    5xx または例外は失敗として再試行、それ以外は完了として扱う
+    """
+
+    def __init__(
+        self,
+        handler,
+        workers=INGEST_WORKERS,
+        max_attempts=INGEST_MAX_ATTEMPTS,
+        retry_delay=INGEST_RETRY_DELAY,
+        poll_interval=INGEST_POLL_INTERVAL,
+    ):
+        self._handler = handler
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        # 受付済みメッセージ ID -> 最初のジョブ ID
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self._duplicates = 0
+
+    def _remember(self, message_id, job_id, duplicate=False):
+        with self._seen_lock:
+            self._seen[message_id] = job_id
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > INGEST_DEDUP_CACHE_SIZE:
+                self._seen.popitem(last=False)
+            if duplicate:
+                self._duplicates += 1
+
+    def _recall(self, message_id):
+        """
+        受付済みなら (最初のジョブ ID,)、LRU に無ければ None
+        """
+        with self._seen_lock:
+            if message_id not in self._seen:
+                return None
+            self._seen.move_to_end(message_id)
+            self._duplicates += 1
+            return (self._seen[message_id],)
+
+    def enqueue(self, payload, message_id=None):
+        """
+        ジョブを積んでコミットし、(ジョブ ID, 新しく積んだか) を返す
+        message_id が受付済みなら積まずに (最初のジョブ ID, False) を返す
+        """
+        if message_id is not None:
+            message_id = str(message_id)
+            seen = self._recall(message_id)
+            if seen is not None:
+                return seen[0], False
+
+        now = time.time()
+        payload = json.dumps(payload, ensure_ascii=False)
+
+        def write(conn):
+            if message_id is not None:
+                # 主キーで弾かれたら他のリクエスト (別プロセス含む) が先に受け付けている
+                claimed = conn.execute(
+                    """
+                    INSERT INTO processed_messages (msg_id, received_at)
+                    VALUES (?, ?)
+                    ON CONFLICT (msg_id) DO NOTHING
+                """,
+                    (message_id, now),
+                ).rowcount
+                if not claimed:
+                    first = conn.execute(
+                        "SELECT job_id FROM processed_messages WHERE msg_id = ?",
+                        (message_id,),
+                    ).fetchone()
+                    return first[0], False
+            cursor = conn.execute(
+                """
+                INSERT INTO webhook_jobs (payload, status, attempts, enqueued_at, next_run_at)
+                VALUES (?, 'pending', 0, ?, ?)
+            """,
+                (payload, now, now),
+            )
+            if message_id is not None:
+                conn.execute(
+                    "UPDATE processed_messages SET job_id = ? WHERE msg_id = ?",
+                    (cursor.lastrowid, message_id),
+                )
+            return cursor.lastrowid, True
+
+        job_id, created = get_writer().run(write)
+        if message_id is not None:
+            self._remember(message_id, job_id, duplicate=not created)
+        if not created:
+            return job_id, False
+        self.start()
+        self._wakeup.set()
+        return job_id, True
+
+    def start(self):
+        """
+        このプロセスのワーカースレッドを起動する (起動済みなら何もしない)
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(
+                    target=self._worker_loop, name=f"ingest-{i}", daemon=True
+                )
+                for i in range(self._workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout=None):
+        """
+        新しいジョブの取得をやめ、実行中のジョブが終わるまで待つ
+        timeout はスレッドごとではなく全体で待つ秒数
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            thread.join(timeout)
+        self._threads = []
+        self._pid = None
+
+    def _claim(self):
+        now = time.time()
+        return get_writer().run(
+            lambda conn: conn.execute(
+                """
+                UPDATE webhook_jobs
+                SET status = 'running', started_at = ?, attempts = attempts + 1
+                WHERE id = (
+                    SELECT id FROM webhook_jobs
+                    WHERE (status = 'pending' AND next_run_at <= ?)
+                        OR (status = 'running' AND started_at < ?)
+                    ORDER BY id
+                    LIMIT 1
+                )
+                RETURNING id, payload, attempts, enqueued_at
+            """,
+                (now, now, now - INGEST_JOB_TIMEOUT),
+            ).fetchone()
+        )
+
+    def _finish(self, job_id, status, error=None, next_run_at=None):
+        finished_at = time.time()
+        get_writer().run(
+            lambda conn: conn.execute(
+                """
+                UPDATE webhook_jobs
+                SET status = ?, finished_at = ?, last_error = ?,
+                    next_run_at = COALESCE(?, next_run_at)
+                WHERE id = ?
+            """,
+                (status, finished_at, error, next_run_at, job_id),
+            )
+        )
+
+    def _run(self, job):
+        job_id, payload, attempts = job["id"], job["payload"], job["attempts"]
+        try:
+            result, code = self._handler(json.loads(payload))
+            error = None if code < 500 else json.dumps(result, ensure_ascii=False)
+        except Exception as e:
+            logger.exception("ingest job %s 失敗！！", job_id)
+            error = repr(e)
+
+        if error is None:
+            self._finish(job_id, "done")
+        elif attempts >= self._max_attempts:
+            logger.error(
+                "ingest job %s dead (attempts=%s): %s", job_id, attempts, error
+            )
+            self._finish(job_id, "dead", error)
+        else:
+            delay = self._retry_delay * 2 ** (attempts - 1)
+            logger.warning("ingest job %s retry in %ss: %s", job_id, delay, error)
+            self._finish(job_id, "pending", error, time.time() + delay)
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+                if job is None:
+                    self._purge()
+                    self._wakeup.wait(self._poll_interval)
+                    # 停止中は消さずに残し、他のワーカーも待たずに抜けさせる
+                    if not self._stopping.is_set():
+                        self._wakeup.clear()
+                    continue
+                self._run(job)
+            except Exception:
+                logger.exception("ingest worker エラー")
+                self._stopping.wait(self._poll_interval)
+
+    def _purge(self):
+        now = time.time()
+        if now - self._last_purge < 600:
+            return
+        self._last_purge = now
+
+        def write(conn):
+            conn.execute(
+                "DELETE FROM webhook_jobs WHERE status = 'done' AND finished_at < ?",
+                (now - INGEST_RETENTION,),
+            )
+            conn.execute(
+                "DELETE FROM processed_messages WHERE received_at < ?",
+                (now - INGEST_DEDUP_RETENTION,),
+            )
+
+        get_writer().run(write)
+
+    def stats(self):
+        """
+        キューの深さ・状態ごとの件数・直近の処理時間を返す
+        duplicates はこのプロセスで弾いた再送の数
+        """
+        now = time.time()
+        conn = get_db()
+        counts = {
+            row["status"]: row["n"]
+            for row in conn.execute(
+                "SELECT status, COUNT(*) AS n FROM webhook_jobs GROUP BY status"
+            )
+        }
+        oldest = conn.execute(
+            "SELECT MIN(enqueued_at) FROM webhook_jobs WHERE status = 'pending'"
+        ).fetchone()[0]
+        recent = conn.execute(
+            """
+            SELECT
+                COUNT(*) AS n,
+                AVG(finished_at - enqueued_at) AS avg_latency,
+                MAX(finished_at - enqueued_at) AS max_latency,
+                AVG(finished_at - started_at) AS avg_run_time
+            FROM webhook_jobs
+            WHERE status = 'done' AND finished_at >= ?
+        """,
+            (now - STATS_WINDOW,),
+        ).fetchone()
+        failed = conn.execute(
+            """
+            SELECT COUNT(*) FROM webhook_jobs
+            WHERE last_error IS NOT NULL AND finished_at >= ?
+        """,
+            (now - STATS_WINDOW,),
+        ).fetchone()[0]
+        return {
+            "depth": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "dead": counts.get("dead", 0),
+            "oldest_pending_age": (now - oldest) if oldest else 0,
+            "workers": len(self._threads),
+            "window_seconds": STATS_WINDOW,
+            "window_done": recent["n"],
+            "window_failures": failed,
+            "avg_latency": recent["avg_latency"],
+            "max_latency": recent["max_latency"],
+            "avg_run_time": recent["avg_run_time"],
+            "duplicates": self._duplicates,
+        }
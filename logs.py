@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+ログの設定
+
+print の代わりに logging を使い、1 行 1 件の JSON (LOG_FORMAT=text なら従来に近い 1 行) で出す。
+logger.info("...", extra={"msg_id": ...}) のように渡した値は JSON の項目になる
+
+LOG_LEVEL：出力するレベル (既定 INFO)
+LOG_PAYLOAD_SAMPLE：LOG_LEVEL=DEBUG の時に webhook の受信内容を丸ごと記録する割合 (0〜1)
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json / text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_PAYLOAD_SAMPLE = float(os.getenv("LOG_PAYLOAD_SAMPLE", "1"))
+
+# LogRecord が元から持つ属性 (これ以外は extra で渡された項目)
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        extra = {
+            key: value
+            for key, value in vars(record).items()
+            if key not in _RESERVED and not key.startswith("_")
+        }
+        if extra:
+            line += " " + json.dumps(extra, ensure_ascii=False, default=str)
+        return line
+
+
+def setup_logging():
+    """
+    ルートロガーに標準エラーへの出力を設定する (2 回目以降は何もしない)
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        handler = logging.StreamHandler(sys.stderr)
+        if LOG_FORMAT == "text":
+            handler.setFormatter(
+                TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+            )
+        else:
+            handler.setFormatter(JsonFormatter())
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        _configured = True
+
+
+def sample_payload():
+    """
+    この webhook の受信内容を記録するか (LOG_PAYLOAD_SAMPLE の割合で True)
+    """
+    return LOG_PAYLOAD_SAMPLE >= 1 or random.random() < LOG_PAYLOAD_SAMPLE
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+webhook で届いたメッセージの種類の判定と、報告テンプレートの項目の取り出し
+
+種類は種類表 (TEMPLATES)、項目は項目表 (FIELDS) に従って判定・抽出する。
+見出しは表から組み立てた 1 つの正規表現で 1 回の走査で全て拾い、
+【①指示】 のほか、番号なし・半角/全角の括弧や数字・前後の空白、
+既知の打ち間違い (浦考) も受け付ける。新しいテンプレートは表に足すか、
+MessageParser に別の表を渡して使う
+"""
+import re
+from collections import namedtuple
+
+
+# key：結果の fields のキー、labels：見出しとして受け付ける語
+Field = namedtuple("Field", ["key", "labels"])
+
+# 上から順に判定し、最初に当てはまったものをその種類とする
+# keywords：本文にすべて含まれている語、exact：本文全体と一致する文字列、
+# msg_type：msg["type"] の値、requires：値が空でない必要がある msg のキー
+Template = namedtuple(
+    "Template",
+    ["kind", "keywords", "exact", "msg_type", "requires"],
+    defaults=((), None, None, ()),
+)
+
+# kind：TEMPLATES のどれにも当てはまらなければ "unknown"
+# fields：FIELDS の全キー (見出しが無かった項目は "")
+ParsedMessage = namedtuple("ParsedMessage", ["kind", "fields"])
+
+
+FIELDS = (
+    Field("①指示", ("指示",)),
+    Field("②状況", ("状況",)),
+    Field("③緊急度", ("緊急度",)),
+    Field("④お客様情報", ("お客様情報", "お客さま情報")),
+    Field("⑤備考", ("備考", "浦考")),
+)
+
+TEMPLATES = (
+    Template("report", keywords=("指示", "状況", "緊急度")),
+    Template("location", keywords=("位置情報を送信しました",), requires=("extra",)),
+    Template("image", msg_type="image"),
+    Template("carousel", exact="テストカルーセル"),
+)
+
+# 見出しの前後に置かれうるもの (半角/全角の空白、括弧、番号)
+_SPACE = r"[ \t　]*"
+_OPEN = r"[【\[［〔(（]"
+_CLOSE = r"[】\]］〕)）]"
+_NUMBER = r"(?:[①-⑳]|[0-9０-９]{1,2}[.．、]?)?"
+
+
+class MessageParser:
+    """
+    項目表・種類表から組み立てた正規表現でメッセージを解析する
+    """
+
+    def __init__(self, fields=FIELDS, templates=TEMPLATES):
+        self.fields = tuple(fields)
+        self.templates = tuple(templates)
+        self._key_of = {
+            label: field.key for field in self.fields for label in field.labels
+        }
+        self._empty = dict.fromkeys((field.key for field in self.fields), "")
+        # 長い語を先に並べ、短い語が長い語の一部に先に当たらないようにする
+        labels = "|".join(
+            re.escape(label) for label in sorted(self._key_of, key=len, reverse=True)
+        )
+        self._pattern = re.compile(
+            rf"^{_SPACE}{_OPEN}{_SPACE}{_NUMBER}{_SPACE}({labels}){_SPACE}{_CLOSE}"
+            r"([^\r\n]*)",
+            re.MULTILINE,
+        )
+
+    def fields_of(self, body):
+        """
+        本文から全項目の値を取り出す (同じ項目が複数あれば後のものを使う)
+        """
+        values = self._empty.copy()
+        for label, value in self._pattern.findall(body):
+            values[self._key_of[label]] = value.strip()
+        return values
+
+    def parse(self, msg):
+        """
+        msg (webhook の "msg") の種類と項目を ParsedMessage で返す
+        """
+        body = msg.get("body") or ""
+        fields = self.fields_of(body)
+        for template in self.templates:
+            if template.exact is not None and body != template.exact:
+                continue
+            if template.msg_type is not None and msg.get("type") != template.msg_type:
+                continue
+            # キーワードは正規表現に混ぜるより部分文字列の検索の方が速い
+            if not all(word in body for word in template.keywords):
+                continue
+            if not all(msg.get(key) for key in template.requires):
+                continue
+            return ParsedMessage(template.kind, fields)
+        return ParsedMessage("unknown", fields)
+
+
+_parser = MessageParser()
+
+
+def parse_message(msg):
+    """
+    既定の表でメッセージを解析する
+    """
+    return _parser.parse(msg)
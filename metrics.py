@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+処理時間・回数の計測と /metrics (Prometheus のテキスト形式) への出力
+
+・http_request_duration_seconds：ルートごとの応答時間 (SSE は応答開始まで)
+・stage_duration_seconds：処理段階ごとの時間 (parse / db_query / db_commit /
+  token_fetch / image_download / outbound_message)
+・sqlite_queries_per_request：1 リクエストで実行した SQL の数 (トリガー内の文も数える)
+・outbound_http_requests_total / outbound_http_duration_seconds：Elgana への通信の
+  ステータスごとの回数と時間
+
+値はプロセスごとに持つ。gunicorn で複数ワーカーを動かす場合は、
+取得したワーカーの分だけが返る
+
+db.py・書き込みスレッドなどからも使うので Flask には依存しない
+(リクエストごとの記録は request_metrics.py が Flask に登録する)
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# SQL の実行回数を数える (接続ごとに trace callback を付ける)
+METRICS_SQL_TRACE = os.getenv("METRICS_SQL_TRACE", "1") == "1"
+
+# 秒単位のヒストグラムの区切り
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, count in items:
+            lines.append(
+                f"{self.name}{_format_labels(self.labels, values)} {_format_number(count)}"
+            )
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # ラベルの値 -> [区切りごとの件数..., 合計, 件数]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, values, [le])}"
+                    f" {cumulative}"
+                )
+            le = 'le="+Inf"'
+            lines.append(
+                f"{self.name}_bucket{_format_labels(self.labels, values, [le])}"
+                f" {series[-1]}"
+            )
+            labels = _format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {_format_number(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "HTTP response time by route",
+    ("route", "method", "status"),
+)
+stage_duration = Histogram(
+    "stage_duration_seconds", "Time spent in each processing stage", ("stage",)
+)
+sqlite_queries = Histogram(
+    "sqlite_queries_per_request",
+    "SQL statements executed per HTTP request",
+    ("route",),
+    buckets=COUNT_BUCKETS,
+)
+outbound_requests = Counter(
+    "outbound_http_requests_total",
+    "Outbound HTTP requests by endpoint and status",
+    ("endpoint", "status"),
+)
+outbound_duration = Histogram(
+    "outbound_http_duration_seconds",
+    "Outbound HTTP time to response headers",
+    ("endpoint",),
+)
+
+_registry = [
+    http_request_duration,
+    stage_duration,
+    sqlite_queries,
+    outbound_requests,
+    outbound_duration,
+]
+# /metrics の度に呼ぶ {名前: ("gauge" / "counter", 説明, 値)} を返す関数
+# (キューの深さなど、他で数えている値用)
+_collectors = []
+
+
+def register_collector(collect):
+    _collectors.append(collect)
+
+
+@contextmanager
+def timed(stage):
+    """
+    with timed("parse"): の中の処理時間を stage_duration_seconds に記録する
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(time.perf_counter() - started, stage)
+
+
+def count_query(statement):
+    """
+    sqlite3 の trace callback。このスレッドの SQL 実行数を数える
+    """
+    _local.queries = getattr(_local, "queries", 0) + 1
+
+
+def install_query_counter(conn):
+    if METRICS_SQL_TRACE:
+        conn.set_trace_callback(count_query)
+
+
+def queries_so_far():
+    return getattr(_local, "queries", 0)
+
+
+def record_outbound(endpoint, status, seconds):
+    outbound_requests.inc(endpoint, str(status))
+    outbound_duration.observe(seconds, endpoint)
+
+
+def render():
+    """
+    Prometheus のテキスト形式で全ての値を返す
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, (kind, help, value) in collect().items():
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {_format_number(value)}")
+    return "\n".join(lines) + "\n"
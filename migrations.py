@@ -0,0 +1,861 @@
+# -*- coding: utf-8 -*-
+"""
+locations.db のスキーマ移行
+
+PRAGMA user_version に適用済みのバージョンを記録し、
+未適用の移行だけを番号順に 1 トランザクションずつ流す
+
+python migrations.py で DB_PATH の DB に適用する
+(gunicorn.conf.py がワーカーの fork 前にマスターから 1 回だけ呼ぶ)
+"""
+import logging
+import sys
+import time
+
+from archive import upgrade_archive
+from db import DB_PATH, connect
+from logs import setup_logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn, table, column, decl):
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _v1_base_tables(conn):
+    """
+    運用中の DB と同じ形でテーブルを作成 (既にあれば何もしない)
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS operation_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            msg_id TEXT,
+            room_id TEXT,
+            user_id TEXT,
+            location_id TEXT,
+            latitude REAL,
+            longitude REAL,
+            instruction_id TEXT,
+            instruction TEXT,
+            status TEXT,
+            urgency TEXT,
+            customer_info TEXT,
+            remarks TEXT,
+            received_at TEXT,
+            completed TEXT,
+            update_at TEXT,
+            signal TEXT
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS spot_info (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            msg_id TEXT,
+            user_id TEXT,
+            image_id TEXT,
+            repair_required TEXT,
+            height TEXT,
+            width TEXT,
+            depth TEXT,
+            cost TEXT,
+            term TEXT,
+            image_url TEXT,
+            image_filename TEXT,
+            status_flag TEXT,
+            deleted TEXT,
+            create_at TEXT
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_info (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            user_name TEXT,
+            org TEXT,
+            email_address TEXT
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rooms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id TEXT,
+            room_name TEXT,
+            creator TEXT,
+            create_at TEXT,
+            total_count INT,
+            completed_count INT,
+            incomplete_count INT
+        )
+    """
+    )
+
+
+def _v2_reconcile_columns(conn):
+    """
+    旧 init_db で作成された DB のカラムを運用中の形に揃える
+    (hight -> height の改名と、後から追加されたカラム)
+    """
+    spot_columns = _columns(conn, "spot_info")
+    if "hight" in spot_columns and "height" not in spot_columns:
+        conn.execute("ALTER TABLE spot_info RENAME COLUMN hight TO height")
+
+    _add_column(conn, "operation_orders", "signal", "TEXT")
+    for column in ("user_id", "height", "cost", "term", "status_flag", "create_at"):
+        _add_column(conn, "spot_info", column, "TEXT")
+    for column in ("total_count", "completed_count", "incomplete_count"):
+        _add_column(conn, "rooms", column, "INT")
+
+
+def _v3_indexes(conn):
+    """
+    msg_id / user_id で引く箇所のインデックス
+    """
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_operation_orders_msg_id "
+        "ON operation_orders (msg_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_spot_info_msg_id_image_url "
+        "ON spot_info (msg_id, image_url)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_info_user_id ON user_info (user_id)"
+    )
+
+
+def _v4_webhook_jobs(conn):
+    """
+    webhook の非同期取り込み用ジョブテーブル (ingest.py)
+    時刻は処理時間を計算しやすいよう UNIX 時間 (秒) で持つ
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS webhook_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            enqueued_at REAL NOT NULL,
+            next_run_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            last_error TEXT
+        )
+    """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_webhook_jobs_status_next_run "
+        "ON webhook_jobs (status, next_run_at)"
+    )
+
+
+def _v5_spot_derivatives(conn):
+    """
+    派生画像 (サムネイル・中サイズ) の URL と寸法 (image_derivatives.py)
+    """
+    for size in ("thumb", "medium"):
+        _add_column(conn, "spot_info", f"{size}_url", "TEXT")
+        _add_column(conn, "spot_info", f"{size}_width", "INTEGER")
+        _add_column(conn, "spot_info", f"{size}_height", "INTEGER")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_spot_info_image_filename "
+        "ON spot_info (image_filename)"
+    )
+
+
+def _v6_change_tracking(conn):
+    """
+    /get_locations の差分取得用 (updated_since)
+
+    sync_state の seq を変更のたびに 1 つ進め、変わった案件の row_seq にその値を入れる。
+    spot_info・user_info の変更も案件の変更として数え、削除された案件は
+    order_tombstones に残す。外部システムからの書き込みも拾えるようトリガーで行う
+    既存の行は row_seq = 0 (全件取得で取り直す前提)
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )
+    """
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO sync_state (name, seq) VALUES ('locations', 0)"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS order_tombstones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            msg_id TEXT,
+            seq INTEGER NOT NULL
+        )
+    """
+    )
+    _add_column(conn, "operation_orders", "row_seq", "INTEGER NOT NULL DEFAULT 0")
+
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_operation_orders_row_seq "
+        "ON operation_orders (row_seq)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_operation_orders_room_id "
+        "ON operation_orders (room_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_operation_orders_lat_lon "
+        "ON operation_orders (latitude, longitude)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_order_tombstones_seq ON order_tombstones (seq)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_spot_info_user_id ON spot_info (user_id)"
+    )
+
+    # seq を進めて、条件に合う案件の row_seq に入れる
+    bump = """
+            UPDATE sync_state SET seq = seq + 1 WHERE name = 'locations';
+            UPDATE operation_orders
+            SET row_seq = (SELECT seq FROM sync_state WHERE name = 'locations')
+            WHERE {where};
+    """
+    tombstone = """
+            UPDATE sync_state SET seq = seq + 1 WHERE name = 'locations';
+            INSERT INTO order_tombstones (msg_id, seq)
+            SELECT OLD.msg_id, seq FROM sync_state WHERE name = 'locations';
+    """
+    triggers = {
+        "trg_orders_insert_seq": (
+            "AFTER INSERT ON operation_orders",
+            bump.format(where="id = NEW.id"),
+        ),
+        # row_seq だけを書き換える更新 (このトリガー自身や spot_info 側) では動かさない
+        "trg_orders_update_seq": (
+            "AFTER UPDATE ON operation_orders WHEN NEW.row_seq IS OLD.row_seq",
+            bump.format(where="id = NEW.id"),
+        ),
+        "trg_orders_rekey_tombstone": (
+            "AFTER UPDATE OF msg_id ON operation_orders "
+            "WHEN NEW.msg_id IS NOT OLD.msg_id",
+            tombstone,
+        ),
+        "trg_orders_delete_tombstone": ("AFTER DELETE ON operation_orders", tombstone),
+        "trg_spot_insert_seq": (
+            "AFTER INSERT ON spot_info",
+            bump.format(where="msg_id = NEW.msg_id"),
+        ),
+        "trg_spot_update_seq": (
+            "AFTER UPDATE ON spot_info",
+            bump.format(where="msg_id IN (OLD.msg_id, NEW.msg_id)"),
+        ),
+        "trg_spot_delete_seq": (
+            "AFTER DELETE ON spot_info",
+            bump.format(where="msg_id = OLD.msg_id"),
+        ),
+        # 撮影者名などは user_info から JOIN して返すので、その変更も案件の変更にする
+        "trg_user_insert_seq": (
+            "AFTER INSERT ON user_info",
+            bump.format(
+                where="msg_id IN "
+                "(SELECT msg_id FROM spot_info WHERE user_id = NEW.user_id)"
+            ),
+        ),
+        "trg_user_update_seq": (
+            "AFTER UPDATE ON user_info",
+            bump.format(
+                where="msg_id IN (SELECT msg_id FROM spot_info "
+                "WHERE user_id IN (OLD.user_id, NEW.user_id))"
+            ),
+        ),
+        "trg_user_delete_seq": (
+            "AFTER DELETE ON user_info",
+            bump.format(
+                where="msg_id IN "
+                "(SELECT msg_id FROM spot_info WHERE user_id = OLD.user_id)"
+            ),
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+
+# 案件の operation_status (get_locations と同じ判定。o は operation_orders)
+OPERATION_STATUS_SQL = """
+    CASE
+        WHEN o.completed IS NOT NULL AND o.completed != '' THEN '3'
+        WHEN EXISTS (
+            SELECT 1 FROM spot_info AS s
+            INNER JOIN user_info AS u ON s.user_id = u.user_id
+            WHERE s.msg_id = o.msg_id
+                AND s.status_flag = '1' AND s.repair_required = 'false'
+        ) THEN '2'
+        WHEN EXISTS (
+            SELECT 1 FROM spot_info AS s
+            INNER JOIN user_info AS u ON s.user_id = u.user_id
+            WHERE s.msg_id = o.msg_id
+                AND s.status_flag = '1' AND s.repair_required = 'true'
+        ) THEN '1'
+        ELSE '0'
+    END
+"""
+
+
+# map_points の 1 件 (NEW) を全ズームのセルに足す (map_points のトリガーの中で使う)
+ADD_TO_CELLS_SQL = """
+            INSERT INTO map_cells
+                (z, cx, cy, urgency, operation_status, n, lat_sum, lon_sum)
+            SELECT
+                z,
+                CAST((NEW.longitude + 180) / cell_deg AS INTEGER),
+                CAST((NEW.latitude + 90) / cell_deg AS INTEGER),
+                NEW.urgency,
+                NEW.operation_status,
+                1,
+                NEW.latitude,
+                NEW.longitude
+            FROM map_zoom_levels
+            WHERE true
+            ON CONFLICT (z, cx, cy, urgency, operation_status) DO UPDATE SET
+                n = n + 1,
+                lat_sum = lat_sum + excluded.lat_sum,
+                lon_sum = lon_sum + excluded.lon_sum;
+"""
+
+
+def _v7_map_clusters(conn):
+    """
+    地図のクラスター表示用の集計 (/get_clusters)
+
+    map_points：地図に出す案件 (非表示・座標なしを除く) の座標・緊急度・operation_status
+    map_cells ：ズームごとのグリッドのセル × 緊急度 × operation_status ごとの件数と座標の合計
+    セルの大きさは 256px のタイルを 4 × 4 に分けた幅 (360 / 2^(z+2) 度)。
+    案件が変わると v6 のトリガーが row_seq を書き換えるので、それを契機に作り直す
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS map_zoom_levels (
+            z INTEGER PRIMARY KEY,
+            cell_deg REAL NOT NULL
+        )
+    """
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO map_zoom_levels (z, cell_deg) VALUES (?, ?)",
+        [(z, 360 / 2 ** (z + 2)) for z in range(16)],
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS map_points (
+            order_id INTEGER PRIMARY KEY,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            urgency TEXT NOT NULL,
+            operation_status TEXT NOT NULL
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS map_cells (
+            z INTEGER NOT NULL,
+            cx INTEGER NOT NULL,
+            cy INTEGER NOT NULL,
+            urgency TEXT NOT NULL,
+            operation_status TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            lat_sum REAL NOT NULL,
+            lon_sum REAL NOT NULL,
+            PRIMARY KEY (z, cx, cy, urgency, operation_status)
+        ) WITHOUT ROWID
+    """
+    )
+    # 件数が 0 になったセルを消すため
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_map_cells_empty ON map_cells (n) WHERE n <= 0"
+    )
+
+    remove_from_cells = """
+            UPDATE map_cells
+            SET
+                n = n - 1,
+                lat_sum = lat_sum - OLD.latitude,
+                lon_sum = lon_sum - OLD.longitude
+            FROM map_zoom_levels AS l
+            WHERE map_cells.z = l.z
+                AND map_cells.cx = CAST((OLD.longitude + 180) / l.cell_deg AS INTEGER)
+                AND map_cells.cy = CAST((OLD.latitude + 90) / l.cell_deg AS INTEGER)
+                AND map_cells.urgency = OLD.urgency
+                AND map_cells.operation_status = OLD.operation_status;
+            DELETE FROM map_cells WHERE n <= 0;
+    """
+    refresh_point = f"""
+            DELETE FROM map_points
+            WHERE order_id = NEW.id
+                AND (NEW.signal IS '0' OR NEW.latitude IS NULL OR NEW.longitude IS NULL);
+            INSERT INTO map_points
+                (order_id, latitude, longitude, urgency, operation_status)
+            SELECT
+                o.id,
+                o.latitude,
+                o.longitude,
+                COALESCE(o.urgency, ''),
+                {OPERATION_STATUS_SQL}
+            FROM operation_orders AS o
+            WHERE o.id = NEW.id
+                AND o.signal IS NOT '0'
+                AND o.latitude IS NOT NULL
+                AND o.longitude IS NOT NULL
+            ON CONFLICT (order_id) DO UPDATE SET
+                latitude = excluded.latitude,
+                longitude = excluded.longitude,
+                urgency = excluded.urgency,
+                operation_status = excluded.operation_status
+            WHERE latitude IS NOT excluded.latitude
+                OR longitude IS NOT excluded.longitude
+                OR urgency IS NOT excluded.urgency
+                OR operation_status IS NOT excluded.operation_status;
+    """
+    triggers = {
+        "trg_map_points_insert": ("AFTER INSERT ON map_points", ADD_TO_CELLS_SQL),
+        "trg_map_points_update": (
+            "AFTER UPDATE ON map_points",
+            remove_from_cells + ADD_TO_CELLS_SQL,
+        ),
+        "trg_map_points_delete": ("AFTER DELETE ON map_points", remove_from_cells),
+        # 案件・画像・撮影者のどれが変わっても row_seq が書き換わる (v6)
+        "trg_orders_refresh_map_point": (
+            "AFTER UPDATE OF row_seq ON operation_orders",
+            refresh_point,
+        ),
+        "trg_orders_delete_map_point": (
+            "AFTER DELETE ON operation_orders",
+            "DELETE FROM map_points WHERE order_id = OLD.id;",
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+    # 既存の案件を取り込む (map_points のトリガーで map_cells も埋まる)
+    conn.execute(
+        f"""
+        INSERT OR IGNORE INTO map_points
+            (order_id, latitude, longitude, urgency, operation_status)
+        SELECT
+            o.id,
+            o.latitude,
+            o.longitude,
+            COALESCE(o.urgency, ''),
+            {OPERATION_STATUS_SQL}
+        FROM operation_orders AS o
+        WHERE o.signal IS NOT '0'
+            AND o.latitude IS NOT NULL
+            AND o.longitude IS NOT NULL
+    """
+    )
+
+
+def _v8_order_rtree(conn):
+    """
+    案件の座標の R*Tree (spatial.py の近傍検索) と、重複の可能性の記録先
+
+    座標は幅 0 の矩形として入れる。R*Tree は 32bit 浮動小数点で外側に丸めて持つので、
+    範囲で絞った後の距離判定は operation_orders 側の座標で行う
+    """
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS order_rtree USING rtree (
+            id,
+            min_lat, max_lat,
+            min_lon, max_lon
+        )
+    """
+    )
+    # 近くにあった未完了の案件の msg_id (spatial.find_duplicate)
+    _add_column(conn, "operation_orders", "duplicate_of", "TEXT")
+
+    upsert = """
+            DELETE FROM order_rtree WHERE id = NEW.id;
+            INSERT INTO order_rtree (id, min_lat, max_lat, min_lon, max_lon)
+            SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+    """
+    triggers = {
+        "trg_orders_insert_rtree": ("AFTER INSERT ON operation_orders", upsert),
+        "trg_orders_update_rtree": (
+            "AFTER UPDATE OF latitude, longitude ON operation_orders",
+            upsert,
+        ),
+        "trg_orders_delete_rtree": (
+            "AFTER DELETE ON operation_orders",
+            "DELETE FROM order_rtree WHERE id = OLD.id;",
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO order_rtree (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT id, latitude, latitude, longitude, longitude
+        FROM operation_orders
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+    """
+    )
+
+
+# rooms の件数を operation_orders から数え直す (WHERE を足して対象の部屋を絞れる)
+ROOM_COUNTS_SQL = """
+    UPDATE rooms
+    SET
+        total_count = (
+            SELECT COUNT(*) FROM operation_orders AS o
+            WHERE o.room_id = rooms.room_id
+                AND o.operation_status IS NOT NULL AND o.signal IS NOT '0'
+        ),
+        completed_count = (
+            SELECT COUNT(*) FROM operation_orders AS o
+            WHERE o.room_id = rooms.room_id
+                AND o.operation_status = '3' AND o.signal IS NOT '0'
+        ),
+        incomplete_count = (
+            SELECT COUNT(*) FROM operation_orders AS o
+            WHERE o.room_id = rooms.room_id
+                AND o.operation_status != '3' AND o.signal IS NOT '0'
+        )
+"""
+
+
+def _v9_materialized_status(conn):
+    """
+    get_locations が毎回計算していた値を書き込み時に持つ
+
+    spot_info.bucket：画像の区分 (0 発見 / 1 作業前 / 2 作業後 / NULL どれでもない)。生成列
+    operation_orders.operation_status：0〜3。row_seq が変わった時 (v6) に計算し直す
+    rooms の total_count / completed_count / incomplete_count：
+        表示対象 (signal != '0') の案件数。operation_status・signal・room_id の変化で増減する
+    整合性の確認・修復は consistency.py
+    """
+    _add_column(
+        conn,
+        "spot_info",
+        "bucket",
+        """INTEGER GENERATED ALWAYS AS (
+            CASE
+                WHEN status_flag = '0' THEN 0
+                WHEN status_flag = '1' AND repair_required = 'true' THEN 1
+                WHEN status_flag = '1' AND repair_required = 'false' THEN 2
+            END
+        ) VIRTUAL""",
+    )
+    _add_column(conn, "operation_orders", "operation_status", "TEXT")
+    conn.execute("DROP INDEX IF EXISTS idx_operation_orders_room_id")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_operation_orders_room_status "
+        "ON operation_orders (room_id, operation_status)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_operation_orders_status "
+        "ON operation_orders (operation_status)"
+    )
+
+    # operation_status だけが変わる更新 (下の再計算) では row_seq を進めない
+    conn.execute("DROP TRIGGER IF EXISTS trg_orders_update_seq")
+    conn.execute(
+        """
+        CREATE TRIGGER trg_orders_update_seq
+        AFTER UPDATE ON operation_orders
+        WHEN NEW.row_seq IS OLD.row_seq
+            AND NEW.operation_status IS OLD.operation_status
+        BEGIN
+            UPDATE sync_state SET seq = seq + 1 WHERE name = 'locations';
+            UPDATE operation_orders
+            SET row_seq = (SELECT seq FROM sync_state WHERE name = 'locations')
+            WHERE id = NEW.id;
+        END
+    """
+    )
+    # 案件 1 件の operation_status (UPDATE operation_orders の中で使う)
+    status_of_row = f"""(
+                SELECT {OPERATION_STATUS_SQL}
+                FROM operation_orders AS o
+                WHERE o.id = operation_orders.id
+            )"""
+    # operation_status を計算し直してから map_points (v7) に反映する
+    conn.execute("DROP TRIGGER IF EXISTS trg_orders_refresh_map_point")
+    conn.execute(
+        f"""
+        CREATE TRIGGER trg_orders_refresh_derived
+        AFTER UPDATE OF row_seq ON operation_orders
+        BEGIN
+            UPDATE operation_orders
+            SET operation_status = {status_of_row}
+            WHERE id = NEW.id AND operation_status IS NOT {status_of_row};
+            DELETE FROM map_points
+            WHERE order_id = NEW.id
+                AND (NEW.signal IS '0' OR NEW.latitude IS NULL OR NEW.longitude IS NULL);
+            INSERT INTO map_points
+                (order_id, latitude, longitude, urgency, operation_status)
+            SELECT
+                o.id,
+                o.latitude,
+                o.longitude,
+                COALESCE(o.urgency, ''),
+                o.operation_status
+            FROM operation_orders AS o
+            WHERE o.id = NEW.id
+                AND o.signal IS NOT '0'
+                AND o.latitude IS NOT NULL
+                AND o.longitude IS NOT NULL
+            ON CONFLICT (order_id) DO UPDATE SET
+                latitude = excluded.latitude,
+                longitude = excluded.longitude,
+                urgency = excluded.urgency,
+                operation_status = excluded.operation_status
+            WHERE latitude IS NOT excluded.latitude
+                OR longitude IS NOT excluded.longitude
+                OR urgency IS NOT excluded.urgency
+                OR operation_status IS NOT excluded.operation_status;
+        END
+    """
+    )
+
+    # 既存の案件の operation_status (row_seq は進めない)
+    conn.execute(f"UPDATE operation_orders SET operation_status = {status_of_row}")
+
+    # 数える対象なら +1 / -1 する
+    count = """
+            UPDATE rooms
+            SET
+                total_count = total_count {sign} 1,
+                completed_count = completed_count {sign} ({row}.operation_status = '3'),
+                incomplete_count = incomplete_count {sign} ({row}.operation_status != '3')
+            WHERE room_id = {row}.room_id
+                AND {row}.operation_status IS NOT NULL AND {row}.signal IS NOT '0';
+    """
+    triggers = {
+        "trg_orders_insert_room_counts": (
+            "AFTER INSERT ON operation_orders",
+            count.format(sign="+", row="NEW"),
+        ),
+        "trg_orders_update_room_counts": (
+            "AFTER UPDATE OF operation_status, signal, room_id ON operation_orders",
+            count.format(sign="-", row="OLD") + count.format(sign="+", row="NEW"),
+        ),
+        "trg_orders_delete_room_counts": (
+            "AFTER DELETE ON operation_orders",
+            count.format(sign="-", row="OLD"),
+        ),
+        # 後から作られた部屋はその場で数える
+        "trg_rooms_insert_counts": (
+            "AFTER INSERT ON rooms",
+            ROOM_COUNTS_SQL + " WHERE rooms.id = NEW.id;",
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+    conn.execute(ROOM_COUNTS_SQL)
+
+
+def _v10_processed_messages(conn):
+    """
+    webhook の再送で同じメッセージを二重に取り込まないための受付済み msg.id (ingest.py)
+    job_id は最初に積んだジョブ (既存データから拾ったものは NULL)
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            msg_id TEXT PRIMARY KEY,
+            job_id INTEGER,
+            received_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_processed_messages_received_at "
+        "ON processed_messages (received_at)"
+    )
+    # 既に積まれた・取り込まれたメッセージも再送されたら弾く
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO processed_messages (msg_id, job_id, received_at)
+        SELECT json_extract(payload, '$.msg.id'), MIN(id), MIN(enqueued_at)
+        FROM webhook_jobs
+        WHERE json_valid(payload) AND json_extract(payload, '$.msg.id') IS NOT NULL
+        GROUP BY 1
+    """
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO processed_messages (msg_id, job_id, received_at)
+        SELECT DISTINCT msg_id, NULL, CAST(strftime('%s', 'now') AS REAL)
+        FROM operation_orders
+        WHERE msg_id IS NOT NULL
+    """
+    )
+
+
+def _v11_map_cells_lookup(conn):
+    """
+    map_points の更新・削除で map_cells から引く処理を主キーで探すようにする
+
+    v7 の UPDATE ... FROM map_zoom_levels は map_cells 側を全件走査する計画になり、
+    案件の状態・位置が変わる度にセルの数 (案件数 × ズーム段階) に比例して遅くなっていた。
+    (z, cx, cy) を行値の IN で渡すと、ズーム段階ごとに主キーで 1 行を探す
+    """
+    remove_from_cells = """
+            UPDATE map_cells
+            SET
+                n = n - 1,
+                lat_sum = lat_sum - OLD.latitude,
+                lon_sum = lon_sum - OLD.longitude
+            WHERE (z, cx, cy) IN (
+                    SELECT
+                        z,
+                        CAST((OLD.longitude + 180) / cell_deg AS INTEGER),
+                        CAST((OLD.latitude + 90) / cell_deg AS INTEGER)
+                    FROM map_zoom_levels
+                )
+                AND urgency = OLD.urgency
+                AND operation_status = OLD.operation_status;
+            DELETE FROM map_cells WHERE n <= 0;
+    """
+    triggers = {
+        "trg_map_points_update": (
+            "AFTER UPDATE ON map_points",
+            remove_from_cells + ADD_TO_CELLS_SQL,
+        ),
+        "trg_map_points_delete": ("AFTER DELETE ON map_points", remove_from_cells),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
+
+
+def _v12_outbox(conn):
+    """
+    Elgana のチャットへの通知の送信待ち (outbox.py)
+    状態の変更と同じトランザクションで積み、送信は別スレッドが行う。時刻は UNIX 時間 (秒)
+    outbox_pacing.next_send_at は次に送ってよい時刻 (プロセスをまたいで送信の間隔を空ける)
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            next_run_at REAL NOT NULL,
+            started_at REAL,
+            sent_at REAL,
+            last_error TEXT
+        )
+    """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status_next_run "
+        "ON outbox (status, next_run_at)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_room_status ON outbox (room_id, status)"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox_pacing (
+            name TEXT PRIMARY KEY,
+            next_send_at REAL NOT NULL
+        )
+    """
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO outbox_pacing (name, next_send_at) VALUES ('elgana', 0)"
+    )
+
+
+# (バージョン, 移行処理) の一覧。追加する場合は末尾に番号を増やして足す
+MIGRATIONS = [
+    (1, _v1_base_tables),
+    (2, _v2_reconcile_columns),
+    (3, _v3_indexes),
+    (4, _v4_webhook_jobs),
+    (5, _v5_spot_derivatives),
+    (6, _v6_change_tracking),
+    (7, _v7_map_clusters),
+    (8, _v8_order_rtree),
+    (9, _v9_materialized_status),
+    (10, _v10_processed_messages),
+    (11, _v11_map_cells_lookup),
+    (12, _v12_outbox),
+]
+
+
+def migrate(conn):
+    """
+    未適用の移行を順に適用し、適用後のバージョンを返す
+    """
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    if current == 0 and conn.execute("SELECT 1 FROM sqlite_master").fetchone() is None:
+        # 新しい DB は archive.py が空きページを返せるよう incremental vacuum にしておく
+        # (WAL にした時点で作られたヘッダーに反映するため、空のうちに VACUUM する)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    for version, step in MIGRATIONS:
+        if version <= current:
+            continue
+        # 複数のプロセスが同時に移行しても同じ版を二重に流さないよう、
+        # 書き込みのロックを取ってから適用済みの版を読み直す
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version <= current:
+                conn.execute("COMMIT")
+                continue
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info("migration v%s 適用", version)
+        current = version
+    # アーカイブの表は読み込み側では作らないので、ここで運用中の表に合わせる
+    upgrade_archive(conn)
+    return current
+
+
+def main(argv):
+    path = argv[0] if argv else DB_PATH
+    setup_logging()
+    started = time.perf_counter()
+    conn = connect(path)
+    try:
+        version = migrate(conn)
+    finally:
+        conn.close()
+    logger.info(
+        "migrate 成功！！ %s v%s (%.0f ms)",
+        path,
+        version,
+        (time.perf_counter() - started) * 1000,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
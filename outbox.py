@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Elgana のチャットへの通知の送信待ち (transactional outbox)
+
+/completed などは通知の本文を outbox テーブルに積むだけで、状態の変更と同じ
+トランザクションでコミットする (積んだ通知は状態の変更と一緒にしか残らず、消えもしない)。
+送信はプロセスごとの送信スレッドが行うので、応答はログイン・投稿の往復を待たない
+
+・同じルーム宛ての送信待ちは OUTBOX_BATCH_MAX 件まで 1 回の投稿にまとめる
+  (ルームごとに積んだ順に送り、前の分が送れるまで後の分は送らない)
+・失敗したら間隔を空けて (試行回数ごとに 2 倍) 再試行し、上限回数を超えたものや
+  送り直しても通らない応答 (4xx) のものは dead にして残す
+・投稿の間隔は outbox_pacing で全プロセス共通に空け、OUTBOX_SEND_RATE 回/秒を超えない
+  (429 の Retry-After もここに反映する)
+
+取得・完了の書き込みは writer.py の書き込みスレッドに渡す
+"""
+import logging
+import os
+import threading
+import time
+
+from db import get_db
+from writer import get_writer
+
+
+# 1 回の投稿にまとめる通知の最大数
+OUTBOX_BATCH_MAX = int(os.getenv("OUTBOX_BATCH_MAX", "10"))
+# 全プロセス合わせた 1 秒あたりの投稿数の上限 (0 で無制限)
+OUTBOX_SEND_RATE = float(os.getenv("OUTBOX_SEND_RATE", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+# 再試行までの待ち秒数 (試行回数ごとに 2 倍、OUTBOX_RETRY_MAX_DELAY まで)
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "2"))
+OUTBOX_RETRY_MAX_DELAY = float(os.getenv("OUTBOX_RETRY_MAX_DELAY", "600"))
+# 他プロセスが積んだ通知を拾いに行く間隔
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+# sending のまま この秒数を過ぎた通知は、送信中のプロセスが落ちたとみなして送り直す
+OUTBOX_SEND_TIMEOUT = float(os.getenv("OUTBOX_SEND_TIMEOUT", "300"))
+# sent の通知を残しておく秒数
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", str(7 * 24 * 3600)))
+# まとめて送る時の通知の区切り
+OUTBOX_SEPARATOR = "\n\n"
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_message(conn, room_id, text):
+    """
+    room_id のルーム宛ての通知を積み、outbox の id を返す
+    conn のトランザクションでコミットされる (コミット後に OutboxDispatcher.wake() を呼ぶ)
+    """
+    now = time.time()
+    return conn.execute(
+        """
+        INSERT INTO outbox (room_id, text, status, attempts, created_at, next_run_at)
+        VALUES (?, ?, 'pending', 0, ?, ?)
+    """,
+        (room_id, text, now, now),
+    ).lastrowid
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After") or 0)
+    except ValueError:
+        return 0.0
+
+
+class OutboxDispatcher:
+    """
+    outbox を送る送信スレッド
+
+    sender(room_id, text) は requests の Response (トークンが取れなければ None) を返す。
+    2xx は送信済み、408・429・5xx・None・例外は再試行、それ以外は dead
+
+    posts：投稿した回数 (このプロセス)
+    sent：送った通知の数
+    failures：失敗した投稿の回数
+    """
+
+    def __init__(
+        self,
+        sender,
+        batch_max=OUTBOX_BATCH_MAX,
+        send_rate=OUTBOX_SEND_RATE,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        retry_delay=OUTBOX_RETRY_DELAY,
+        poll_interval=OUTBOX_POLL_INTERVAL,
+    ):
+        self._sender = sender
+        self._batch_max = batch_max
+        self._interval = 1 / send_rate if send_rate > 0 else 0
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._stats_lock = threading.Lock()
+        self._stats = {"posts": 0, "sent": 0, "failures": 0}
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def start(self):
+        """
+        このプロセスの送信スレッドを起動する (起動済みなら何もしない)
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._loop, name="outbox", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout=None):
+        """
+        新しい通知の取得をやめ、送信中の投稿が終わるまで待つ
+        (送れなかった分は outbox に残り、次に起動したプロセスが送る)
+        """
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+
+    def wake(self):
+        """
+        積んだ通知をすぐに送らせる
+        """
+        self.start()
+        self._wakeup.set()
+
+    def _claim(self):
+        """
+        送ってよい最も古い通知のルームの送信待ちを最大 batch_max 件 sending にする
+        (ルーム, [通知の行], 0) を返す。送れるものが無ければ (None, [], 次に見に行くまでの秒数)
+        """
+
+        def write(conn):
+            now = time.time()
+            conn.execute(
+                """
+                UPDATE outbox SET status = 'pending'
+                WHERE status = 'sending' AND started_at < ?
+            """,
+                (now - OUTBOX_SEND_TIMEOUT,),
+            )
+            if self._interval:
+                next_send_at = conn.execute(
+                    "SELECT next_send_at FROM outbox_pacing WHERE name = 'elgana'"
+                ).fetchone()[0]
+                if next_send_at > now:
+                    return None, [], next_send_at - now
+            # 順番が入れ替わらないよう、同じルームの前の通知が送信待ち・送信中なら取らない
+            # (再試行を待っている通知の後に積まれた分も、その通知より先には送らない)
+            head = conn.execute(
+                """
+                SELECT id, room_id FROM outbox AS o
+                WHERE status = 'pending' AND next_run_at <= ?
+                    AND NOT EXISTS (
+                        SELECT 1 FROM outbox AS e
+                        WHERE e.room_id = o.room_id
+                            AND e.status IN ('pending', 'sending')
+                            AND e.id < o.id
+                    )
+                ORDER BY id
+                LIMIT 1
+            """,
+                (now,),
+            ).fetchone()
+            if head is None:
+                return None, [], self._poll_interval
+            # 先頭から、まだ送れない通知の手前までをまとめる
+            rows = conn.execute(
+                """
+                UPDATE outbox
+                SET status = 'sending', started_at = ?, attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE room_id = ? AND status = 'pending' AND id >= ?
+                        AND id < COALESCE(
+                            (
+                                SELECT MIN(id) FROM outbox
+                                WHERE room_id = ? AND status = 'pending'
+                                    AND next_run_at > ? AND id > ?
+                            ),
+                            9223372036854775807
+                        )
+                    ORDER BY id
+                    LIMIT ?
+                )
+                RETURNING id, text, attempts
+            """,
+                (
+                    now,
+                    head["room_id"],
+                    head["id"],
+                    head["room_id"],
+                    now,
+                    head["id"],
+                    self._batch_max,
+                ),
+            ).fetchall()
+            if self._interval:
+                conn.execute(
+                    """
+                    UPDATE outbox_pacing SET next_send_at = MAX(next_send_at, ?) + ?
+                    WHERE name = 'elgana'
+                """,
+                    (now, self._interval),
+                )
+            return head["room_id"], sorted(rows, key=lambda row: row["id"]), 0
+
+        return get_writer().run(write)
+
+    def _sent(self, rows):
+        sent_at = time.time()
+        get_writer().run(
+            lambda conn: conn.executemany(
+                """
+                UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL
+                WHERE id = ?
+            """,
+                [(sent_at, row["id"]) for row in rows],
+            )
+        )
+
+    def _failed(self, room_id, rows, error, permanent=False, retry_after=0.0):
+        now = time.time()
+        retry, dead = [], []
+        for row in rows:
+            if permanent or row["attempts"] >= self._max_attempts:
+                dead.append(row)
+            else:
+                retry.append(row)
+        delay = 0.0
+        if retry:
+            attempts = max(row["attempts"] for row in retry)
+            delay = min(self._retry_delay * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_DELAY)
+            delay = max(delay, retry_after)
+
+        def write(conn):
+            conn.executemany(
+                "UPDATE outbox SET status = 'dead', last_error = ? WHERE id = ?",
+                [(error, row["id"]) for row in dead],
+            )
+            if not retry:
+                return
+            conn.executemany(
+                """
+                UPDATE outbox SET status = 'pending', last_error = ?, next_run_at = ?
+                WHERE id = ?
+            """,
+                [(error, now + delay, row["id"]) for row in retry],
+            )
+            # 後から積まれた同じルームの通知も、再試行の分より先に送らない
+            conn.execute(
+                """
+                UPDATE outbox SET next_run_at = MAX(next_run_at, ?)
+                WHERE room_id = ? AND status = 'pending'
+            """,
+                (now + delay, room_id),
+            )
+            if retry_after:
+                conn.execute(
+                    """
+                    UPDATE outbox_pacing SET next_send_at = MAX(next_send_at, ?)
+                    WHERE name = 'elgana'
+                """,
+                    (now + retry_after,),
+                )
+
+        get_writer().run(write)
+        if dead:
+            logger.error(
+                "upload_message 失敗！！ room=%s の通知 %s 件を dead にしました: %s",
+                room_id,
+                len(dead),
+                error,
+            )
+        if retry:
+            logger.warning(
+                "upload_message 失敗！！ room=%s の通知 %s 件を %ss 後に再試行: %s",
+                room_id,
+                len(retry),
+                delay,
+                error,
+            )
+
+    def _deliver(self, room_id, rows):
+        text = OUTBOX_SEPARATOR.join(row["text"] for row in rows)
+        self._count("posts")
+        try:
+            response = self._sender(room_id, text)
+        except Exception as e:
+            logger.exception("upload_message 失敗！！ : %s", e)
+            self._count("failures")
+            self._failed(room_id, rows, repr(e))
+            return
+        if response is None:
+            self._count("failures")
+            self._failed(room_id, rows, "アクセストークン取得失敗")
+            return
+        status = response.status_code
+        if 200 <= status < 300:
+            self._sent(rows)
+            self._count("sent", len(rows))
+            logger.debug("upload_message 成功！！: %s 件 %s", len(rows), status)
+            return
+        self._count("failures")
+        error = f"{status} {response.text[:200]}"
+        if status in (408, 429) or status >= 500:
+            self._failed(room_id, rows, error, retry_after=_retry_after(response))
+        else:
+            self._failed(room_id, rows, error, permanent=True)
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            try:
+                # 取りに行く前に消す (取りに行った後の wake() を取りこぼさない)
+                self._wakeup.clear()
+                room_id, rows, wait = self._claim()
+                if room_id is None:
+                    self._purge()
+                    self._wakeup.wait(min(wait, self._poll_interval))
+                    continue
+                self._deliver(room_id, rows)
+            except Exception:
+                logger.exception("outbox エラー")
+                self._stopping.wait(self._poll_interval)
+
+    def _purge(self):
+        now = time.time()
+        if now - self._last_purge < 600:
+            return
+        self._last_purge = now
+        get_writer().run(
+            lambda conn: conn.execute(
+                "DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?",
+                (now - OUTBOX_RETENTION,),
+            )
+        )
+
+    def stats(self):
+        """
+        送信待ちの数・状態ごとの件数と、このプロセスの投稿の回数を返す
+        """
+        now = time.time()
+        conn = get_db()
+        counts = {
+            row["status"]: row["n"]
+            for row in conn.execute(
+                "SELECT status, COUNT(*) AS n FROM outbox GROUP BY status"
+            )
+        }
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')"
+        ).fetchone()[0]
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return {
+            "depth": counts.get("pending", 0),
+            "sending": counts.get("sending", 0),
+            "dead": counts.get("dead", 0),
+            "oldest_pending_age": (now - oldest) if oldest else 0,
+            **stats,
+        }
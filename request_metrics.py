@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+リクエストごとの応答時間と SQL 実行数の記録 (metrics.py の値を Flask から更新する)
+
+create_app() で init_app(app) を呼んで登録する
+"""
+import time
+
+from flask import g, request
+
+from metrics import http_request_duration, queries_so_far, sqlite_queries
+
+
+def init_app(app):
+    """
+    全リクエストの応答時間と SQL 実行数を記録するよう Flask に登録する
+    """
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = queries_so_far()
+
+    @app.after_request
+    def _record(response):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        http_request_duration.observe(
+            time.perf_counter() - started,
+            route,
+            request.method,
+            str(response.status_code),
+        )
+        sqlite_queries.observe(queries_so_far() - g.pop("metrics_queries", 0), route)
+        return response
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+データのバージョン (sync_state の seq) ごとに組み立て済みの応答本文を使い回す
+
+・同じパラメータ・同じバージョンの間は JSON を作り直さない
+・本文のハッシュを強い ETag にし、If-None-Match が一致すれば 304 を返す
+・Accept-Encoding に応じて brotli / gzip で圧縮し、圧縮結果も使い回す
+  (brotli は requirements.txt に含めない任意のもの。入っていれば使い、無ければ gzip のみ)
+・組み立ては同じキー同士でだけ待ち合わせ、別の絞り込みの組み立ては待たせない
+・保持する本文 (圧縮結果も含む) の合計を RESPONSE_CACHE_MAX_BYTES までにする
+・RESPONSE_CACHE_MAX_BODY_BYTES を超える本文 (絞り込みなしの全件など) は gzip の圧縮結果と
+  ETag だけを持つ。304 と gzip の応答は組み立て直さず、圧縮を受け付けない時だけ組み立て直す
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # brotli は任意。無ければ gzip のみ
+    brotli = None
+
+
+# 保持するパラメータの組み合わせの数
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "16"))
+# 保持する本文と圧縮結果の合計の上限 (バイト、ワーカーごと)
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+# これより大きい本文は保持しない (バイト)
+RESPONSE_CACHE_MAX_BODY_BYTES = int(
+    os.getenv("RESPONSE_CACHE_MAX_BODY_BYTES", str(8 * 1024 * 1024))
+)
+# これより小さい本文は圧縮しない (バイト)
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def choose_encoding(accept_encodings):
+    """
+    request.accept_encodings から使う圧縮方式を選ぶ (br > gzip > なし)
+    """
+    if brotli is not None and accept_encodings["br"]:
+        return "br"
+    if accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+class CachedBody:
+    """
+    組み立て済みの本文 1 つと、その圧縮結果
+    on_grow：圧縮結果が増えた時に呼ぶ関数 (ResponseCache が合計の大きさを見直す)
+    body が None のもの (compacted) は gzip の圧縮結果だけを持つ
+    """
+
+    def __init__(self, version, body, headers=None, on_grow=None):
+        self.version = version
+        self.body = body
+        self.headers = headers or {}
+        self.size = len(body)
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self._encoded = {None: body}
+        self._lock = threading.Lock()
+        self._on_grow = on_grow
+
+    def compacted(self, on_grow=None):
+        """
+        同じ ETag で、本文を持たず gzip の圧縮結果だけを持つ CachedBody を返す
+        """
+        compact = CachedBody(self.version, b"", self.headers, on_grow)
+        compact.body = None
+        compact.size = self.size
+        compact.etag = self.etag
+        compact._encoded = {"gzip": self.encoded("gzip")}
+        return compact
+
+    @property
+    def nbytes(self):
+        """
+        本文と圧縮結果の合計バイト数
+        """
+        return sum(len(data) for data in list(self._encoded.values()))
+
+    def encoded(self, encoding):
+        """
+        圧縮結果を返す (無ければ作る)。本文を持たず作れない時は None
+        """
+        if encoding not in self._encoded:
+            if self.body is None:
+                return None
+            with self._lock:
+                if encoding not in self._encoded:
+                    if encoding == "br":
+                        data = brotli.compress(self.body, quality=BROTLI_QUALITY)
+                    else:
+                        data = gzip.compress(self.body, compresslevel=GZIP_LEVEL)
+                    self._encoded[encoding] = data
+                if self._on_grow is not None:
+                    self._on_grow()
+        return self._encoded[encoding]
+
+    def response(self, request, mimetype="application/json"):
+        """
+        ETag・圧縮付きの Response を返す (If-None-Match が一致すれば 304)
+        本文を持たず、持っている圧縮結果ではクライアントに返せない時は None
+        """
+        encoding = None
+        if self.size >= COMPRESS_MIN_BYTES:
+            encoding = choose_encoding(request.accept_encodings)
+            if self.body is None and encoding not in self._encoded:
+                encoding = "gzip" if request.accept_encodings["gzip"] else None
+        # 圧縮方式ごとに表現が違うので ETag も分ける
+        etag = self.etag if encoding is None else f"{self.etag}-{encoding}"
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            data = self.encoded(encoding)
+            if data is None:
+                return None
+            response = Response(data, mimetype=mimetype)
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.headers["Vary"] = "Accept-Encoding"
+        # キャッシュしてよいが、使う前に毎回 ETag で確認させる
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers.update(self.headers)
+        return response
+
+
+class ResponseCache:
+    """
+    キー (パラメータ) ごとに最新バージョンの CachedBody を LRU で持つ
+
+    hits：組み立て済みの本文を返した回数
+    builds：本文を組み立てた回数
+    compacted：大きいので gzip の圧縮結果だけを保持した本文の数
+    oversized：圧縮しても大きすぎて保持しなかった本文の数
+    """
+
+    def __init__(
+        self,
+        max_entries=RESPONSE_CACHE_SIZE,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        max_body_bytes=RESPONSE_CACHE_MAX_BODY_BYTES,
+    ):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._max_body_bytes = max_body_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 同じ本文を複数のスレッドが同時に組み立てないため (キーごと)
+        self._building = {}
+        self._stats = {"hits": 0, "builds": 0, "compacted": 0, "oversized": 0}
+
+    def _lookup(self, key, version):
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached.version == version:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return cached
+        return None
+
+    def get(self, key, version, build):
+        """
+        key・version の本文を返す。無ければ build() で (本文の bytes, 追加ヘッダー) を作る
+        """
+        cached = self._lookup(key, version)
+        if cached is not None:
+            return cached
+        with self._lock:
+            build_lock = self._building.setdefault(key, threading.Lock())
+        try:
+            with build_lock:
+                cached = self._lookup(key, version)
+                if cached is not None:
+                    return cached
+                body, headers = build()
+                with self._lock:
+                    self._stats["builds"] += 1
+                served = cached = CachedBody(version, body, headers, on_grow=self._trim)
+                if len(body) > self._max_body_bytes:
+                    # 今回の応答には本文ごと使い、保持するのは gzip の圧縮結果だけにする
+                    served = CachedBody(version, body, headers)
+                    cached = served.compacted(on_grow=self._trim)
+                    with self._lock:
+                        self._stats["compacted"] += 1
+                        if cached.nbytes > self._max_body_bytes:
+                            self._stats["oversized"] += 1
+                            return served
+                with self._lock:
+                    self._entries[key] = cached
+                    self._entries.move_to_end(key)
+                self._trim()
+                return served
+        finally:
+            with self._lock:
+                if self._building.get(key) is build_lock:
+                    del self._building[key]
+
+    def respond(self, request, key, version, build, mimetype="application/json"):
+        """
+        key・version の本文で request への Response を返す (get() と CachedBody.response())
+        本文を手放したものを圧縮を受け付けないクライアントに返す時だけ組み立て直す
+        """
+        response = self.get(key, version, build).response(request, mimetype)
+        if response is None:
+            body, headers = build()
+            with self._lock:
+                self._stats["builds"] += 1
+            response = CachedBody(version, body, headers).response(request, mimetype)
+        return response
+
+    def _trim(self):
+        """
+        件数・合計バイト数の上限を超えた分を古い順に捨てる
+        """
+        with self._lock:
+            total = sum(cached.nbytes for cached in self._entries.values())
+            while self._entries and (
+                len(self._entries) > self._max_entries or total > self._max_bytes
+            ):
+                _, cached = self._entries.popitem(last=False)
+                total -= cached.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "bytes": sum(cached.nbytes for cached in self._entries.values()),
+            }
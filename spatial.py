@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+案件の位置による検索
+
+operation_orders の座標は order_rtree (R*Tree、migrations.py v8) にトリガーで写してあり、
+半径から求めた緯度経度の範囲で候補を絞ってから、実際の距離で判定する。
+同じ場所の二重報告を見つけるため、位置情報の登録時にも使う
+"""
+import math
+import os
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# この距離 (メートル) 以内に未完了の案件があれば重複の可能性ありとする
+DUPLICATE_RADIUS_M = float(os.getenv("DUPLICATE_RADIUS_M", "20"))
+# /nearby で指定できる半径の上限 (メートル)
+NEARBY_MAX_RADIUS_M = float(os.getenv("NEARBY_MAX_RADIUS_M", "5000"))
+
+EARTH_RADIUS_M = 6371008.8
+# 緯度 1 度あたりの距離 (メートル)
+METERS_PER_DEG_LAT = math.pi * EARTH_RADIUS_M / 180
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """
+    2 点間の距離 (メートル、haversine)
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_m):
+    """
+    中心から radius_m 以内を必ず含む (south, west, north, east)
+    """
+    dlat = radius_m / METERS_PER_DEG_LAT
+    # 範囲の中で一番高緯度の側で経度 1 度が最も短くなる
+    max_lat = min(abs(latitude) + dlat, 89.9)
+    dlon = radius_m / (METERS_PER_DEG_LAT * math.cos(math.radians(max_lat)))
+    return latitude - dlat, longitude - dlon, latitude + dlat, longitude + dlon
+
+
+def longitude_ranges(west, east):
+    """
+    bounding_box の経度の範囲を -180〜180 度に収まる [(west, east), ...] に分ける
+    180 度の経線をまたぐ範囲は両側の 2 つに、一周以上なら全体の 1 つにする
+    """
+    if east - west >= 360:
+        return [(-180.0, 180.0)]
+    if west < -180:
+        return [(west + 360, 180.0), (-180.0, east)]
+    if east > 180:
+        return [(west, 180.0), (-180.0, east - 360)]
+    return [(west, east)]
+
+
+def find_nearby(
+    conn,
+    latitude,
+    longitude,
+    radius_m,
+    exclude_msg_id=None,
+    open_only=False,
+    limit=20,
+):
+    """
+    (latitude, longitude) から radius_m 以内の案件を近い順に返す
+    非表示 (signal = '0') の案件は含めない。open_only なら完了済みも除く
+    [{"msg_id", "latitude", "longitude", "distance", ...}]
+    """
+    south, west, north, east = bounding_box(latitude, longitude, radius_m)
+    conditions = ["o.signal IS NOT '0'"]
+    filter_params = []
+    if exclude_msg_id is not None:
+        conditions.append("o.msg_id IS NOT ?")
+        filter_params.append(exclude_msg_id)
+    if open_only:
+        conditions.append("(o.completed IS NULL OR o.completed = '')")
+    sql = f"""
+        SELECT
+            o.msg_id,
+            o.latitude,
+            o.longitude,
+            o.instruction,
+            o.status,
+            o.urgency,
+            o.completed,
+            o.received_at
+        FROM order_rtree AS r
+        INNER JOIN operation_orders AS o ON o.id = r.id
+        WHERE r.min_lat <= ? AND r.max_lat >= ?
+            AND r.min_lon <= ? AND r.max_lon >= ?
+            AND {" AND ".join(conditions)}
+    """
+    # 180 度の経線をまたぐ時は R*Tree を 2 つの範囲で引く (範囲は重ならない)
+    rows = []
+    for min_lon, max_lon in longitude_ranges(west, east):
+        rows += conn.execute(
+            sql, [north, south, max_lon, min_lon, *filter_params]
+        ).fetchall()
+
+    nearby = []
+    for row in rows:
+        distance = distance_m(latitude, longitude, row["latitude"], row["longitude"])
+        if distance <= radius_m:
+            nearby.append({**dict(row), "distance": round(distance, 1)})
+    nearby.sort(key=lambda order: order["distance"])
+    return nearby[:limit]
+
+
+def find_duplicate(conn, msg_id, latitude, longitude):
+    """
+    DUPLICATE_RADIUS_M 以内で一番近い未完了の別案件の msg_id (無ければ None)
+    座標が数値にできない場合も None (登録自体は止めない)
+    """
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+    nearby = find_nearby(
+        conn,
+        latitude,
+        longitude,
+        DUPLICATE_RADIUS_M,
+        exclude_msg_id=msg_id,
+        open_only=True,
+        limit=1,
+    )
+    return nearby[0]["msg_id"] if nearby else None
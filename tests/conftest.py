@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+テスト共通の準備
+
+db_path：移行済みの一時 DB に DB_PATH (とアーカイブの置き場所) を向け、
+終わったら接続と書き込みスレッドを片付ける
+client：elgana_api のルートだけを登録した Flask のテストクライアント
+(スレッドは起動せず、/get_locations のキャッシュは空から始める)
+"""
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive  # noqa: E402
+import db  # noqa: E402
+import elgana_api  # noqa: E402
+from migrations import migrate  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+from writer import get_writer  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "locations.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    monkeypatch.setattr(archive, "ARCHIVE_DB_PATH", str(tmp_path / "locations-archive.db"))
+    db.close_db()
+    conn = db.connect()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    yield path
+    get_writer().stop(10)
+    db.close_db()
+
+
+@pytest.fixture
+def client(db_path, monkeypatch):
+    monkeypatch.setattr(elgana_api, "locations_cache", ResponseCache())
+    app = Flask(__name__)
+    app.register_blueprint(elgana_api.api)
+    return app.test_client()
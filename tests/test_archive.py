@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import pytest
+
+import archive
+import db
+import elgana_api
+from migrations import migrate
+
+
+def _archive_one(msg_id="old"):
+    conn = db.get_db()
+    conn.execute(
+        """
+        INSERT INTO operation_orders (msg_id, latitude, longitude, completed)
+        VALUES (?, 35.68, 139.76, '2000-01-01 00:00:00')
+    """,
+        (msg_id,),
+    )
+    conn.commit()
+    archiver = db.connect()
+    try:
+        archive.attach_archive(archiver, create=True)
+        archive.archive_completed(archiver, "2001-01-01 00:00:00")
+    finally:
+        archiver.close()
+
+
+def test_readers_attach_once_read_only_without_ddl(db_path):
+    _archive_one()
+    conn = db.connect()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        for _ in range(3):
+            assert archive.attach_archive(conn)
+            assert elgana_api.image_visible(conn, "missing.jpg") is False
+        assert conn.attached == {"archive": "ro"}
+        assert sum("ATTACH" in s for s in statements) == 1
+        assert not [
+            s for s in statements if s.lstrip().split()[0] in ("CREATE", "ALTER", "PRAGMA")
+        ]
+        with pytest.raises(sqlite3.OperationalError, match="readonly"):
+            conn.execute("DELETE FROM archive.operation_orders")
+        locations = elgana_api.query_locations(conn, [], [], None, include_archived=True)
+        assert [location["msg_id"] for location in locations] == ["old"]
+    finally:
+        conn.close()
+
+
+def test_missing_archive_is_not_created_by_readers(db_path):
+    conn = db.connect()
+    try:
+        assert archive.attach_archive(conn) is False
+        assert conn.attached == {}
+    finally:
+        conn.close()
+
+
+def test_migrate_brings_archive_tables_up_to_date(db_path):
+    _archive_one()
+    conn = db.connect()
+    try:
+        conn.execute("ALTER TABLE operation_orders ADD COLUMN added_later TEXT")
+        conn.commit()
+        migrate(conn)
+        archive.attach_archive(conn)
+        columns = {row[1] for row in conn.execute("PRAGMA archive.table_info(operation_orders)")}
+        assert "added_later" in columns
+    finally:
+        conn.close()
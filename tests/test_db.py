@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+地図の読み込みと書き込みを同時に流しても "database is locked" にならないことを確かめる
+読み込みはスレッドごとの接続 (get_db)、書き込みは書き込みスレッド (writer.py) と、
+別プロセスの代わりに自前の接続から直接行う
+"""
+import sqlite3
+import threading
+import time
+
+import db
+import elgana_api
+from bench import datagen
+from writer import get_writer
+
+
+DURATION = 2.0
+READERS = 6
+
+
+def test_mixed_readers_and_writers_do_not_lock(db_path, record_property):
+    db.close_db()
+    datagen.generate(db_path, orders=2000, rooms=10, users=50)
+    msg_ids = [
+        row[0]
+        for row in db.get_db().execute(
+            "SELECT msg_id FROM operation_orders ORDER BY id LIMIT 500"
+        )
+    ]
+    deadline = time.monotonic() + DURATION
+    errors = []
+    counts = {"reads": 0, "writes": 0}
+    lock = threading.Lock()
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def reader(i):
+        conn = db.get_db()
+        seq = 0
+        try:
+            while time.monotonic() < deadline:
+                if i % 2:
+                    elgana_api.query_locations(conn, [], [], None)
+                else:
+                    # 差分の取得 (前回の seq 以降)
+                    elgana_api.query_locations(
+                        conn, ["row_seq > ?"], [seq], seq
+                    )
+                    seq = conn.execute(
+                        "SELECT seq FROM sync_state WHERE name = 'locations'"
+                    ).fetchone()[0]
+                count("reads")
+        except sqlite3.Error as e:
+            errors.append(e)
+        finally:
+            db.close_db()
+
+    def batched_writer(i):
+        n = 0
+        try:
+            while time.monotonic() < deadline:
+                msg_id = msg_ids[(i * 97 + n) % len(msg_ids)]
+                get_writer().run(
+                    lambda conn: conn.execute(
+                        "UPDATE operation_orders SET remarks = ? WHERE msg_id = ?",
+                        (f"writer {i} #{n}", msg_id),
+                    )
+                )
+                n += 1
+                count("writes")
+        except sqlite3.Error as e:
+            errors.append(e)
+
+    def direct_writer(i):
+        # 別プロセス (別のワーカー・archive.py など) と同じく自前の接続で書く
+        conn = db.connect()
+        n = 0
+        try:
+            while time.monotonic() < deadline:
+                conn.execute(
+                    """
+                    INSERT INTO operation_orders (msg_id, room_id, latitude, longitude, instruction)
+                    VALUES (?, 'room', 35.7, 139.7, ?)
+                """,
+                    (f"direct-{i}-{n}", f"#{n}"),
+                )
+                conn.execute(
+                    "UPDATE spot_info SET deleted = ? WHERE msg_id = ?",
+                    (str(n % 2), msg_ids[n % len(msg_ids)]),
+                )
+                conn.commit()
+                n += 1
+                count("writes")
+        except sqlite3.Error as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(READERS)]
+    threads += [threading.Thread(target=batched_writer, args=(i,)) for i in range(2)]
+    threads += [threading.Thread(target=direct_writer, args=(i,)) for i in range(2)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(DURATION + 30)
+    elapsed = time.monotonic() - started
+
+    # 結果のスループット (junitxml などに残る)
+    record_property("reads_per_s", round(counts["reads"] / elapsed, 1))
+    record_property("writes_per_s", round(counts["writes"] / elapsed, 1))
+    assert errors == []
+    assert counts["reads"] >= READERS and counts["writes"] > 0
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+import elgana_client
+from bench.stub_elgana import TOKEN_TTL, StubElgana
+
+
+def _start_stub(monkeypatch, latency_ms=0):
+    stub = StubElgana(latency_ms=latency_ms, image_size=(64, 48)).start()
+    env = stub.env()
+    monkeypatch.setattr(elgana_client, "LOGIN_API_URL", env["LOGIN_API_URL"])
+    monkeypatch.setattr(elgana_client, "token_cache", elgana_client.TokenCache())
+    # このテスト用の接続プールから始める
+    monkeypatch.setattr(elgana_client, "_session", None)
+    return stub
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = _start_stub(monkeypatch)
+    yield stub
+    elgana_client.get_session().close()
+    stub.stop()
+
+
+@pytest.fixture
+def slow_stub(monkeypatch):
+    # ログインの往復の間に他のスレッドが重なるように遅らせる
+    stub = _start_stub(monkeypatch, latency_ms=200)
+    yield stub
+    elgana_client.get_session().close()
+    stub.stop()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(elgana_client.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _download(stub, file_id):
+    def send(token):
+        return elgana_client.get(
+            f"{stub.base_url}/file?roomId=r&fileId={file_id}",
+            headers=elgana_client.elgana_headers(token, "application/octet-stream"),
+            stream=True,
+        )
+
+    response = elgana_client.call_with_token(send)
+    with response:
+        assert response.status_code == 200
+        return b"".join(response.iter_content(8192))
+
+
+def test_refresh_after_401_reuses_the_pooled_connection(stub):
+    elgana_client.token_cache._token = "expired"
+    elgana_client.token_cache._expires_at = float("inf")
+    _download(stub, "a")
+    stats = stub.stats()
+    assert (stats["unauthorized"], stats["logins"], stats["downloads"]) == (1, 1, 1)
+    # ログインも 401 の応答を受けた接続も 1 本を使い回す
+    assert stats["connections"] == 1
+
+
+def test_repeated_calls_share_one_pooled_connection(stub):
+    for i in range(20):
+        _download(stub, f"file-{i}")
+    response = elgana_client.post(
+        f"{stub.base_url}/upload",
+        headers=elgana_client.elgana_headers(elgana_client.get_access_token()),
+        json={"roomIds": ["r"], "text": "t"},
+    )
+    assert response.status_code == 200
+    stats = stub.stats()
+    assert (stats["logins"], stats["downloads"], stats["uploads"]) == (1, 20, 1)
+    # ログイン・取得・投稿の全てが keep-alive の 1 本で済む
+    assert stats["connections"] == 1
+    assert elgana_client.get_session() is elgana_client.get_session()
+
+
+def test_token_is_refreshed_at_expires_in_minus_margin(clock):
+    tokens = iter(["t1", "t2"])
+    cache = elgana_client.TokenCache(
+        fetch=lambda: (next(tokens), 100), ttl=1800, refresh_margin=10
+    )
+    assert cache.get() == "t1"
+    clock[0] += 89.9
+    assert cache.get() == "t1"
+    # 期限の refresh_margin 秒前からは取り直す
+    clock[0] += 0.1
+    assert cache.get() == "t2"
+    assert cache.stats() == {
+        "hits": 1,
+        "misses": 2,
+        "refreshes": 2,
+        "failures": 0,
+        "invalidations": 0,
+    }
+
+
+def test_token_without_expires_in_uses_ttl(clock):
+    cache = elgana_client.TokenCache(fetch=lambda: ("t", None), ttl=300, refresh_margin=60)
+    assert cache.get() == "t"
+    clock[0] += 239.9
+    assert cache.get() == "t"
+    clock[0] += 0.1
+    assert cache.get() == "t"
+    assert cache.stats()["misses"] == 2
+
+
+def test_failed_login_is_not_cached(clock):
+    results = iter([(None, None), ("t", 100)])
+    cache = elgana_client.TokenCache(fetch=lambda: next(results), refresh_margin=10)
+    assert cache.get() is None
+    assert cache.get() == "t"
+    stats = cache.stats()
+    assert (stats["misses"], stats["failures"], stats["refreshes"]) == (2, 1, 1)
+
+
+def test_refresh_margin_against_stub(stub, clock):
+    margin = elgana_client.TOKEN_REFRESH_MARGIN
+    first = elgana_client.get_access_token()
+    clock[0] += TOKEN_TTL - margin - 1
+    assert elgana_client.get_access_token() == first
+    assert stub.stats()["logins"] == 1
+    clock[0] += 1
+    assert elgana_client.get_access_token() != first
+    assert stub.stats()["logins"] == 2
+    stats = elgana_client.token_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["refreshes"]) == (1, 2, 2)
+
+
+def test_concurrent_callers_on_empty_cache_log_in_once(slow_stub):
+    callers = 16
+    barrier = threading.Barrier(callers)
+    tokens = []
+
+    def caller():
+        barrier.wait()
+        tokens.append(elgana_client.get_access_token())
+
+    threads = [threading.Thread(target=caller) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(tokens) == callers and len(set(tokens)) == 1 and tokens[0]
+    assert slow_stub.stats()["logins"] == 1
+    # 1 つがログインし、残りはロック待ちの後にそのトークンを使う
+    stats = elgana_client.token_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["refreshes"]) == (callers - 1, 1, 1)
+
+
+def test_401_counts_an_invalidation_and_one_refresh(stub):
+    elgana_client.token_cache._token = "expired"
+    elgana_client.token_cache._expires_at = float("inf")
+    _download(stub, "a")
+    _download(stub, "b")
+    stats = elgana_client.token_cache.stats()
+    # 401 の後の 1 回だけ取り直し、次の呼び出しは取り直したトークンを使う
+    assert stats["invalidations"] == 1
+    assert (stats["hits"], stats["misses"], stats["refreshes"]) == (2, 1, 1)
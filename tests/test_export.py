@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+一括出力 (export.py) が大きな DB でも正しい CSV / GeoJSON を、
+出力の大きさに比例しないメモリで流すことを確かめる
+"""
+import csv
+import hashlib
+import json
+import tracemalloc
+
+import pytest
+
+import db
+import export
+from bench import datagen
+
+
+ORDERS = 20000
+# 接続・1 回分 (EXPORT_CHUNK_ROWS 行) の断片の分だけ。件数には比例しない
+PEAK_LIMIT_BYTES = 6 * 1024 * 1024
+
+
+@pytest.fixture(scope="module")
+def large_db(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("export") / "locations.db")
+    datagen.generate(path, orders=ORDERS, rooms=20, users=100)
+    conn = db.connect(path)
+    try:
+        spots = conn.execute("SELECT COUNT(*) FROM spot_info").fetchone()[0]
+        without_spots = conn.execute(
+            """
+            SELECT COUNT(*) FROM operation_orders AS o
+            WHERE NOT EXISTS (SELECT 1 FROM spot_info AS s WHERE s.msg_id = o.msg_id)
+        """
+        ).fetchone()[0]
+    finally:
+        conn.close()
+    return path, spots + without_spots
+
+
+def _consume(pieces, handle):
+    """
+    断片を handle に渡しながら読み切り、(出力のバイト数, ピークの割り当て) を返す
+    """
+    tracemalloc.start()
+    try:
+        size = 0
+        for piece in pieces:
+            size += len(piece.encode())
+            handle(piece)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size, peak
+
+
+def test_csv_export_of_large_db_is_valid_with_bounded_memory(large_db):
+    path, expected_rows = large_db
+    columns = [name for name, _ in export.ORDER_COLUMNS + export.SPOT_COLUMNS]
+    counts = {"rows": 0, "orders": 0}
+    last = [None]
+
+    def handle(piece):
+        # 断片ごとに行に分けてすぐ解析し、出力全体は持たない
+        for row in csv.reader(piece.lstrip("\ufeff").splitlines()):
+            assert len(row) == len(columns)
+            if row == columns:
+                continue
+            counts["rows"] += 1
+            # 同じ案件の行は続いて並ぶ
+            if row[0] != last[0]:
+                counts["orders"] += 1
+                last[0] = row[0]
+
+    size, peak = _consume(export.export_csv([], [], path), handle)
+    assert counts == {"rows": expected_rows, "orders": ORDERS}
+    assert peak < PEAK_LIMIT_BYTES < size
+
+
+def test_geojson_export_of_large_db_is_valid_with_bounded_memory(large_db):
+    path, expected_rows = large_db
+    digest = hashlib.sha256()
+    size, peak = _consume(
+        export.export_geojson([], [], path), lambda piece: digest.update(piece.encode())
+    )
+    assert peak < PEAK_LIMIT_BYTES < size
+
+    # 解析は計測の外で。同じ DB なので同じ出力になる
+    body = "".join(export.export_geojson([], [], path))
+    assert hashlib.sha256(body.encode()).digest() == digest.digest()
+    collection = json.loads(body)
+    assert collection["type"] == "FeatureCollection"
+    features = collection["features"]
+    assert len(features) == ORDERS
+    assert sum(max(1, len(f["properties"]["images"])) for f in features) == expected_rows
+    for feature in features:
+        geometry = feature["geometry"]
+        if geometry is not None:
+            longitude, latitude = geometry["coordinates"]
+            assert -180 <= longitude <= 180 and -90 <= latitude <= 90
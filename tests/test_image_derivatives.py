@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import pytest
+
+import image_derivatives
+from image_store import StoredImage
+
+
+class _ClosedPool:
+    def submit(self, *args):
+        raise RuntimeError("cannot schedule new futures after shutdown")
+
+
+class _TempStore:
+    # S3 と同じく、読むたびに一時ファイルへ取り出す保存先
+    def fetch_local(self, filename):
+        fd, path = tempfile.mkstemp(suffix=".jpg")
+        os.close(fd)
+        return path, True
+
+
+def test_failed_submit_removes_temporary_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    monkeypatch.setattr(image_derivatives, "_get_pool", lambda: _ClosedPool())
+    digest = "a" * 64
+    stored = StoredImage(
+        f"{digest}.jpg", f"/images/{digest}.jpg", 1, digest, "image/jpeg", True
+    )
+
+    with pytest.raises(RuntimeError):
+        image_derivatives.submit(_TempStore(), stored, lambda *args: None)
+    # 出力先のディレクトリも取り出した元画像も残らない
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+画像のダウンロードが本文をメモリに溜めずに保存先へ流し込むことを確かめる
+"""
+import os
+import tracemalloc
+
+import pytest
+
+import elgana_api
+import elgana_client
+import image_store
+from bench.stub_elgana import StubElgana
+
+
+IMAGE_BYTES = 48 * 1024 * 1024
+# 接続・チャンク・ハッシュの分だけ。画像の大きさには比例しない
+PEAK_LIMIT_BYTES = 4 * 1024 * 1024
+
+
+@pytest.fixture
+def large_stub(tmp_path, monkeypatch):
+    stub = StubElgana(
+        latency_ms=0, image_size=(64, 48), image_padding=IMAGE_BYTES
+    ).start()
+    env = stub.env()
+    monkeypatch.setattr(elgana_client, "LOGIN_API_URL", env["LOGIN_API_URL"])
+    monkeypatch.setattr(elgana_client, "token_cache", elgana_client.TokenCache())
+    monkeypatch.setattr(elgana_client, "_session", None)
+    monkeypatch.setattr(elgana_api, "ELGANA_API_URL", env["ELGANA_API_URL"])
+    monkeypatch.setattr(
+        image_store, "_store", image_store.LocalImageStore(str(tmp_path / "images"))
+    )
+    yield stub
+    elgana_client.get_session().close()
+    stub.stop()
+
+
+def test_large_download_streams_with_bounded_memory(large_stub, tmp_path):
+    # ログイン・接続を先に済ませ、計測には取り込み 1 回分だけを含める
+    assert elgana_client.get_access_token()
+    tracemalloc.start()
+    try:
+        stored = elgana_api.download_image("room", "big")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert stored is not None and stored.created
+    assert stored.size > IMAGE_BYTES
+    assert os.path.getsize(tmp_path / "images" / stored.filename) == stored.size
+    assert peak < PEAK_LIMIT_BYTES
+    assert not list((tmp_path / "images").glob("*.part"))
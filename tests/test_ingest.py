@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import elgana_api
+from ingest import JobQueue
+
+
+REPORT_BODY = "【①指示】1\n【②状況】側溝の補修\n【③緊急度】高\n【④お客様情報】要請あり\n【⑤備考】テスト"
+
+
+def _report(msg_id):
+    return {
+        "tag": "onMessage",
+        "msg": {
+            "id": msg_id,
+            "roomId": "room",
+            "userId": "user",
+            "type": "text",
+            "body": REPORT_BODY,
+            "extra": "",
+        },
+    }
+
+
+def _job(job_id):
+    return db.get_db().execute(
+        "SELECT status, attempts, last_error FROM webhook_jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+
+
+def test_failed_write_keeps_job_retryable(db_path):
+    conn = db.get_db()
+    conn.execute(
+        """
+        CREATE TRIGGER fail_insert BEFORE INSERT ON operation_orders
+        BEGIN SELECT RAISE(ABORT, 'disk full'); END
+    """
+    )
+    conn.commit()
+    queue = JobQueue(elgana_api.handle_message, workers=0)
+    job_id, created = queue.enqueue(_report("m1"), message_id="m1")
+    assert created
+
+    queue._run(queue._claim())
+    status, attempts, last_error = _job(job_id)
+    assert (status, attempts) == ("pending", 1)
+    assert "disk full" in last_error
+
+    # 再送は重複として弾かれても、同じジョブの再試行で取り込まれる
+    assert queue.enqueue(_report("m1"), message_id="m1") == (job_id, False)
+    conn.execute("DROP TRIGGER fail_insert")
+    conn.commit()
+    conn.execute("UPDATE webhook_jobs SET next_run_at = 0 WHERE id = ?", (job_id,))
+    conn.commit()
+    queue._run(queue._claim())
+    assert _job(job_id)["status"] == "done"
+    assert conn.execute(
+        "SELECT COUNT(*) FROM operation_orders WHERE msg_id = 'm1'"
+    ).fetchone()[0] == 1
+
+
+def _count(table, where="", params=()):
+    return db.get_db().execute(
+        f"SELECT COUNT(*) FROM {table} {where}", params
+    ).fetchone()[0]
+
+
+def test_concurrent_replays_create_one_job_and_one_set_of_rows(db_path):
+    # ワーカーごとに別の JobQueue (重複の記憶は別々) で、同じメッセージを同時に受ける
+    queues = [JobQueue(elgana_api.handle_message, workers=0) for _ in range(4)]
+    threads = 16
+    barrier = threading.Barrier(threads)
+
+    def deliver(i):
+        barrier.wait()
+        return queues[i % len(queues)].enqueue(_report("m1"), message_id="m1")
+
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(deliver, range(threads)))
+
+    job_ids = {job_id for job_id, _ in results}
+    assert len(job_ids) == 1
+    assert sum(created for _, created in results) == 1
+    assert _count("webhook_jobs") == 1
+    assert _count("processed_messages", "WHERE msg_id = 'm1'") == 1
+
+    queue = queues[0]
+    while (job := queue._claim()) is not None:
+        queue._run(job)
+    # 処理後の再送も積まれない
+    assert queue.enqueue(_report("m1"), message_id="m1") == (job_ids.pop(), False)
+    assert queue._claim() is None
+    assert _count("operation_orders", "WHERE msg_id = 'm1'") == 1
+    assert _count("webhook_jobs", "WHERE status = 'done'") == 1
+
+
+def test_stop_timeout_is_shared_by_all_workers(db_path):
+    workers = 4
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def handler(payload):
+        started.release()
+        release.wait(10)
+        return {}, 200
+
+    queue = JobQueue(handler, workers=workers, poll_interval=0.05)
+    for i in range(workers):
+        queue.enqueue({"n": i})
+    for _ in range(workers):
+        assert started.acquire(timeout=5)
+    threads = list(queue._threads)
+
+    began = time.monotonic()
+    queue.stop(0.5)
+    # 実行中のジョブが終わらなくても、待つのは全体で timeout まで (ワーカー数倍ではない)
+    assert time.monotonic() - began < 1.0
+    release.set()
+    for thread in threads:
+        thread.join(5)
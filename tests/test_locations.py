@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+/get_locations の差分 (updated_since) が正しいことを確かめる
+
+前回の全件の応答に、差分の locations を msg_id で上書きし removed を消したものが、
+同じ絞り込みで取り直した全件と一致すること。
+絞り込みから外れる・入る変更 (完了・写真による状態の変化・移動・非表示・削除) を混ぜる
+あわせて、実際の件数での全件のポーリングが組み立て直さずに 304 で済むことも確かめる
+"""
+import statistics
+import time
+
+import pytest
+
+import db
+import elgana_api
+from bench import datagen
+
+
+TOKYO = "35.5,139.5,35.9,140.0"
+
+FILTERS = [
+    {},
+    {"status": "0"},
+    {"status": "1,2"},
+    {"status": "3"},
+    {"bbox": TOKYO},
+    {"bbox": TOKYO, "status": "0,1"},
+]
+
+
+@pytest.fixture
+def seeded(db_path):
+    db.close_db()
+    datagen.generate(db_path, orders=400, rooms=5, users=20, seed=7)
+    return db_path
+
+
+def _full(client, filters):
+    response = client.get("/get_locations", query_string=filters)
+    assert response.status_code == 200
+    return response.get_json(), int(response.headers["X-Locations-Seq"])
+
+
+def _delta(client, filters, since):
+    response = client.get(
+        "/get_locations", query_string={**filters, "updated_since": since}
+    )
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def _apply(previous, delta):
+    merged = {location["msg_id"]: location for location in previous}
+    for msg_id in delta["removed"]:
+        merged.pop(msg_id, None)
+    for location in delta["locations"]:
+        merged[location["msg_id"]] = location
+    return merged
+
+
+def _pick(conn, where, params=()):
+    return conn.execute(
+        f"SELECT msg_id FROM operation_orders WHERE {where} ORDER BY msg_id LIMIT 1",
+        params,
+    ).fetchone()[0]
+
+
+def _mutate(conn):
+    """
+    絞り込みの出入りが起きる変更をまとめて入れる
+    """
+    user_id, user_name = conn.execute(
+        "SELECT user_id, user_name FROM user_info ORDER BY user_id LIMIT 1"
+    ).fetchone()
+    room_id = conn.execute("SELECT room_id FROM rooms LIMIT 1").fetchone()[0]
+    tokyo = "latitude BETWEEN 35.6 AND 35.8 AND longitude BETWEEN 139.6 AND 139.9"
+
+    # 未着手 → 完了 (0 → 3)
+    msg_id = _pick(conn, f"operation_status = '0' AND {tokyo}")
+    conn.execute(
+        "UPDATE operation_orders SET completed = '2025-08-02 10:00:00' WHERE msg_id = ?",
+        (msg_id,),
+    )
+    # 完了の取り消し (3 → 0 など)
+    msg_id = _pick(conn, f"operation_status = '3' AND {tokyo}")
+    conn.execute(
+        "UPDATE operation_orders SET completed = NULL WHERE msg_id = ?", (msg_id,)
+    )
+    # 写真の追加で状態が変わる (0 → 1)
+    msg_id = _pick(conn, f"operation_status = '0' AND {tokyo}")
+    conn.execute(
+        """
+        INSERT INTO spot_info
+            (msg_id, user_id, image_id, repair_required, image_url, image_filename,
+             status_flag, deleted, create_at)
+        VALUES (?, ?, 'img-new', 'true', '/images/new.jpg', 'new.jpg', '1', '0',
+                '2025-08-02 11:00:00')
+    """,
+        (msg_id, user_id),
+    )
+    # 写真の削除で状態が戻る
+    conn.execute(
+        """
+        UPDATE spot_info SET deleted = '1'
+        WHERE id = (
+            SELECT s.id FROM spot_info AS s
+            JOIN operation_orders AS o ON o.msg_id = s.msg_id
+            WHERE o.operation_status IN ('1', '2') AND s.status_flag = '1'
+                AND s.deleted = '0' AND o.completed IS NULL
+            ORDER BY s.id LIMIT 1
+        )
+    """
+    )
+    # 東京の外へ移動・東京の中へ移動
+    msg_id = _pick(conn, tokyo)
+    conn.execute(
+        "UPDATE operation_orders SET latitude = 34.7, longitude = 135.5 WHERE msg_id = ?",
+        (msg_id,),
+    )
+    msg_id = _pick(conn, "latitude < 34.9 AND completed IS NULL")
+    conn.execute(
+        "UPDATE operation_orders SET latitude = 35.7, longitude = 139.7 WHERE msg_id = ?",
+        (msg_id,),
+    )
+    # 非表示
+    msg_id = _pick(conn, f"{tokyo} AND signal IS NOT '0'")
+    conn.execute("UPDATE operation_orders SET signal = '0' WHERE msg_id = ?", (msg_id,))
+    # 削除
+    msg_id = _pick(conn, tokyo)
+    conn.execute("DELETE FROM operation_orders WHERE msg_id = ?", (msg_id,))
+    # 新しい案件
+    conn.execute(
+        """
+        INSERT INTO operation_orders
+            (msg_id, room_id, user_id, latitude, longitude, instruction, urgency,
+             received_at, update_at)
+        VALUES ('new-order', ?, ?, 35.7, 139.8, '25-08-02-001', '高',
+                '2025-08-02 12:00:00', '2025-08-02 12:00:00')
+    """,
+        (room_id, user_id),
+    )
+    # 作業者名の変更 (その作業者の写真がある案件が変わる)
+    conn.execute(
+        "UPDATE user_info SET user_name = ? WHERE user_id = ?",
+        (user_name + "（改）", user_id),
+    )
+    conn.commit()
+
+
+@pytest.mark.parametrize("filters", FILTERS, ids=lambda f: ",".join(f) or "all")
+def test_delta_applied_to_previous_full_equals_fresh_full(seeded, client, filters):
+    previous, seq = _full(client, filters)
+
+    conn = db.connect()
+    try:
+        _mutate(conn)
+    finally:
+        conn.close()
+
+    delta = _delta(client, filters, seq)
+    fresh, fresh_seq = _full(client, filters)
+    assert delta["seq"] == fresh_seq > seq
+    assert delta["locations"] or delta["removed"]
+    assert _apply(previous, delta) == {
+        location["msg_id"]: location for location in fresh
+    }
+
+
+def test_delta_reports_status_filter_transitions(seeded, client):
+    previous, seq = _full(client, {"status": "0"})
+    msg_id = previous[0]["msg_id"]
+
+    conn = db.connect()
+    try:
+        conn.execute(
+            "UPDATE operation_orders SET completed = '2025-08-02 10:00:00' WHERE msg_id = ?",
+            (msg_id,),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    delta = _delta(client, {"status": "0"}, seq)
+    assert delta["removed"] == [msg_id]
+    assert delta["locations"] == []
+    delta = _delta(client, {"status": "3"}, seq)
+    assert [location["msg_id"] for location in delta["locations"]] == [msg_id]
+    assert delta["locations"][0]["operation_status"] == "3"
+
+
+def test_delta_is_empty_without_changes(seeded, client):
+    _, seq = _full(client, {"bbox": TOKYO})
+    assert _delta(client, {"bbox": TOKYO}, seq) == {
+        "seq": seq,
+        "locations": [],
+        "removed": [],
+    }
+
+
+def test_polling_unfiltered_map_at_scale_is_cheap(db_path, client):
+    # 絞り込みなしの全件が RESPONSE_CACHE_MAX_BODY_BYTES (8 MiB) を超える件数
+    db.close_db()
+    datagen.generate(db_path, orders=15000, rooms=20, users=100)
+    gzip_only = {"Accept-Encoding": "gzip"}
+
+    first = client.get("/get_locations", headers=gzip_only)
+    assert first.status_code == 200 and first.headers["Content-Encoding"] == "gzip"
+    etag = first.headers["ETag"]
+    stats = elgana_api.locations_cache.stats()
+    assert (stats["builds"], stats["compacted"], stats["entries"]) == (1, 1, 1)
+
+    times, wire = [], 0
+    for _ in range(20):
+        started = time.perf_counter()
+        response = client.get(
+            "/get_locations", headers={**gzip_only, "If-None-Match": etag}
+        )
+        times.append(time.perf_counter() - started)
+        assert response.status_code == 304
+        wire += len(response.data)
+    assert wire == 0
+    # 組み立て直さずに ETag だけで答える
+    assert statistics.median(times) < 0.05
+
+    started = time.perf_counter()
+    again = client.get("/get_locations", headers=gzip_only)
+    assert time.perf_counter() - started < 0.2
+    assert again.data == first.data
+    assert elgana_api.locations_cache.stats()["builds"] == 1
+
+    # 圧縮を受け付けない時だけ組み立て直す。送るのは本文の数分の 1
+    plain = client.get("/get_locations")
+    assert "Content-Encoding" not in plain.headers
+    assert len(plain.data) > 8 * 1024 * 1024 > len(first.data) * 4
+    assert elgana_api.locations_cache.stats()["builds"] == 2
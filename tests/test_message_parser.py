@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from bench.datagen import report_bodies
+from bench.micro import parse_body_text
+from message_parser import MessageParser, parse_message
+
+
+def _msg(body, **extra):
+    return {"body": body, "type": "text", "extra": "", **extra}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_legacy_parser_on_canonical_bodies(seed):
+    for body, expected in report_bodies(500, seed=seed):
+        parsed = parse_message(_msg(body))
+        assert parsed.kind == "report"
+        assert parsed.fields == parse_body_text(body) == expected, body
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_heading_variants_read_like_canonical_headings(seed):
+    # 括弧・番号の半角/全角、前後の空白、言い換え・打ち間違いの揺れがあっても同じ値になる
+    for body, expected in report_bodies(500, seed=seed, variants=True):
+        assert parse_message(_msg(body)).fields == expected, body
+
+
+@pytest.mark.parametrize(
+    "heading",
+    ["【⑤備考】", "【⑤浦考】", "[5 備考]", "（５．備考）", "　【 備考 】", "［⑤浦考］"],
+)
+def test_remarks_heading_spellings(heading):
+    body = f"【①指示】a\n【②状況】b\n【③緊急度】高\n{heading} 至急"
+    assert parse_message(_msg(body)).fields["⑤備考"] == "至急"
+
+
+def test_kinds():
+    assert parse_message(_msg("位置情報を送信しました", extra='{"lat": 1}')).kind == "location"
+    assert parse_message(_msg("位置情報を送信しました")).kind == "unknown"
+    assert parse_message({"body": "", "type": "image"}).kind == "image"
+    assert parse_message(_msg("テストカルーセル")).kind == "carousel"
+    assert parse_message(_msg("指示だけ")).kind == "unknown"
+
+
+def test_non_heading_lines_are_ignored():
+    body = "【①指示】1\n【②状況】b\n【③緊急度】高\n指示：上書きしない\n  本文中の【④お客様情報】x"
+    fields = parse_message(_msg(body)).fields
+    assert fields["①指示"] == "1"
+    assert fields["④お客様情報"] == ""
+
+
+def test_custom_field_table():
+    from message_parser import Field, Template
+
+    parser = MessageParser(
+        fields=[Field("場所", ("場所",))],
+        templates=[Template("place", keywords=("場所",))],
+    )
+    parsed = parser.parse(_msg("[1 場所] 東京"))
+    assert parsed == ("place", {"場所": "東京"})
+    assert parser.parse(_msg("【場所】 東京")).fields == {"場所": "東京"}
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+from flask import Flask
+
+import metrics
+import request_metrics
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_db_layer_does_not_import_flask():
+    code = (
+        "import sys, db, metrics, migrations, consistency, writer;"
+        "sys.exit('flask' in sys.modules)"
+    )
+    assert subprocess.run([sys.executable, "-c", code], cwd=ROOT).returncode == 0
+
+
+def test_request_hooks_record_duration_and_queries():
+    app = Flask(__name__)
+    request_metrics.init_app(app)
+
+    @app.route("/ping")
+    def ping():
+        metrics.count_query("SELECT 1")
+        return "pong"
+
+    assert app.test_client().get("/ping").status_code == 200
+    rendered = "\n".join(
+        metrics.http_request_duration.render() + metrics.sqlite_queries.render()
+    )
+    assert 'http_request_duration_seconds_count{route="/ping",method="GET",status="200"} 1' in rendered
+    assert 'sqlite_queries_per_request_count{route="/ping"} 1' in rendered
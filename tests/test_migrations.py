@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+よく通るクエリが migrations.py のインデックスを使い、表を走査しないことを
+EXPLAIN QUERY PLAN で確かめる (実際に発行された SQL を trace で拾って調べる)
+"""
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import db
+import elgana_api
+from migrations import MIGRATIONS, migrate
+
+
+def _plans(conn, run):
+    """
+    run() の中で conn が実行した SQL ごとの EXPLAIN QUERY PLAN の detail の list
+    トリガーの中の文 (-- で始まる) は元の文の計画に含まれないので除く
+    """
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        run()
+    finally:
+        conn.set_trace_callback(None)
+    plans = {}
+    for statement in statements:
+        if statement.lstrip().split()[0].upper() not in ("SELECT", "UPDATE", "DELETE"):
+            continue
+        plans[statement] = [
+            row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {statement}")
+        ]
+    assert plans
+    return plans
+
+
+def _scans(plans):
+    return {
+        " ".join(statement.split())[:80]: [d for d in details if d.startswith("SCAN")]
+        for statement, details in plans.items()
+        if any(d.startswith("SCAN") for d in details)
+    }
+
+
+def test_migrate_is_idempotent_and_tracks_user_version(db_path):
+    conn = db.connect()
+    try:
+        assert migrate(conn) == MIGRATIONS[-1][0]
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == MIGRATIONS[-1][0]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        {"room_id": "room"},
+        {"status": "0,1"},
+        {"bbox": "35.5,139.5,35.8,139.9"},
+        {"updated_since": "5"},
+    ],
+)
+def test_filtered_get_locations_does_not_scan(db_path, args):
+    conn = db.get_db()
+    where, params, since = elgana_api.parse_locations_filters(MultiDict(args))
+    plans = _plans(
+        conn, lambda: elgana_api.query_locations(conn, where, params, since)
+    )
+    assert _scans(plans) == {}
+
+
+@pytest.mark.parametrize(
+    "args, index",
+    [
+        ({"bbox": "35.5,139.5,35.8,139.9", "status": "0,1,2"}, "idx_operation_orders_lat_lon"),
+        ({"room_id": "room", "status": "0"}, "idx_operation_orders_room_status"),
+        ({"status": "0", "updated_since": "5"}, "idx_operation_orders_row_seq"),
+        (
+            {"bbox": "35.5,139.5,35.8,139.9", "status": "0", "updated_since": "5"},
+            "idx_operation_orders_row_seq",
+        ),
+    ],
+)
+def test_combined_filters_use_the_selective_index(db_path, args, index):
+    # 統計が無くても状態 (4 通り) の索引より絞り込める索引から引く
+    conn = db.get_db()
+    where, params, since = elgana_api.parse_locations_filters(MultiDict(args))
+    plans = _plans(
+        conn, lambda: elgana_api.query_locations(conn, where, params, since)
+    )
+    details = [d for details in plans.values() for d in details]
+    assert any(f"USING INDEX {index}" in d for d in details)
+    assert not any("idx_operation_orders_status" in d for d in details)
+
+
+def test_full_get_locations_only_reads_each_table_once(db_path):
+    conn = db.get_db()
+    plans = _plans(conn, lambda: elgana_api.query_locations(conn, [], [], None))
+    # 全件は operation_orders と spot_info を 1 回ずつ読むだけ。作業者は user_id で引く
+    assert sorted(d for scans in _scans(plans).values() for d in scans) == [
+        "SCAN main.operation_orders",
+        "SCAN s",
+    ]
+    assert any(
+        "SEARCH u USING INDEX idx_user_info_user_id" in d
+        for details in plans.values()
+        for d in details
+    )
+
+
+def test_status_lookups_use_msg_id_index(db_path, client):
+    conn = db.get_db()
+    conn.execute(
+        "INSERT INTO operation_orders (msg_id, room_id, instruction) VALUES ('m1', 'r', 'i')"
+    )
+    conn.commit()
+    plans = _plans(
+        conn, lambda: client.post("/completed", json={"msg_id": "m1"})
+    )
+    assert _scans(plans) == {}
+    assert any(
+        "USING INDEX idx_operation_orders_msg_id" in d
+        for details in plans.values()
+        for d in details
+    )
+
+
+def test_image_lookups_use_indexes(db_path, client):
+    conn = db.get_db()
+
+    def run():
+        elgana_api.image_visible(conn, "legacy.jpg")
+        elgana_api.image_visible(conn, "0" * 64 + ".jpg")
+        client.post(
+            "/deleted", json={"msg_id": "m1", "image_url": "/images/a.jpg", "deleted": "0"}
+        )
+
+    plans = _plans(conn, run)
+    assert _scans(plans) == {}
+    details = [d for details in plans.values() for d in details]
+    assert any("idx_spot_info_image_filename" in d for d in details)
+    assert any("idx_spot_info_msg_id_image_url" in d for d in details)
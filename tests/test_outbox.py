@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import db
+from outbox import OutboxDispatcher, enqueue_message
+
+
+def _enqueue(room_id, text):
+    conn = db.get_db()
+    outbox_id = enqueue_message(conn, room_id, text)
+    conn.commit()
+    return outbox_id
+
+
+def test_retried_message_stays_ahead_of_later_ones(db_path):
+    dispatcher = OutboxDispatcher(lambda room_id, text: None, send_rate=0)
+    first = _enqueue("room-a", "1")
+    room_id, rows, _ = dispatcher._claim()
+    assert [row["id"] for row in rows] == [first]
+    dispatcher._failed(room_id, rows, "503", retry_after=60)
+
+    # 再試行を待っている間に積まれた同じルームの通知は、先に送らない
+    second = _enqueue("room-a", "2")
+    other = _enqueue("room-b", "x")
+    room_id, rows, _ = dispatcher._claim()
+    assert (room_id, [row["id"] for row in rows]) == ("room-b", [other])
+    assert dispatcher._claim()[0] is None
+
+    conn = db.get_db()
+    conn.execute("UPDATE outbox SET next_run_at = 0 WHERE id = ?", (first,))
+    conn.commit()
+    room_id, rows, _ = dispatcher._claim()
+    assert (room_id, [row["id"] for row in rows]) == ("room-a", [first, second])
+
+
+def test_batch_stops_before_a_message_that_is_not_due(db_path):
+    dispatcher = OutboxDispatcher(lambda room_id, text: None, send_rate=0)
+    ids = [_enqueue("room-a", str(i)) for i in range(3)]
+    conn = db.get_db()
+    conn.execute("UPDATE outbox SET next_run_at = 9e18 WHERE id = ?", (ids[1],))
+    conn.commit()
+    room_id, rows, _ = dispatcher._claim()
+    assert [row["id"] for row in rows] == [ids[0]]
+
+
+def test_wake_during_claim_is_not_lost(db_path):
+    posted = []
+    dispatcher = OutboxDispatcher(
+        lambda room_id, text: posted.append(text), send_rate=0, poll_interval=60
+    )
+    claim = dispatcher._claim
+
+    def claim_then_enqueue():
+        # 空を確認した直後に別のリクエストが積んで wake() する
+        result = claim()
+        if not posted and result[0] is None:
+            _enqueue("room-a", "late")
+            dispatcher.wake()
+        return result
+
+    dispatcher._claim = claim_then_enqueue
+    dispatcher.start()
+    try:
+        for _ in range(200):
+            if posted:
+                break
+            dispatcher._stopping.wait(0.01)
+    finally:
+        dispatcher.stop(5)
+    assert posted == ["late"]
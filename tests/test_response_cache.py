@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import threading
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from response_cache import ResponseCache
+
+
+def _build(body):
+    return lambda: (body, {})
+
+
+def test_slow_build_does_not_block_other_keys():
+    cache = ResponseCache()
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return b"slow", {}
+
+    thread = threading.Thread(target=cache.get, args=("bbox", 1, slow))
+    thread.start()
+    try:
+        assert started.wait(5)
+        # 別のキーの組み立ては、遅い組み立ての終わりを待たない
+        assert cache.get("all", 1, _build(b"fast")).body == b"fast"
+    finally:
+        release.set()
+        thread.join(5)
+
+
+def test_concurrent_misses_for_one_key_build_once():
+    cache = ResponseCache()
+    builds = []
+    gate = threading.Barrier(8)
+
+    def build():
+        builds.append(1)
+        return b"body", {}
+
+    def fetch():
+        gate.wait(5)
+        cache.get("all", 1, build)
+
+    threads = [threading.Thread(target=fetch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(builds) == 1
+
+
+def test_total_bytes_are_capped_including_compressed_copies():
+    cache = ResponseCache(max_entries=16, max_bytes=10_000, max_body_bytes=5_000)
+    for i in range(5):
+        cached = cache.get(i, 1, _build(bytes(range(256)) * 16))
+        cached.encoded("gzip")
+    stats = cache.stats()
+    assert stats["bytes"] <= 10_000
+    assert 0 < stats["entries"] < 5
+    # 新しいものが残る
+    assert cache.get(4, 1, _build(b"rebuilt")).body != b"rebuilt"
+
+
+def _request(headers=None):
+    return Request(EnvironBuilder(headers=headers or {}).get_environ())
+
+
+def test_oversized_body_keeps_only_the_gzip_copy():
+    cache = ResponseCache(max_body_bytes=1000)
+    body = b'{"x": "' + b"a" * 5000 + b'"}'
+    builds = []
+
+    def build():
+        builds.append(1)
+        return body, {}
+
+    response = cache.respond(_request({"Accept-Encoding": "gzip"}), "big", 1, build)
+    etag = response.get_etag()[0]
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()) == body
+    stats = cache.stats()
+    assert (stats["entries"], stats["compacted"], stats["oversized"]) == (1, 1, 0)
+    assert stats["bytes"] < 1000
+
+    # 304・gzip の応答は組み立て直さない
+    response = cache.respond(
+        _request({"Accept-Encoding": "gzip", "If-None-Match": f'"{etag}"'}), "big", 1, build
+    )
+    assert response.status_code == 304
+    response = cache.respond(_request({"Accept-Encoding": "gzip, br"}), "big", 1, build)
+    assert gzip.decompress(response.get_data()) == body
+    assert len(builds) == 1
+
+    # 圧縮を受け付けないクライアントにだけ組み立て直す
+    response = cache.respond(_request(), "big", 1, build)
+    assert response.get_data() == body and "Content-Encoding" not in response.headers
+    assert len(builds) == 2
+
+
+def test_body_too_large_even_compressed_is_served_but_not_kept():
+    cache = ResponseCache(max_body_bytes=100)
+    body = os.urandom(2000)
+    assert cache.get("big", 1, _build(body)).body == body
+    other = os.urandom(2000)
+    assert cache.get("big", 1, _build(other)).body == other
+    stats = cache.stats()
+    assert (stats["entries"], stats["builds"], stats["oversized"]) == (0, 2, 2)
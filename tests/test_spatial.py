@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+R*Tree で絞ってから距離で判定する find_nearby が、全件を haversine で調べた結果と一致することを確かめる
+"""
+import math
+import random
+
+import pytest
+
+import db
+import spatial
+from bench import datagen
+
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    # spatial.distance_m とは別に書いた比較用 (atan2 形)
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * spatial.EARTH_RADIUS_M * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+@pytest.fixture
+def orders(db_path):
+    db.close_db()
+    datagen.generate(db_path, orders=5000, rooms=10, users=50, seed=11)
+    conn = db.get_db()
+    # 高緯度・経度 180 度の近く・非表示の案件も混ぜる
+    conn.executemany(
+        """
+        INSERT INTO operation_orders (msg_id, room_id, latitude, longitude, instruction, signal)
+        VALUES (?, 'room', ?, ?, 'i', ?)
+    """,
+        [
+            ("north-1", 45.5, 141.9, None),
+            ("north-2", 45.5012, 141.9, None),
+            ("dateline", 35.0, 179.9999, None),
+            ("dateline-west", 35.0, -179.9995, None),
+            ("hidden", 35.68, 139.76, "0"),
+        ],
+    )
+    conn.commit()
+    return [
+        tuple(row)
+        for row in conn.execute(
+            """
+            SELECT msg_id, latitude, longitude, completed, signal FROM operation_orders
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        """
+        )
+    ]
+
+
+def _brute_force(orders, latitude, longitude, radius_m, open_only=False):
+    found = {}
+    for msg_id, lat, lon, completed, signal in orders:
+        if signal == "0" or (open_only and completed):
+            continue
+        distance = _haversine_m(latitude, longitude, lat, lon)
+        if distance <= radius_m:
+            found[msg_id] = distance
+    return found
+
+
+def test_find_nearby_matches_brute_force(orders):
+    conn = db.get_db()
+    rng = random.Random(5)
+    centers = [(35.68, 139.76), (34.69, 135.50), (45.5, 141.9), (35.0, 179.99)]
+    centers += [(35.0, -179.99), (35.0, 180.0)]
+    centers += [orders[rng.randrange(len(orders))][1:3] for _ in range(10)]
+    centers += [(rng.uniform(31, 43), rng.uniform(130, 145)) for _ in range(10)]
+    checked = 0
+    for latitude, longitude in centers:
+        for radius_m in (20, 200, 1000, 5000):
+            for open_only in (False, True):
+                expected = _brute_force(orders, latitude, longitude, radius_m, open_only)
+                found = spatial.find_nearby(
+                    conn,
+                    latitude,
+                    longitude,
+                    radius_m,
+                    open_only=open_only,
+                    limit=len(orders),
+                )
+                # 半径ちょうど (1 mm 以内) の案件は式の違いによる誤差で出入りしうるので除く
+                edge = {m for m, d in expected.items() if abs(d - radius_m) < 1e-3}
+                assert {o["msg_id"] for o in found} - edge == set(expected) - edge
+                distances = [o["distance"] for o in found]
+                assert distances == sorted(distances)
+                for order in found:
+                    assert order["distance"] == pytest.approx(
+                        expected.get(order["msg_id"], radius_m), abs=0.1
+                    )
+                checked += len(expected)
+    # 近くに案件のある中心で実際に件数のある比較をしている
+    assert checked > 300
+
+
+def test_find_nearby_limit_keeps_the_closest(orders):
+    conn = db.get_db()
+    expected = _brute_force(orders, 35.68, 139.76, 5000)
+    closest = sorted(expected, key=expected.get)[:5]
+    found = spatial.find_nearby(conn, 35.68, 139.76, 5000, limit=5)
+    assert [o["msg_id"] for o in found] == closest
+
+
+def test_find_nearby_includes_points_across_high_latitude_box(orders):
+    conn = db.get_db()
+    # 北に 133 m
+    found = spatial.find_nearby(conn, 45.5, 141.9, 200)
+    assert {"north-1", "north-2"} <= {o["msg_id"] for o in found}
+    assert "hidden" not in {
+        o["msg_id"] for o in spatial.find_nearby(conn, 35.68, 139.76, 50)
+    }
+
+
+def test_find_nearby_across_the_antimeridian(orders):
+    conn = db.get_db()
+    # 東経 179.9999 度と西経 179.9995 度は 55 m ほどしか離れていない
+    for longitude in (179.9999, -179.9995, 180.0, -180.0):
+        found = {o["msg_id"] for o in spatial.find_nearby(conn, 35.0, longitude, 100)}
+        assert {"dateline", "dateline-west"} <= found
+
+
+def test_longitude_ranges_split_at_the_antimeridian():
+    assert spatial.longitude_ranges(139.0, 140.0) == [(139.0, 140.0)]
+    assert spatial.longitude_ranges(179.5, 180.5) == [(179.5, 180.0), (-180.0, -179.5)]
+    assert spatial.longitude_ranges(-180.5, -179.5) == [(179.5, 180.0), (-180.0, -179.5)]
+    assert spatial.longitude_ranges(-100.0, 300.0) == [(-180.0, 180.0)]
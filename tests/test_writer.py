@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import pytest
+
+import db
+import elgana_api
+from writer import WriteBatcher
+
+
+def _insert(msg_id):
+    def write(conn):
+        conn.execute("INSERT INTO operation_orders (msg_id) VALUES (?)", (msg_id,))
+        return msg_id
+
+    return write
+
+
+def _fail(conn):
+    conn.execute("INSERT INTO operation_orders (msg_id) VALUES ('rolled-back')")
+    raise sqlite3.IntegrityError("constraint failed")
+
+
+def test_failed_write_is_reported_to_its_caller_only(db_path):
+    writer = WriteBatcher(wait_ms=50)
+    try:
+        futures = [writer.submit(_insert("a")), writer.submit(_fail), writer.submit(_insert("b"))]
+        assert futures[0].result(5) == "a"
+        with pytest.raises(sqlite3.IntegrityError):
+            futures[1].result(5)
+        assert futures[2].result(5) == "b"
+    finally:
+        writer.stop(5)
+
+    rows = [
+        row[0]
+        for row in db.get_db().execute("SELECT msg_id FROM operation_orders ORDER BY id")
+    ]
+    assert rows == ["a", "b"]
+    assert writer.stats()["failures"] == 1
+
+
+def test_unexpected_commit_error_fails_pending_writes(db_path, monkeypatch):
+    writer = WriteBatcher()
+
+    def broken(conn, batch):
+        raise RuntimeError("writer broke")
+
+    monkeypatch.setattr(writer, "_commit", broken)
+    try:
+        with pytest.raises(RuntimeError):
+            writer.submit(_insert("a")).result(5)
+    finally:
+        writer.stop(5)
+
+
+def test_write_helpers_raise_writer_failures(db_path):
+    conn = db.get_db()
+    conn.execute("INSERT INTO operation_orders (msg_id) VALUES ('m1')")
+    conn.execute(
+        """
+        CREATE TRIGGER fail_update BEFORE UPDATE ON operation_orders
+        BEGIN SELECT RAISE(ABORT, 'database is locked'); END
+    """
+    )
+    conn.commit()
+    with pytest.raises(sqlite3.IntegrityError, match="database is locked"):
+        elgana_api.update_locations("m1", "m2", 35.68, 139.76)
+    conn.execute("DROP TRIGGER fail_update")
+    conn.commit()
+    assert elgana_api.insert_locations("m3", "room", "user", 35.0, 135.0) is None
+    assert elgana_api.insert_locations("m4", "room", "user", 35.0, 135.0) == "m3"
@@ -8,8 +8,11 @@ export default {
 	server: {
 		proxy: {
 			'/get_locations': { target: 'http://127.0.0.1:5000', changeOrigin: true },
+			'/get_clusters': { target: 'http://127.0.0.1:5000', changeOrigin: true },
 			'/completed': { target: 'http://127.0.0.1:5000', changeOrigin: true },
-			'/deleted': { target: 'http://127.0.0.1:5000', changeOrigin: true }
+			'/deleted': { target: 'http://127.0.0.1:5000', changeOrigin: true },
+			'/events': { target: 'http://127.0.0.1:5000', changeOrigin: true },
+			'/images': { target: 'http://127.0.0.1:5000', changeOrigin: true }
 		}
 	},
 	esbuild: {
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+書き込みのまとめコミット (group commit)
+
+webhook の取り込みでは 1 件ごとに INSERT とコミットをしていたため、
+報告が一度に押し寄せるとコミット (fsync) の回数だけ待たされ、書き込みロックも奪い合っていた。
+プロセスに 1 本の書き込みスレッドを置き、各スレッドから渡された書き込みを
+前のコミットの間に溜まった分 (と WRITE_BATCH_WAIT_MS の間に届いた分) ずつ、
+最大 WRITE_BATCH_MAX 件まで 1 つのトランザクションで実行する。
+
+書き込みは fn(conn) の形で渡し、1 件ごとに SAVEPOINT で区切るので、
+1 件が失敗してもその 1 件だけ取り消され、呼び出し元にはその例外が返る。
+fn の中でコミット・ロールバックはしない。書き込みスレッドの中から run() を呼ぶと止まる
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from db import connect
+from metrics import timed
+
+
+# 1 トランザクションにまとめる書き込みの最大数
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "200"))
+# 最初の書き込みが来てから後続を待つ時間 (ミリ秒)
+# 0 でもコミット中に積まれた分は次にまとめて実行される。
+# ジョブの取得・書き込み・完了は順に待ち合わせるので、待たせると 1 件ごとに遅れが積み重なる
+WRITE_BATCH_WAIT_MS = float(os.getenv("WRITE_BATCH_WAIT_MS", "0"))
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBatcher:
+    """
+    書き込みスレッドと、そこへ渡す書き込みのキュー
+
+    writes：実行した書き込みの数
+    batches：コミットした回数
+    failures：失敗した書き込みの数
+    """
+
+    def __init__(self, max_batch=WRITE_BATCH_MAX, wait_ms=WRITE_BATCH_WAIT_MS):
+        self._max_batch = max_batch
+        self._wait = wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stats = {"writes": 0, "batches": 0, "failures": 0}
+
+    def start(self):
+        """
+        このプロセスの書き込みスレッドを起動する (起動済みなら何もしない)
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(
+                target=self._loop, name="db-writer", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout=None):
+        """
+        積まれている書き込みを全て実行してからスレッドを止める
+        """
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+
+    def submit(self, fn):
+        """
+        fn(conn) を書き込みスレッドで実行し、その戻り値を持つ Future を返す
+        """
+        self.start()
+        future = Future()
+        self._queue.put((fn, future))
+        return future
+
+    def run(self, fn):
+        """
+        submit して、コミットされるまで待つ (失敗した時は例外を送出する)
+        """
+        return self.submit(fn).result()
+
+    def _collect(self, first):
+        """
+        first に続けて、待ち時間内に届いた書き込みを最大件数まで集める
+        停止の合図 (None) を受け取ったら 2 つ目の戻り値が True
+        """
+        batch = [first]
+        deadline = time.monotonic() + self._wait
+        while len(batch) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _loop(self):
+        conn = connect()
+        # BEGIN / SAVEPOINT / COMMIT は自分で発行する
+        conn.isolation_level = None
+        # ここの SQL はどのリクエストにも属さないので数えない (トリガー内の文まで呼ばれて遅くなる)
+        conn.set_trace_callback(None)
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stopping = self._collect(first)
+            try:
+                with timed("db_commit"):
+                    self._commit(conn, batch)
+            except Exception as e:
+                logger.exception("書き込みのコミット失敗！！")
+                # 結果を受け取れないまま呼び出し元を待たせない
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        batch = [(fn, f) for fn, f in batch if f.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            self._count(len(batch), len(batch))
+            return
+
+        done = []
+        failures = 0
+        try:
+            for fn, future in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    result = fn(conn)
+                    conn.execute("RELEASE write")
+                    done.append((future, result))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    future.set_exception(e)
+                    failures += 1
+            conn.execute("COMMIT")
+        except Exception as e:
+            # コミットできなかった (または取り消しに失敗した) ら、まとめた書き込みは全て失敗
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            self._count(len(batch), len(batch))
+            return
+        self._count(len(batch), failures, committed=True)
+        for future, result in done:
+            future.set_result(result)
+
+    def _count(self, writes, failures, committed=False):
+        with self._lock:
+            self._stats["writes"] += writes
+            self._stats["failures"] += failures
+            self._stats["batches"] += committed
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "pending": self._queue.qsize()}
+
+
+_writer = WriteBatcher()
+
+
+def get_writer():
+    """
+    プロセス共通の WriteBatcher を返す
+    """
+    return _writer